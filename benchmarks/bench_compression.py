@@ -0,0 +1,165 @@
+'''
+Effective throughput of lansync send --compress on a mixed payload.
+
+The payload is a third each of log files, binary records (mostly noise) and
+photos (random data behind JPEG magic bytes). It is streamed over a
+simulated link of the given speeds three ways: uncompressed (lansync send
+as before), zlib level 6 for everything (plain rsync -z) and the per-class
+levels picked by compression.plan. Every stream compresses on one thread,
+throttles to the link speed on another and decompresses on a third, so
+CPU and link overlap like in an rsync session. Results are JSON lines.
+
+    python benchmarks/bench_compression.py [--size 192M] [--link-speeds 100,300,1000] [--quick]
+'''
+import argparse
+import json
+import os
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lansync.compression import plan  # noqa: E402
+from lansync.send import FileEntry  # noqa: E402
+from lansync.utilities import parse_size  # noqa: E402
+
+
+SIZE = '192M'
+QUICK_SIZE = '48M'
+LINK_SPEEDS = '100,300,1000'
+FILE_SIZE = 4 * 2**20
+CHUNK_SIZE = 256 * 1024
+# chunks in flight between the stages, about what socket buffers hold
+QUEUE_CHUNKS = 16
+
+
+def log_data(size: int, rng: random.Random) -> bytes:
+    lines = []  # type: List[str]
+    total = 0
+    while total < size:
+        line = f'2024-05-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} ' \
+               f'INFO worker-{rng.randint(0, 15)} GET /api/items/{rng.randint(0, 10**6)} 200 {rng.randint(1, 999)}ms\n'
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def record_data(size: int, rng: random.Random) -> bytes:
+    noise = rng.randbytes(size)
+    return b''.join(b'REC' + (i % 2**32).to_bytes(4, 'little') + noise[i * 20:i * 20 + 20] + bytes(5) for i in range(size // 32))
+
+
+def make_payload(directory: str, size: int) -> List[FileEntry]:
+    rng = random.Random(0)
+    makers = [('log', log_data), ('rec', record_data), ('jpg', lambda n, rng: b'\xff\xd8\xff' + rng.randbytes(n - 3))]
+    files = []  # type: List[FileEntry]
+    for i in range(max(3, size // FILE_SIZE)):
+        suffix, make = makers[i % len(makers)]
+        name = f'file{i}.{suffix}'
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(make(FILE_SIZE, rng))
+        files.append(FileEntry(path, name, FILE_SIZE))
+    return files
+
+
+def stream(files: List[FileEntry], level_of: Callable[[FileEntry], Optional[int]], speed: float) -> Dict[str, float]:
+    '''
+    Send files over a link of speed bytes per second, returns seconds and bytes on the wire
+    '''
+    on_link = queue.Queue(QUEUE_CHUNKS)  # type: queue.Queue
+    received = queue.Queue(QUEUE_CHUNKS)  # type: queue.Queue
+    wire = [0]
+
+    def link() -> None:
+        start = time.perf_counter()
+        while True:
+            item = on_link.get()
+            if item is not None:
+                wire[0] += len(item[1])
+                delay = start + wire[0] / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            received.put(item)
+            if item is None:
+                return
+
+    def receive() -> None:
+        decompressor = None
+        while True:
+            item = received.get()
+            if item is None:
+                return
+            first, data, compressed = item
+            if first:
+                decompressor = zlib.decompressobj(-15) if compressed else None
+            if decompressor is not None:
+                decompressor.decompress(data)
+
+    threads = [threading.Thread(target=link), threading.Thread(target=receive)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for entry in files:
+        level = level_of(entry)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if level is not None else None
+        with open(entry.path, 'rb') as f:
+            # an empty chunk starts every file, the receiver sets up its decompressor on it
+            on_link.put((True, b'', compressor is not None))
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if len(chunk) > 0:
+                    on_link.put((False, chunk, compressor is not None))
+            if compressor is not None:
+                on_link.put((False, compressor.flush(), True))
+    on_link.put(None)
+    for thread in threads:
+        thread.join()
+    return {'seconds': time.perf_counter() - start, 'wire': wire[0]}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', default=None, help=f'Size of the payload. Default is {SIZE}, {QUICK_SIZE} with --quick')
+    parser.add_argument('--link-speeds', default=LINK_SPEEDS, help=f'Comma separated link speeds in Mbit/s. Default is {LINK_SPEEDS}')
+    parser.add_argument('--quick', action='store_true', help='Smaller payload')
+    args = parser.parse_args()
+    size = parse_size(args.size or (QUICK_SIZE if args.quick else SIZE))
+
+    directory = tempfile.mkdtemp(prefix='lansync-bench-compression-')
+    try:
+        files = make_payload(directory, size)
+        total = sum(f.size for f in files)
+        for mbits in [int(speed) for speed in args.link_speeds.split(',')]:
+            speed = mbits * 10**6 / 8
+            start = time.perf_counter()
+            groups = plan(files, 'zlib', speed, jobs=1)
+            planning = time.perf_counter() - start
+            levels = {entry.path: group.choice.level for group in groups for entry in group.files}
+            print(json.dumps({'link_mbit': mbits, 'plan_seconds': round(planning, 3),
+                              'classes': {group.kind: group.choice.level for group in groups}}), flush=True)
+            strategies = [
+                ('uncompressed', lambda entry: None),
+                ('zlib level 6', lambda entry: 6),
+                ('policy', lambda entry: levels[entry.path]),
+            ]  # type: List
+            baseline = None  # type: Optional[float]
+            for name, level_of in strategies:
+                measured = stream(files, level_of, speed)
+                mb_per_s = total / 2**20 / measured['seconds']
+                baseline = baseline or mb_per_s
+                print(json.dumps({'name': f'{name} {mbits}Mbit', 'seconds': round(measured['seconds'], 3), 'size': total,
+                                  'wire': measured['wire'], 'mb_per_s': round(mb_per_s, 1), 'gain': round(mb_per_s / baseline, 2)}), flush=True)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+'''
+Throughput of the built-in delta engine against rsync on loopback.
+
+A random base file is copied to the destination, then a few scattered
+blocks of the source are changed and a few bytes inserted, the way a VM
+image changes between two sends. Both engines update the destination in
+place; rsync runs as a local client/server pair talking over a pipe.
+
+    python benchmarks/bench_delta.py [--size 256M] [--block-size 8K]
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lansync.delta import SignatureCache, sync_file  # noqa: E402
+from lansync.utilities import parse_size  # noqa: E402
+
+
+def make_files(directory: str, size: int, changes: int):
+    base = os.path.join(directory, 'base.img')
+    src = os.path.join(directory, 'src.img')
+    with open(base, 'wb') as f:
+        for _ in range(0, size, 2**20):
+            f.write(os.urandom(min(2**20, size - f.tell())))
+    shutil.copyfile(base, src)
+    rng = random.Random(0)
+    with open(src, 'r+b') as f:
+        for _ in range(changes):
+            f.seek(rng.randrange(size - 4096))
+            f.write(os.urandom(rng.randrange(1, 4096)))
+    return base, src
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def result(name: str, size: int, seconds: float, **extra) -> dict:
+    return dict(name=name, seconds=round(seconds, 3), mb_per_s=round(size / 2**20 / seconds, 1), **extra)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', default='256M')
+    parser.add_argument('--block-size', default=None)
+    parser.add_argument('--changes', type=int, default=32)
+    args = parser.parse_args()
+    size = parse_size(args.size)
+    block_size = parse_size(args.block_size) if args.block_size is not None else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        base, src = make_files(directory, size, args.changes)
+        results = []
+
+        dest = os.path.join(directory, 'dest.img')
+        shutil.copyfile(base, dest)
+        cache = SignatureCache(os.path.join(directory, 'signatures'))
+        sync = {}
+        seconds = timed(lambda: sync.update(result=sync_file(src, dest, block_size, cache)))
+        results.append(result('lansync sync', size, seconds, literal=sync['result'].literal, written=sync['result'].written))
+        # unchanged source against the cached signature
+        seconds = timed(lambda: sync_file(src, dest, block_size, cache))
+        results.append(result('lansync sync, cached signature', size, seconds))
+
+        rsync = shutil.which('rsync')
+        if rsync is None:
+            results.append({'name': 'rsync', 'skipped': 'rsync is not installed'})
+        else:
+            shutil.copyfile(base, dest)
+            options = ['--inplace', '--no-whole-file'] + (['--block-size', str(block_size)] if block_size is not None else [])
+            seconds = timed(lambda: subprocess.run([rsync] + options + [src, dest], check=True))
+            results.append(result('rsync', size, seconds))
+
+        for line in results:
+            print(json.dumps(line))
+
+
+if __name__ == '__main__':
+    main()
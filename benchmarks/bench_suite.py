@@ -0,0 +1,337 @@
+'''
+Offline benchmarks of key import, share provisioning and transfer throughput.
+
+Everything runs on synthetic data in a throwaway HOME: authorized_keys files
+with 1k to 1M keys, key lists served by a local stand-in for github.com,
+share images of several sizes and a tree of files sent by lansync send
+(plan_tree, sharding and its rsync processes) to a local stand-in for
+rsync that copies them into a directory. The same files streamed with
+sendfile over loopback TCP give the upper bound of the kernel alone; with
+--peer they are also sent to a real peer. Results are printed as JSON lines.
+--save stores them as a baseline, --compare exits with 1 when a benchmark
+got slower than the baseline by more than --threshold.
+
+    python benchmarks/bench_suite.py [--quick] [--only keys,fetch,share,transfer]
+        [--save baseline.json] [--compare baseline.json [--threshold 0.25]] [--jobs <n>] [--peer user@host]
+'''
+import argparse
+import base64
+import hashlib
+import json
+import os
+import platform
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+# paths in lansync.settings are derived from HOME when it is imported
+HOME = tempfile.mkdtemp(prefix='lansync-bench-')
+os.environ['HOME'] = HOME
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lansync import fetch, utilities, validation  # noqa: E402
+from lansync.keystore import KeyStore  # noqa: E402
+from lansync.lansync import create_share  # noqa: E402
+from lansync.settings import AUTHORIZED_KEYS_PATH, PATH_TO_PUBLIC_DIR_FILE, SECURE_OPTIONS, SEND_JOBS  # noqa: E402
+from lansync.utilities import get_first_partition_offset, get_pub_keys, import_key, is_key_imported, parse_size  # noqa: E402
+
+
+KEY_COUNTS = [1000, 10000, 100000, 1000000]
+QUICK_KEY_COUNTS = [1000, 10000, 100000]
+USER_COUNTS = [10, 100]
+KEYS_PER_USER = 3
+SHARE_SIZES = ['16M', '256M', '1G']
+QUICK_SHARE_SIZES = ['16M', '256M']
+TRANSFER_SIZE = '512M'
+QUICK_TRANSFER_SIZE = '64M'
+THRESHOLD = 0.25
+# differences below this many seconds are noise, whatever the ratio
+MIN_SLOWDOWN = 0.001
+TRANSFER_FILE_SIZE = 4 * 2**20
+TRANSFER_DIRS = 4
+
+LOCAL_RSYNC = '''#!{python}
+import shutil, sys
+for path in sys.argv[1:-1]:
+    if not path.startswith('-'):
+        shutil.copy(path, {share!r})
+'''
+
+
+def synthetic_key(i: int) -> str:
+    # a well formed ed25519 key, its 32 bytes of key material derived from i
+    blob = struct.pack('>I', 11) + b'ssh-ed25519' + struct.pack('>I', 32) + hashlib.sha256(str(i).encode()).digest()
+    return 'ssh-ed25519 ' + base64.b64encode(blob).decode('ascii') + f' bench{i}@lansync'
+
+
+def write_authorized_keys(path: str, count: int) -> None:
+    with open(path, 'w') as f:
+        for start in range(0, count, 10000):
+            f.write(''.join(SECURE_OPTIONS + ' ' + synthetic_key(i) + '\n' for i in range(start, min(count, start + 10000))))
+
+
+def best(fn: Callable[[], object], repeat: int) -> float:
+    '''
+    Fastest of repeat runs, the least disturbed by everything else on the machine
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def result(name: str, seconds: float, **extra) -> dict:
+    return dict(name=name, seconds=round(seconds, 6), **extra)
+
+
+def bench_keys(counts: List[int], repeat: int) -> List[dict]:
+    results = []
+    os.makedirs(os.path.dirname(AUTHORIZED_KEYS_PATH), exist_ok=True)
+    for count in counts:
+        write_authorized_keys(AUTHORIZED_KEYS_PATH, count)
+        size = os.path.getsize(AUTHORIZED_KEYS_PATH)
+        present = synthetic_key(count // 2)
+
+        def cold_lookup() -> None:
+            # as in a fresh process without a persisted index: authorized_keys is read and parsed
+            utilities._key_stores.clear()
+            if os.path.exists(AUTHORIZED_KEYS_PATH + '.lansync-index'):
+                os.remove(AUTHORIZED_KEYS_PATH + '.lansync-index')
+            assert is_key_imported(present)
+
+        seconds = best(cold_lookup, repeat)
+        results.append(result(f'is_key_imported cold {count}', seconds, keys=count, size=size))
+        # later lookups in the same process hit the store kept in memory
+        seconds = best(lambda: is_key_imported(present), repeat)
+        results.append(result(f'is_key_imported warm {count}', seconds, keys=count, size=size))
+        new_keys = iter(synthetic_key(count + i) for i in range(repeat))
+        seconds = best(lambda: import_key(next(new_keys)), repeat)
+        results.append(result(f'import_key {count}', seconds, keys=count, size=size))
+        KeyStore(AUTHORIZED_KEYS_PATH, persist_index=True)
+        seconds = best(lambda: KeyStore(AUTHORIZED_KEYS_PATH, persist_index=True), repeat)
+        results.append(result(f'KeyStore persisted index {count}', seconds, keys=count, size=size))
+        os.remove(AUTHORIZED_KEYS_PATH)
+        os.remove(AUTHORIZED_KEYS_PATH + '.lansync-index')
+    return results
+
+
+class KeysHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in for https://github.com/<user>.keys: KEYS_PER_USER keys for /user<n>.keys after the configured latency
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        user = int(self.path.strip('/').split('.')[0][len('user'):])
+        body = ''.join(synthetic_key(user * KEYS_PER_USER + i) + '\n' for i in range(KEYS_PER_USER)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_fetch(user_counts: List[int], repeat: int, latency: float) -> List[dict]:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeysHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    results = []
+    try:
+        for users in user_counts:
+            arg = '\n'.join(f'{base}/user{i}.keys' for i in range(users))
+
+            def cold() -> None:
+                # nothing fetched or validated yet, as in a fresh process
+                fetch._default_fetcher = fetch.Fetcher(use_cache=False)
+                validation._default_cache = validation.ValidationCache()
+                assert len(get_pub_keys(arg)) == users * KEYS_PER_USER
+
+            seconds = best(cold, repeat)
+            results.append(result(f'get_pub_keys {users} urls', seconds, urls=users, keys=users * KEYS_PER_USER, latency=latency))
+    finally:
+        fetch.get_fetcher().close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def bench_share(sizes: List[str], repeat: int) -> List[dict]:
+    os.makedirs(PATH_TO_PUBLIC_DIR_FILE, exist_ok=True)
+    results = []
+    for size in sizes:
+        for thin in [False, True]:
+            name = 'bench-thin.img' if thin else 'bench.img'
+            path = os.path.join(PATH_TO_PUBLIC_DIR_FILE, name)
+            seconds = best(lambda: create_share(name, size, thin=thin), repeat)
+            results.append(result(f'create_share {size}{" thin" if thin else ""}', seconds, size=parse_size(size)))
+            seconds = best(lambda: get_first_partition_offset(path), repeat)
+            results.append(result(f'get_first_partition_offset {size}{" thin" if thin else ""}', seconds, size=parse_size(size)))
+            os.remove(path)
+    return results
+
+
+def make_payload(directory: str, size: int) -> int:
+    '''
+    Files of TRANSFER_FILE_SIZE spread over a few subdirectories, returns how many
+    '''
+    count = max(1, size // TRANSFER_FILE_SIZE)
+    for i in range(count):
+        path = os.path.join(directory, f'dir{i % TRANSFER_DIRS}', f'file{i}.bin')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for _ in range(0, TRANSFER_FILE_SIZE, 2**20):
+                f.write(os.urandom(min(2**20, TRANSFER_FILE_SIZE - f.tell())))
+    return count
+
+
+def loopback_transfer(paths: List[str]) -> int:
+    '''
+    Stream paths to a local receiver over TCP with sendfile, returns the number of bytes received
+    '''
+    received = [0]
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def receive() -> None:
+            conn, _ = listener.accept()
+            with conn:
+                buf = bytearray(2**20)
+                while True:
+                    n = conn.recv_into(buf)
+                    if n == 0:
+                        return
+                    received[0] += n
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        with socket.create_connection(listener.getsockname()) as sock:
+            for path in paths:
+                with open(path, 'rb') as f:
+                    sock.sendfile(f)
+        receiver.join()
+    return received[0]
+
+
+def write_local_rsync(path: str, share: str) -> None:
+    # stand-in for rsync and the peer: copies its file arguments into share
+    with open(path, 'w') as f:
+        f.write(LOCAL_RSYNC.format(python=sys.executable, share=share))
+    os.chmod(path, 0o755)
+
+
+def bench_transfer(size: int, repeat: int, jobs: int, peer: Optional[str]) -> List[dict]:
+    from lansync.send import plan_tree, send_tree
+    results = []
+    directory = os.path.join(HOME, 'transfer')
+    share = os.path.join(HOME, 'transfer-share')
+    rsync = os.path.join(HOME, 'rsync')
+    os.makedirs(share)
+    files = make_payload(directory, size)
+    size = files * TRANSFER_FILE_SIZE
+    write_local_rsync(rsync, share)
+
+    def rate(seconds: float) -> float:
+        return round(size / 2**20 / seconds, 1)
+
+    seconds = best(lambda: plan_tree(directory), repeat)
+    results.append(result(f'send plan_tree {files} files', seconds, files=files))
+
+    def local_send() -> None:
+        report = send_tree(directory, 'bench@127.0.0.1', jobs=jobs, rsync=rsync)
+        assert report.ok, report.errors
+
+    # planning, sharding and the rsync processes, the data is copied on the local disk
+    seconds = best(local_send, repeat)
+    results.append(result(f'send_tree {jobs} jobs local rsync stand-in', seconds, files=files, size=size, mb_per_s=rate(seconds)))
+    # upper bound of the network path alone: the kernel copying the files into a loopback socket
+    paths = [entry.path for entry in plan_tree(directory)]
+    seconds = best(lambda: loopback_transfer(paths), repeat)
+    results.append(result('kernel sendfile loopback', seconds, size=size, mb_per_s=rate(seconds)))
+    if peer is not None:
+        seconds = best(lambda: send_tree(directory, peer, jobs=jobs), repeat)
+        results.append(result(f'lansync send {peer}', seconds, size=size, mb_per_s=rate(seconds)))
+    shutil.rmtree(directory)
+    shutil.rmtree(share)
+    return results
+
+
+def save_baseline(path: str, results: List[dict]) -> None:
+    with open(path, 'w') as f:
+        json.dump({'machine': platform.platform(), 'python': platform.python_version(), 'results': results}, f, indent=2)
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> List[dict]:
+    '''
+    Benchmarks slower than in the baseline by more than threshold (0.25 is 25%)
+    '''
+    before = {entry['name']: entry['seconds'] for entry in baseline if 'seconds' in entry}
+    regressions = []
+    for entry in results:
+        old = before.get(entry['name'])
+        if old is not None and entry['seconds'] > old * (1 + threshold) and entry['seconds'] - old > MIN_SLOWDOWN:
+            regressions.append(dict(name=entry['name'], baseline=old, seconds=entry['seconds'], slower=round(entry['seconds'] / old - 1, 3)))
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='Skip the biggest inputs')
+    parser.add_argument('--only', default='keys,fetch,share,transfer', help='Comma separated benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every benchmark, the fastest counts')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the key server stand-in waits before answering')
+    parser.add_argument('--transfer-size', default=None, help=f'Size of the sent tree. Default is {TRANSFER_SIZE}, {QUICK_TRANSFER_SIZE} with --quick')
+    parser.add_argument('--jobs', type=int, default=SEND_JOBS, help=f'Concurrent rsync processes of send_tree. Default is {SEND_JOBS}')
+    parser.add_argument('--peer', help='Also time lansync send of the transfer payload to this user@host')
+    parser.add_argument('--save', help='Store the results as a baseline in this file')
+    parser.add_argument('--compare', help='Baseline file to compare the results with')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help=f'Allowed slowdown against the baseline. Default is {THRESHOLD}')
+    args = parser.parse_args()
+    only = set(args.only.split(','))
+    transfer_size = parse_size(args.transfer_size or (QUICK_TRANSFER_SIZE if args.quick else TRANSFER_SIZE))
+
+    results = []  # type: List[dict]
+    try:
+        benchmarks = [
+            ('keys', lambda: bench_keys(QUICK_KEY_COUNTS if args.quick else KEY_COUNTS, args.repeat)),
+            ('fetch', lambda: bench_fetch(USER_COUNTS, args.repeat, args.latency)),
+            ('share', lambda: bench_share(QUICK_SHARE_SIZES if args.quick else SHARE_SIZES, args.repeat)),
+            ('transfer', lambda: bench_transfer(transfer_size, args.repeat, args.jobs, args.peer)),
+        ]  # type: List
+        for name, run in benchmarks:
+            if name not in only:
+                continue
+            for entry in run():
+                print(json.dumps(entry), flush=True)
+                results.append(entry)
+    finally:
+        shutil.rmtree(HOME, ignore_errors=True)
+
+    if args.save is not None:
+        save_baseline(args.save, results)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)  # type: Dict
+        regressions = compare(results, baseline['results'], args.threshold)
+        for regression in regressions:
+            print(json.dumps(dict(regression=True, **regression)))
+        if len(regressions) > 0:
+            print(f'{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}', file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
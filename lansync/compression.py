@@ -0,0 +1,262 @@
+'''
+Per-file compression policy of lansync send --compress.
+
+rsync compresses a whole session with a single codec and the receiver's
+forced command has to agree with the sender on it, so the codec is chosen
+per peer when its key is imported (lansync --import <key> --compress zlib).
+What can differ from file to file is the level. Every file is sampled (magic
+bytes and the byte entropy of a few blocks) into a class, the codec is timed
+on the samples of every class and each class is sent by its own rsync runs
+at the level that gets the most data across the link, or with compression
+skipped when no level is faster than sending it as it is.
+'''
+import math
+import os
+import time
+import zlib
+from collections import Counter, namedtuple
+from typing import Callable, Dict, List, Optional, Tuple
+from lansync import metrics
+from lansync.send import FileEntry
+from lansync.settings import COMPRESS_MIN_GAIN, COMPRESSION_CODECS, LINK_SPEED, SECURE_OPTIONS, SEND_JOBS, SERVER_FLAGS
+
+
+CODECS = COMPRESSION_CODECS
+# levels tried per codec, fastest first. rsync ignores the level of lz4
+LEVELS = {'zlib': [1, 3, 6, 9], 'zstd': [1, 3, 9, 19], 'lz4': [0]}
+
+CLASS_COMPRESSED = 'compressed'
+CLASS_BINARY = 'binary'
+CLASS_TEXT = 'text'
+# bits per byte: compressed and encrypted data is close to 8, text well below 6
+COMPRESSED_ENTROPY = 7.5
+TEXT_ENTROPY = 6.0
+
+SAMPLE_SIZE = 64 * 1024
+# at most this much of every class is compressed to time the codec
+CLASS_SAMPLE_BYTES = 2 * 2**20
+
+# (offset, signature) of formats that are compressed already
+MAGIC = [
+    (0, b'\x1f\x8b'),  # gzip
+    (0, b'PK\x03\x04'),  # zip, jar, docx, apk
+    (0, b'\xfd7zXZ\x00'),  # xz
+    (0, b'BZh'),  # bzip2
+    (0, b'\x28\xb5\x2f\xfd'),  # zstd
+    (0, b'\x04\x22\x4d\x18'),  # lz4
+    (0, b'7z\xbc\xaf\x27\x1c'),  # 7z
+    (0, b'Rar!\x1a\x07'),  # rar
+    (0, b'\x89PNG\r\n\x1a\n'),
+    (0, b'\xff\xd8\xff'),  # jpeg
+    (0, b'GIF8'),
+    (8, b'WEBP'),
+    (4, b'ftyp'),  # mp4, mov, heic
+    (0, b'\x1a\x45\xdf\xa3'),  # mkv, webm
+    (0, b'ID3'),  # mp3
+    (0, b'OggS'),
+    (0, b'fLaC'),
+]
+
+Measurement = namedtuple('Measurement', ['ratio', 'compress_speed', 'decompress_speed'])
+# level is None when the class is sent without compressing it
+Choice = namedtuple('Choice', ['codec', 'level', 'ratio', 'throughput'])
+Group = namedtuple('Group', ['kind', 'files', 'choice', 'options'])
+
+
+class CompressionError(Exception):
+    pass
+
+
+def entropy(data: bytes) -> float:
+    '''
+    Shannon entropy of the bytes in data, in bits per byte
+    '''
+    if len(data) == 0:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def sample(path: str, size: int) -> List[bytes]:
+    '''
+    Blocks from the start, middle and end of a file
+    '''
+    offsets = sorted({0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)})
+    blocks = []  # type: List[bytes]
+    with open(path, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            blocks.append(f.read(SAMPLE_SIZE))
+    return blocks
+
+
+def has_magic(head: bytes) -> bool:
+    return any(head[offset:offset + len(signature)] == signature for offset, signature in MAGIC)
+
+
+def classify(blocks: List[bytes]) -> str:
+    data = b''.join(blocks)
+    # nothing to gain on empty files either
+    if len(data) == 0 or has_magic(data):
+        return CLASS_COMPRESSED
+    bits = entropy(data)
+    if bits >= COMPRESSED_ENTROPY:
+        return CLASS_COMPRESSED
+    return CLASS_TEXT if bits < TEXT_ENTROPY else CLASS_BINARY
+
+
+def classify_files(files: List[FileEntry]) -> Dict[str, Tuple[List[FileEntry], bytearray]]:
+    '''
+    Files of every class together with up to CLASS_SAMPLE_BYTES of their samples.
+    Files that can't be read are put with the compressed ones, rsync reports them.
+    '''
+    classes = {}  # type: Dict[str, Tuple[List[FileEntry], bytearray]]
+    for entry in files:
+        try:
+            blocks = sample(entry.path, entry.size)
+        except OSError:
+            blocks = []
+        kind = classify(blocks)
+        metrics.counter('compress_classified', kind=kind)
+        members, data = classes.setdefault(kind, ([], bytearray()))
+        members.append(entry)
+        for block in blocks:
+            if len(data) >= CLASS_SAMPLE_BYTES:
+                break
+            data += block[:CLASS_SAMPLE_BYTES - len(data)]
+    return classes
+
+
+def codec_functions(codec: str) -> Tuple[Callable[[bytes, int], bytes], Callable[[bytes], bytes]]:
+    '''
+    compress(data, level) and decompress(data) of codec
+    '''
+    if codec == 'zlib':
+        def compress(data: bytes, level: int) -> bytes:
+            # raw deflate, as rsync sends it
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            return compressor.compress(data) + compressor.flush()
+        return compress, lambda data: zlib.decompress(data, -15)
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise CompressionError('Timing zstd needs the zstandard module, install it with: pip install lansync[compression]')
+        return (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data))
+    if codec == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise CompressionError('Timing lz4 needs the lz4 module, install it with: pip install lansync[compression]')
+        return lambda data, level: lz4.frame.compress(data), lz4.frame.decompress
+    raise CompressionError(f'Unknown codec {codec}, use one of {", ".join(CODECS)}')
+
+
+def measure(codec: str, level: int, data: bytes) -> Measurement:
+    '''
+    Compression ratio and single core speeds (bytes of input per second) of codec on data
+    '''
+    compress, decompress = codec_functions(codec)
+    with metrics.timer('compress_measure', codec=codec, level=level):
+        start = time.perf_counter()
+        compressed = compress(data, level)
+        middle = time.perf_counter()
+        decompress(compressed)
+        end = time.perf_counter()
+    # timer resolution on tiny samples
+    return Measurement(len(data) / max(1, len(compressed)), len(data) / max(middle - start, 1e-6), len(data) / max(end - middle, 1e-6))
+
+
+def choose(codec: str, data: bytes, link_speed: float, streams: int) -> Choice:
+    '''
+    Level of codec moving the most of data across the link. Every rsync stream
+    compresses on one core, so streams of them compress in parallel while
+    sharing the link; the receiver is assumed to be about as fast.
+    '''
+    plain = Choice(codec, None, 1.0, link_speed)
+    best = plain
+    if len(data) == 0:
+        return plain
+    for level in LEVELS[codec]:
+        m = measure(codec, level, data)
+        throughput = min(streams * m.compress_speed, streams * m.decompress_speed, link_speed * m.ratio)
+        if throughput > best.throughput:
+            best = Choice(codec, level, m.ratio, throughput)
+    return best if best.throughput >= plain.throughput * COMPRESS_MIN_GAIN else plain
+
+
+def client_options(choice: Choice, files: List[FileEntry]) -> List[str]:
+    '''
+    rsync options sending files as choice says, to a peer whose forced command is server_flags(choice.codec)
+    '''
+    options = ['-z']
+    if choice.codec != 'zlib':
+        options.append(f'--compress-choice={choice.codec}')
+    if choice.level is not None:
+        return options + [f'--compress-level={choice.level}']
+    # compression can't be turned off for a single run against a -z server, but rsync
+    # stores files with these suffixes as they are. Files without one get the cheapest level
+    options.append(f'--compress-level={LEVELS[choice.codec][0]}')
+    suffixes = sorted({entry.name.rsplit('.', 1)[1].lower() for entry in files if '.' in entry.name.strip('.')})
+    if len(suffixes) > 0:
+        options.append('--skip-compress=' + '/'.join(suffixes))
+    return options
+
+
+def server_flags(codec: str) -> str:
+    '''
+    rsync --server flags matching the options of client_options
+    '''
+    if codec not in CODECS:
+        raise CompressionError(f'Unknown codec {codec}, use one of {", ".join(CODECS)}')
+    flags = '-z' + SERVER_FLAGS[1:]
+    # there is nothing to negotiate with, the codec has to be given on both ends
+    return flags if codec == 'zlib' else flags + f' --compress-choice={codec}'
+
+
+def secure_options(codec: Optional[str]) -> str:
+    '''
+    SECURE_OPTIONS of keys allowed to send compressed with codec
+    '''
+    if codec is None:
+        return SECURE_OPTIONS
+    return SECURE_OPTIONS.replace(' ' + SERVER_FLAGS + ' ', ' ' + server_flags(codec) + ' ', 1)
+
+
+def link_speed(interface: Optional[str] = None, sys_net='/sys/class/net') -> Optional[float]:
+    '''
+    Bytes per second the interface (by default the one of the default route) negotiated, if it reports it
+    '''
+    if interface is None:
+        from lansync.netif import default_route_interface
+        interface = default_route_interface()
+        if interface is None:
+            return None
+    try:
+        with open(os.path.join(sys_net, interface, 'speed'), 'r') as f:
+            mbits = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    # wifi and virtual interfaces report -1 or nothing at all
+    return mbits * 10**6 / 8 if mbits > 0 else None
+
+
+def plan(files: List[FileEntry], codec: str, speed: Optional[float] = None, jobs=SEND_JOBS) -> List[Group]:
+    '''
+    Split files into classes and decide how every class is sent. speed is the
+    link speed in bytes per second, measured when not given.
+    '''
+    if codec not in CODECS:
+        raise CompressionError(f'Unknown codec {codec}, use one of {", ".join(CODECS)}')
+    if speed is None:
+        speed = link_speed() or LINK_SPEED
+    streams = max(1, min(jobs, os.cpu_count() or 1))
+    groups = []  # type: List[Group]
+    for kind, (members, data) in sorted(classify_files(files).items()):
+        if kind == CLASS_COMPRESSED:
+            choice = Choice(codec, None, 1.0, speed)
+        else:
+            choice = choose(codec, bytes(data), speed, streams)
+        groups.append(Group(kind, members, choice, client_options(choice, members)))
+    return groups
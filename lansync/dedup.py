@@ -0,0 +1,332 @@
+'''
+Content-defined chunk deduplication of the receive share.
+
+Files are cut into chunks with a FastCDC-like gear hash, so an insertion
+only changes the chunks around it. Every chunk is kept once in the store
+under ~/.lansync/dedup and counted in an index.
+
+A new chunk is cloned out of the file it was found in and chunks already
+in the store are deduplicated back into the file with FIDEDUPERANGE, so
+files in the share share their extents with the store and stay separate
+files. That needs reflinks (btrfs, xfs) with the share and the store on the
+same filesystem; without them lansync dedup refuses to run. Cut points are
+aligned to ALIGN bytes, as extents can only be shared a filesystem block at
+a time.
+
+Only files whose size, mtime or inode changed since the last run are chunked
+again, and the chunks they no longer reference are collected right away, so
+an update costs time proportional to what changed.
+'''
+import fcntl
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import random
+import shutil
+import struct
+from collections import namedtuple
+from typing import Dict, Iterator, List, Optional, Tuple
+from lansync.metrics import WARNING, log
+from lansync.settings import DEDUP_DIR, PATH_TO_PUBLIC_DIR
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+
+ALIGN = 4096
+MIN_CHUNK = 16 * 1024
+AVG_CHUNK = 64 * 1024
+MAX_CHUNK = 256 * 1024
+# normalized chunking: harder to cut before the average size, easier after it
+MASK_SMALL = ((1 << 18) - 1) << 14
+MASK_LARGE = ((1 << 14) - 1) << 18
+WINDOW = 8 * 2**20
+
+FICLONERANGE = 0x4020940d
+FIDEDUPERANGE = 0xc0189436
+FILE_DEDUPE_RANGE_SAME = 0
+
+Chunk = namedtuple('Chunk', ['offset', 'length', 'digest'])
+DedupStats = namedtuple('DedupStats', ['files', 'logical', 'stored', 'changed', 'collected'])
+
+
+class DedupError(Exception):
+    pass
+
+
+def require_numpy() -> None:
+    if np is None:
+        raise DedupError('Deduplication needs numpy, install it with: pip install lansync[dedup]')
+
+
+def gear_table() -> 'np.ndarray':
+    rng = random.Random(0x6c616e73796e63)
+    return np.array([rng.getrandbits(32) for _ in range(256)], dtype=np.uint32)
+
+
+GEAR = gear_table() if np is not None else None
+
+
+def gear_hashes(data: 'np.ndarray') -> 'np.ndarray':
+    '''
+    Gear hash ending at every byte: h(i) = sum of GEAR[data[i - k]] << k for k < 32,
+    built by doubling the number of bytes summed: h2k(i) = hk(i) + (hk(i - k) << k)
+    '''
+    h = GEAR[data]
+    k = 1
+    while k < 32:
+        h[k:] += h[:-k] << np.uint32(k)
+        k *= 2
+    return h
+
+
+def cut_points(hashes: 'np.ndarray', mask: int) -> 'np.ndarray':
+    # a hit at byte i cuts after it, rounded up to the next aligned offset
+    hits = np.flatnonzero((hashes & np.uint32(mask)) == 0) + 1
+    return np.unique((hits + ALIGN - 1) // ALIGN * ALIGN)
+
+
+def chunk_boundaries(data: 'np.ndarray') -> Iterator[int]:
+    '''
+    End offsets of the chunks of data
+    '''
+    start = 0
+    while start < len(data):
+        # the hash only depends on the last 32 bytes, so restarting it at a chunk start changes nothing
+        end = min(start + WINDOW, len(data))
+        window = data[start:end]
+        hashes = gear_hashes(window)
+        small, large = cut_points(hashes, MASK_SMALL), cut_points(hashes, MASK_LARGE)
+        offset = 0
+        while start + offset < len(data):
+            if end < len(data) and offset + MAX_CHUNK > len(window):
+                break  # the next chunk may end past the window
+            cut = first_between(small, offset + MIN_CHUNK, offset + AVG_CHUNK)
+            if cut is None:
+                cut = first_between(large, offset + AVG_CHUNK, offset + MAX_CHUNK)
+            if cut is None:
+                cut = offset + MAX_CHUNK
+            offset = min(cut, len(window))
+            yield start + offset
+        start += offset
+
+
+def first_between(points: 'np.ndarray', low: int, high: int) -> Optional[int]:
+    i = np.searchsorted(points, low)
+    if i < len(points) and points[i] < high:
+        return int(points[i])
+    return None
+
+
+def chunk_digest(data) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def chunk_file(path: str) -> List[Chunk]:
+    require_numpy()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            data = np.frombuffer(m, dtype=np.uint8)
+            chunks = []  # type: List[Chunk]
+            offset = 0
+            for end in chunk_boundaries(data):
+                chunks.append(Chunk(offset, end - offset, chunk_digest(data[offset:end])))
+                offset = end
+            del data
+            return chunks
+
+
+def content_digest(chunks: List[Chunk]) -> str:
+    return chunk_digest(''.join(chunk.digest for chunk in chunks).encode())
+
+
+def clone_range(src_fd: int, src_offset: int, length: int, dest_fd: int, dest_offset: int) -> None:
+    fcntl.ioctl(dest_fd, FICLONERANGE, struct.pack('qQQQ', src_fd, src_offset, length, dest_offset))
+
+
+def dedupe_range(src_fd: int, length: int, dest_fd: int, dest_offset: int) -> bool:
+    '''
+    Share the first length bytes of src with dest at dest_offset. The kernel
+    compares the two first, so a file changing under our feet is left alone.
+    '''
+    request = bytearray(struct.pack('QQHHI', 0, length, 1, 0, 0) + struct.pack('qQQiI', dest_fd, dest_offset, 0, 0, 0))
+    fcntl.ioctl(src_fd, FIDEDUPERANGE, request)
+    _, bytes_deduped, status, _ = struct.unpack_from('QQiI', request, 32)
+    return status == FILE_DEDUPE_RANGE_SAME and bytes_deduped == length
+
+
+def supports_reflink(src_dir: str, dest_dir: str) -> bool:
+    '''
+    Whether extents of files in src_dir can be cloned into files in dest_dir,
+    which needs a filesystem with reflinks and both directories on it
+    '''
+    os.makedirs(dest_dir, exist_ok=True)
+    src_path = os.path.join(src_dir, '.lansync-reflink-test')
+    dest_path = os.path.join(dest_dir, '.lansync-reflink-test')
+    try:
+        with open(src_path, 'w+b') as src, open(dest_path, 'wb') as dest:
+            src.write(b'\0' * ALIGN)
+            src.flush()
+            clone_range(src.fileno(), 0, ALIGN, dest.fileno(), 0)
+        return True
+    except OSError:
+        return False
+    finally:
+        for path in [src_path, dest_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class DedupStore(object):
+    '''
+    Chunks of the files in root, kept in store_dir. Both have to be on one
+    filesystem with reflinks: files only ever share extents with the store,
+    so writing into one of them (e.g. lansync sync) copies on write and
+    never changes another.
+    '''
+    def __init__(self, root=PATH_TO_PUBLIC_DIR, store_dir=DEDUP_DIR):
+        self.root = os.path.abspath(root)
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, 'objects')
+        self.index_path = os.path.join(store_dir, 'index.json.gz')
+        # rel path -> [size, mtime_ns, inode, content digest, [[chunk digest, length], ...]]
+        self.files = {}  # type: Dict[str, list]
+        # chunk digest -> [references, length]
+        self.chunks = {}  # type: Dict[str, List[int]]
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def load(self) -> None:
+        if not supports_reflink(self.root, self.store_dir):
+            raise DedupError(f'{self.root} and {self.store_dir} have to be on one filesystem with reflinks (btrfs, xfs). '
+                             'The FAT share image doesn\'t support them')
+        try:
+            with gzip.open(self.index_path, 'rt') as f:
+                index = json.load(f)
+            if index['root'] != self.root:
+                raise ValueError('index of another share')
+            self.files = index['files']
+        except (OSError, ValueError, KeyError, EOFError):
+            self.files = {}
+        self.chunks = {}
+        for entry in self.files.values():
+            self._reference(entry)
+
+    def save(self) -> None:
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with gzip.open(tmp_path, 'wt') as f:
+            json.dump({'root': self.root, 'files': self.files}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+    def _reference(self, entry: list) -> None:
+        for digest, length in entry[4]:
+            self.chunks.setdefault(digest, [0, length])[0] += 1
+
+    def _release(self, entry: list) -> int:
+        '''
+        Drop the references of a file entry, deleting chunks nobody references anymore. Returns the bytes collected.
+        '''
+        collected = 0
+        for digest, length in entry[4]:
+            refs = self.chunks[digest]
+            refs[0] -= 1
+            if refs[0] == 0:
+                del self.chunks[digest]
+                collected += length
+                if os.path.exists(self.object_path(digest)):
+                    os.remove(self.object_path(digest))
+        return collected
+
+    def _walk(self) -> Iterator[Tuple[str, os.stat_result]]:
+        stack = ['']
+        while len(stack) > 0:
+            rel = stack.pop()
+            with os.scandir(os.path.join(self.root, rel)) as entries:
+                for entry in entries:
+                    child = os.path.join(rel, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(child)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield child, entry.stat(follow_symlinks=False)
+
+    def _own_inode(self, path: str) -> None:
+        '''
+        Give a hardlinked file an inode of its own, sharing its extents with the old one
+        '''
+        tmp_path = path + '.lansync-unlink'
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dest:
+            # a length of 0 clones up to the end of the file
+            clone_range(src.fileno(), 0, 0, dest.fileno(), 0)
+        shutil.copystat(path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _share_chunks(self, path: str, chunks: List[Chunk]) -> None:
+        stored = set()  # chunks repeating inside this file
+        with open(path, 'r+b') as f:
+            for chunk in chunks:
+                object_path = self.object_path(chunk.digest)
+                if (chunk.digest in self.chunks or chunk.digest in stored) and os.path.exists(object_path):
+                    with open(object_path, 'rb') as obj:
+                        dedupe_range(obj.fileno(), chunk.length, f.fileno(), chunk.offset)
+                else:
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    with open(object_path + '.tmp', 'wb') as obj:
+                        clone_range(f.fileno(), chunk.offset, chunk.length, obj.fileno(), 0)
+                    os.replace(object_path + '.tmp', object_path)
+                    stored.add(chunk.digest)
+
+    def _add(self, rel: str) -> int:
+        '''
+        Chunk a new or changed file and share its chunks with the store. The
+        new chunks are referenced before the old version of the file is
+        released, so chunks it still has are neither deleted nor cloned again.
+        Returns the bytes collected.
+        '''
+        path = os.path.join(self.root, rel)
+        if os.lstat(path).st_nlink > 1:
+            self._own_inode(path)
+        chunks = chunk_file(path)
+        self._share_chunks(path, chunks)
+        st = os.lstat(path)
+        entry = [st.st_size, st.st_mtime_ns, st.st_ino, content_digest(chunks), [[chunk.digest, chunk.length] for chunk in chunks]]
+        self._reference(entry)
+        old = self.files.get(rel)
+        self.files[rel] = entry
+        return self._release(old) if old is not None else 0
+
+    def update(self) -> DedupStats:
+        '''
+        Bring the store up to date with the share
+        '''
+        changed = 0
+        collected = 0
+        seen = set()
+        for rel, st in list(self._walk()):
+            seen.add(rel)
+            entry = self.files.get(rel)
+            if entry is not None and entry[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+                continue
+            try:
+                collected += self._add(rel)
+            except OSError as err:
+                log(f'Couldn\'t deduplicate {rel}: {err}', WARNING, path=os.path.join(self.root, rel))
+                continue
+            changed += 1
+        for rel in [rel for rel in self.files if rel not in seen]:
+            collected += self._release(self.files.pop(rel))
+            changed += 1
+        return DedupStats(len(self.files), self.logical_size(), self.stored_size(), changed, collected)
+
+    def logical_size(self) -> int:
+        return sum(entry[0] for entry in self.files.values())
+
+    def stored_size(self) -> int:
+        return sum(length for _, length in self.chunks.values())
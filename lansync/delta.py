@@ -0,0 +1,304 @@
+'''
+Built-in delta engine implementing the rsync algorithm.
+
+The destination is described by a signature: a weak rolling checksum and a
+strong hash of every block. The source is scanned with the weak checksum at
+every offset - computed for a whole buffer at once with NumPy prefix sums -
+candidate offsets are looked up in a hash index of the signature and
+confirmed with the strong hash. The result is a list of operations copying
+blocks the destination already has and literal ranges of the source.
+
+Signatures of destination files are cached, so updating a big file again
+only reads the source. Needs numpy (pip install lansync[delta]).
+'''
+import hashlib
+import mmap
+import os
+from collections import namedtuple
+from typing import Dict, List, Optional
+from lansync.metrics import WARNING, log
+from lansync.settings import DELTA_WINDOW, SIGNATURE_CACHE_DIR
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+
+MIN_BLOCK_SIZE = 700
+MAX_BLOCK_SIZE = 128 * 1024
+STRONG_SIZE = 16
+TAG_MASK = (1 << 24) - 1
+
+Signature = namedtuple('Signature', ['block_size', 'size', 'weak', 'strong'])
+# copy count blocks of the destination starting at block
+Copy = namedtuple('Copy', ['block', 'count'])
+# length bytes of the source at offset
+Literal = namedtuple('Literal', ['offset', 'length'])
+SyncResult = namedtuple('SyncResult', ['size', 'matched', 'literal', 'written'])
+
+
+class DeltaError(Exception):
+    pass
+
+
+def require_numpy() -> None:
+    if np is None:
+        raise DeltaError('The delta engine needs numpy, install it with: pip install lansync[delta]')
+
+
+def block_size_for(size: int) -> int:
+    # same heuristic as rsync: about the square root of the file size
+    block_size = int(size ** 0.5) // 8 * 8
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def block_checksums(data: 'np.ndarray', block_size: int) -> 'np.ndarray':
+    '''
+    Weak checksum of every block_size aligned block, the last one may be shorter
+    '''
+    weak = []
+    full = len(data) // block_size * block_size
+    if full > 0:
+        blocks = data[:full].reshape(-1, block_size).astype(np.int64)
+        a = blocks.sum(axis=1)
+        b = blocks @ np.arange(block_size, 0, -1, dtype=np.int64)
+        weak.append((a & 0xffff) | ((b & 0xffff) << 16))
+    if full < len(data):
+        tail = data[full:].astype(np.int64)
+        a = tail.sum()
+        b = tail @ np.arange(len(tail), 0, -1, dtype=np.int64)
+        weak.append(np.array([(a & 0xffff) | ((b & 0xffff) << 16)]))
+    if len(weak) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    return np.concatenate(weak).astype(np.uint32)
+
+
+def rolling_checksums(data: 'np.ndarray', block_size: int) -> 'np.ndarray':
+    '''
+    Weak checksum of the block_size bytes starting at every offset of data,
+    without rolling byte by byte. With S the prefix sums of data and T the
+    prefix sums of S: a(k) = S[k+L] - S[k] and b(k) = T[k+L] - T[k] - L * S[k].
+    Only the low 16 bits of each are kept, so uint32 arithmetic may wrap around.
+    '''
+    if len(data) < block_size:
+        return np.zeros(0, dtype=np.uint32)
+    s = np.zeros(len(data) + 1, dtype=np.uint32)
+    np.cumsum(data, dtype=np.uint32, out=s[1:])
+    t = np.zeros(len(data) + 1, dtype=np.uint32)
+    np.cumsum(s[1:], dtype=np.uint32, out=t[1:])
+    a = s[block_size:] - s[:-block_size]
+    b = t[block_size:] - t[:-block_size] - np.uint32(block_size) * s[:-block_size]
+    return (a & 0xffff) | (b << 16)
+
+
+def map_file(f) -> 'np.ndarray':
+    if os.fstat(f.fileno()).st_size == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+
+
+def signature(path: str, block_size: Optional[int] = None) -> Signature:
+    require_numpy()
+    with open(path, 'rb') as f:
+        data = map_file(f)
+        block_size = block_size if block_size is not None else block_size_for(len(data))
+        strong = [strong_hash(data[offset:offset + block_size]) for offset in range(0, len(data), block_size)]
+        return Signature(block_size, len(data), block_checksums(data, block_size), strong)
+
+
+class SignatureCache(object):
+    '''
+    Signatures of destination files, valid as long as size and mtime don't change
+    '''
+    def __init__(self, path=SIGNATURE_CACHE_DIR):
+        self.path = path
+
+    def _entry(self, path: str, block_size: int) -> str:
+        key = hashlib.blake2b(f'{os.path.realpath(path)}:{block_size}'.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, path: str, block_size: int) -> Signature:
+        st = os.stat(path)
+        entry = self._entry(path, block_size)
+        try:
+            with np.load(entry) as cached:
+                if list(cached['meta']) == [st.st_size, st.st_mtime_ns, block_size]:
+                    return Signature(block_size, st.st_size, cached['weak'], [bytes(row) for row in cached['strong']])
+        except (OSError, ValueError, KeyError):
+            pass
+        sig = signature(path, block_size)
+        self.put(path, sig)
+        return sig
+
+    def put(self, path: str, sig: Signature) -> None:
+        st = os.stat(path)
+        entry = self._entry(path, sig.block_size)
+        strong = np.frombuffer(b''.join(sig.strong), dtype=np.uint8).reshape(-1, STRONG_SIZE)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(entry + '.tmp', 'wb') as f:
+                np.savez(f, meta=np.array([st.st_size, st.st_mtime_ns, sig.block_size], dtype=np.int64), weak=sig.weak, strong=strong)
+            os.replace(entry + '.tmp', entry)
+        except OSError as err:
+            log(f'Couldn\'t cache signature of {path}: {err}', WARNING, path=path)
+
+
+def build_index(sig: Signature) -> Dict[int, List[int]]:
+    '''
+    Full blocks by weak checksum. The short last block is matched separately.
+    '''
+    index = {}  # type: Dict[int, List[int]]
+    full_blocks = sig.size // sig.block_size
+    for block, weak in enumerate(sig.weak[:full_blocks].tolist()):
+        index.setdefault(weak, []).append(block)
+    return index
+
+
+def find_block(data: 'np.ndarray', pos: int, blocks: List[int], sig: Signature, inplace: bool) -> Optional[int]:
+    strong = None
+    # the block at the same offset first - in place it doesn't have to be written at all
+    for block in sorted(blocks, key=lambda block: block * sig.block_size != pos):
+        if inplace and block * sig.block_size < pos:
+            continue  # already overwritten by the time it would be read
+        if strong is None:
+            strong = strong_hash(data[pos:pos + sig.block_size])
+        if sig.strong[block] == strong:
+            return block
+    return None
+
+
+def delta(data: 'np.ndarray', sig: Signature, inplace=False, window=DELTA_WINDOW) -> List:
+    '''
+    Operations that turn the destination described by sig into data.
+    With inplace, blocks are only copied from offsets the output hasn't reached yet.
+    '''
+    require_numpy()
+    block_size = sig.block_size
+    index = build_index(sig)
+    weaks = np.array(sorted(index), dtype=np.uint32)
+    # two table lookups before the exact one: a small table that stays in the
+    # cpu cache for every offset, a bigger one for the offsets passing the first
+    small_table = np.zeros(1 << 16, dtype=bool)
+    small_table[weaks >> 16] = True
+    big_table = np.zeros(TAG_MASK + 1, dtype=bool)
+    big_table[weaks & TAG_MASK] = True
+    ops = OpList()
+    pos = 0
+    start = 0
+    while start + block_size <= len(data) and len(weaks) > 0:
+        end = min(start + window, len(data) - block_size + 1)
+        checksums = rolling_checksums(data[start:end + block_size - 1], block_size)
+        candidates = np.flatnonzero(small_table[checksums >> 16])
+        candidates = candidates[big_table[checksums[candidates] & TAG_MASK]]
+        found = np.minimum(np.searchsorted(weaks, checksums[candidates]), len(weaks) - 1)
+        candidates = start + candidates[weaks[found] == checksums[candidates]]
+        i = np.searchsorted(candidates, pos)
+        while i < len(candidates):
+            offset = int(candidates[i])
+            block = find_block(data, offset, index[int(checksums[offset - start])], sig, inplace)
+            if block is None:
+                i += 1
+                continue
+            ops.literal(pos, offset - pos)
+            ops.copy(block)
+            pos = offset + block_size
+            i = np.searchsorted(candidates, pos, side='left')
+        start = max(end, pos)
+    # the short last block can only match the end of the data
+    tail = sig.size % block_size
+    last = len(sig.strong) - 1
+    if tail > 0 and len(data) - pos >= tail and (not inplace or last * block_size >= len(data) - tail):
+        offset = len(data) - tail
+        if sig.strong[last] == strong_hash(data[offset:]):
+            ops.literal(pos, offset - pos)
+            ops.copy(last)
+            pos = len(data)
+    ops.literal(pos, len(data) - pos)
+    return ops.ops
+
+
+class OpList(object):
+    '''
+    Operations with neighbouring copies and literals merged
+    '''
+    def __init__(self):
+        self.ops = []  # type: List
+
+    def literal(self, offset: int, length: int) -> None:
+        if length <= 0:
+            return
+        if len(self.ops) > 0 and isinstance(self.ops[-1], Literal):
+            self.ops[-1] = Literal(self.ops[-1].offset, self.ops[-1].length + length)
+        else:
+            self.ops.append(Literal(offset, length))
+
+    def copy(self, block: int) -> None:
+        last = self.ops[-1] if len(self.ops) > 0 else None
+        if isinstance(last, Copy) and last.block + last.count == block:
+            self.ops[-1] = Copy(last.block, last.count + 1)
+        else:
+            self.ops.append(Copy(block, 1))
+
+
+def copy_forward(fd: int, src: int, dst: int, length: int, chunk=2**20) -> None:
+    # src >= dst, so reading ahead of every write never reads overwritten data
+    done = 0
+    while done < length:
+        data = os.pread(fd, min(chunk, length - done), src + done)
+        os.pwrite(fd, data, dst + done)
+        done += len(data)
+
+
+def patch_inplace(dest_path: str, data: 'np.ndarray', ops: List, block_size: int) -> int:
+    '''
+    Apply operations of an inplace delta to dest_path, writing only what changed.
+    Returns the number of bytes written.
+    '''
+    written = 0
+    out = 0
+    fd = os.open(dest_path, os.O_RDWR)
+    try:
+        dest_size = os.fstat(fd).st_size
+        for op in ops:
+            if isinstance(op, Copy):
+                src = op.block * block_size
+                length = min(op.count * block_size, dest_size - src)
+                if src != out:
+                    copy_forward(fd, src, out, length)
+                    written += length
+                out += length
+            else:
+                os.pwrite(fd, data[op.offset:op.offset + op.length], out)
+                written += op.length
+                out += op.length
+        os.ftruncate(fd, out)
+    finally:
+        os.close(fd)
+    return written
+
+
+def sync_file(src_path: str, dest_path: str, block_size: Optional[int] = None, cache: Optional[SignatureCache] = None) -> SyncResult:
+    '''
+    Update dest_path to the contents of src_path, rewriting only the blocks that differ
+    '''
+    require_numpy()
+    cache = cache if cache is not None else SignatureCache()
+    if os.path.isdir(dest_path):
+        dest_path = os.path.join(dest_path, os.path.basename(src_path))
+    if not os.path.exists(dest_path):
+        open(dest_path, 'wb').close()
+    with open(src_path, 'rb') as f:
+        data = map_file(f)
+        block_size = block_size if block_size is not None else block_size_for(max(len(data), os.path.getsize(dest_path)))
+        sig = cache.get(dest_path, block_size)
+        ops = delta(data, sig, inplace=True)
+        written = patch_inplace(dest_path, data, ops, block_size)
+        literal = sum(op.length for op in ops if isinstance(op, Literal))
+        # dest now has the same contents as src
+        cache.put(dest_path, sig if written == 0 and len(data) == sig.size else signature(src_path, block_size))
+        return SyncResult(len(data), len(data) - literal, literal, written)
@@ -0,0 +1,194 @@
+'''
+Zero-config discovery of other lansync users on the LAN.
+
+`lansync discover` announces this user with a small binary beacon on every
+local interface (broadcast where the interface supports it, multicast
+otherwise) and listens for the beacons of others. Everyone heard is kept in
+a peer cache for PEER_TTL seconds, which `lansync peers` prints right away.
+'''
+import json
+import os
+import select
+import socket
+import struct
+import time
+from collections import namedtuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from lansync.metrics import WARNING, log
+from lansync.netif import Interface, interfaces
+from lansync.settings import (CURRENT_USER, DISCOVERY_GROUP, DISCOVERY_INTERVAL, DISCOVERY_PORT, PATH_TO_PUBLIC_DIR,
+                              PEER_CACHE_PATH, PEER_TTL)
+
+
+MAGIC = b'LSYN'
+VERSION = 1
+# magic, version, instance id, share capacity, free space, user and host name lengths
+BEACON_HEADER = struct.Struct('!4sB8sQQBB')
+
+Beacon = namedtuple('Beacon', ['instance', 'user', 'host', 'capacity', 'free'])
+Peer = namedtuple('Peer', ['user', 'address', 'host', 'capacity', 'free', 'last_seen'])
+
+
+def encode_beacon(beacon: Beacon) -> bytes:
+    user = beacon.user.encode()[:255]
+    host = beacon.host.encode()[:255]
+    return BEACON_HEADER.pack(MAGIC, VERSION, beacon.instance, beacon.capacity, beacon.free, len(user), len(host)) + user + host
+
+
+def decode_beacon(data: bytes) -> Optional[Beacon]:
+    if len(data) < BEACON_HEADER.size:
+        return None
+    magic, version, instance, capacity, free, user_length, host_length = BEACON_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or len(data) != BEACON_HEADER.size + user_length + host_length:
+        return None
+    try:
+        user = data[BEACON_HEADER.size:BEACON_HEADER.size + user_length].decode()
+        host = data[BEACON_HEADER.size + user_length:].decode()
+    except UnicodeDecodeError:
+        return None
+    return Beacon(instance, user, host, capacity, free)
+
+
+def share_space(root=PATH_TO_PUBLIC_DIR) -> Tuple[int, int]:
+    '''
+    Capacity of the share and how much of it is free, 0 when unknown
+    '''
+    from lansync.usage import share_limit
+    capacity = share_limit(root) or 0
+    try:
+        st = os.statvfs(root)
+        free = st.f_bavail * st.f_frsize
+    except OSError:
+        return capacity, 0
+    return capacity, min(free, capacity) if capacity > 0 else free
+
+
+class PeerCache(object):
+    '''
+    Peers by (user, address), forgotten ttl seconds after their last beacon
+    '''
+    def __init__(self, path=PEER_CACHE_PATH, ttl=PEER_TTL, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}  # type: Dict[Tuple[str, str], Peer]
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                entries = [Peer(*entry) for entry in json.load(f)]
+        except (OSError, ValueError, TypeError):
+            entries = []
+        self.entries = {(peer.user, peer.address): peer for peer in entries}
+        self.expire()
+
+    def save(self) -> None:
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self.entries.values()), f)
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            log(f'Couldn\'t save peer cache: {err}', WARNING, path=self.path)
+
+    def update(self, beacon: Beacon, address: str) -> bool:
+        '''
+        Record a beacon, True when the peer is new or changed
+        '''
+        previous = self.entries.get((beacon.user, address))
+        peer = Peer(beacon.user, address, beacon.host, beacon.capacity, beacon.free, self.clock())
+        self.entries[(beacon.user, address)] = peer
+        return previous is None or previous[:-1] != peer[:-1]
+
+    def expire(self) -> None:
+        deadline = self.clock() - self.ttl
+        self.entries = {key: peer for key, peer in self.entries.items() if peer.last_seen >= deadline}
+
+    def peers(self) -> List[Peer]:
+        self.expire()
+        return sorted(self.entries.values(), key=lambda peer: (peer.user, peer.address))
+
+
+class DiscoveryDaemon(object):
+    def __init__(self, cache: PeerCache, port=DISCOVERY_PORT, group=DISCOVERY_GROUP, user=CURRENT_USER,
+                 bind_address='', on_peer: Callable[[Peer], None] = lambda peer: None):
+        self.cache = cache
+        self.group = group
+        self.on_peer = on_peer
+        self.instance = os.urandom(8)
+        self.user = user
+        self.host = socket.gethostname()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.bind((bind_address, port))
+        self.port = self.sock.getsockname()[1]
+        self._joined = set()  # type: Set[str]
+
+    def beacon(self) -> bytes:
+        capacity, free = share_space()
+        return encode_beacon(Beacon(self.instance, self.user, self.host, capacity, free))
+
+    def join(self, ifaces: List[Interface]) -> None:
+        # docking and undocking changes the interfaces, so this is redone every round
+        for iface in ifaces:
+            if iface.address in self._joined:
+                continue
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self.group) + socket.inet_aton(iface.address))
+                self._joined.add(iface.address)
+            except OSError:
+                continue
+
+    def announce(self, ifaces: List[Interface]) -> None:
+        data = self.beacon()
+        for iface in ifaces:
+            try:
+                if iface.broadcast is not None:
+                    self.sock.sendto(data, (iface.broadcast, self.port))
+                else:
+                    self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(iface.address))
+                    self.sock.sendto(data, (self.group, self.port))
+            except OSError:
+                continue  # interface went away in the meantime
+
+    def handle_datagram(self, data: bytes, address: str) -> None:
+        beacon = decode_beacon(data)
+        if beacon is None or beacon.instance == self.instance:
+            return
+        if self.cache.update(beacon, address):
+            self.on_peer(self.cache.entries[(beacon.user, address)])
+
+    def poll(self, timeout: float) -> None:
+        '''
+        Handle every beacon arriving in the next timeout seconds
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            readable, _, _ = select.select([self.sock], [], [], max(0, remaining))
+            if len(readable) > 0:
+                data, (address, _) = self.sock.recvfrom(1024)
+                self.handle_datagram(data, address)
+            elif remaining <= 0:
+                return
+
+    def run(self, interval=DISCOVERY_INTERVAL, should_stop: Callable[[], bool] = lambda: False) -> None:
+        while not should_stop():
+            ifaces = interfaces()
+            self.join(ifaces)
+            self.announce(ifaces)
+            self.poll(interval)
+            self.cache.expire()
+            self.cache.save()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
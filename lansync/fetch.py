@@ -0,0 +1,256 @@
+'''
+Concurrent HTTP(S) fetching of remote key lists.
+
+Every URL is requested once while its response is in memory (the last
+max_responses of them, or until a caller takes it), connections are kept
+alive and reused per host and responses are cached on disk and revalidated
+with ETag/Last-Modified once their TTL expires.
+'''
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urljoin, urlsplit
+from lansync import metrics
+from lansync.settings import FETCH_WINDOW, HTTP_CACHE_DIR, HTTP_CACHE_TTL, HTTP_MAX_WORKERS, HTTP_TIMEOUT
+
+
+Response = namedtuple('Response', ['url', 'status', 'body', 'error'])
+
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def normalize_url(url: str) -> str:
+    if '://' not in url:
+        url = 'https://' + url
+    return url
+
+
+class ResponseCache(object):
+    '''
+    One JSON file per URL holding the body and the validators needed to revalidate it
+    '''
+    def __init__(self, cache_dir=HTTP_CACHE_DIR, ttl=HTTP_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, url: str) -> Optional[dict]:
+        try:
+            with open(self._path(url), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, url: str, body: bytes, etag: Optional[str], last_modified: Optional[str]) -> None:
+        entry = {
+            'url': url,
+            'fetched_at': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': body.decode('utf-8', errors='replace'),
+        }
+        path = self._path(url)
+        tmp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            metrics.log(f'Couldn\'t write http cache: {err}', metrics.WARNING, url=url)
+
+
+class Fetcher(object):
+    '''
+    Fetches URLs over a bounded thread pool. Each worker thread keeps one
+    keep-alive connection per host, so a batch of N urls on the same host
+    opens at most max_workers connections.
+    '''
+    def __init__(self, cache_dir=HTTP_CACHE_DIR, ttl=HTTP_CACHE_TTL, max_workers=HTTP_MAX_WORKERS, timeout=HTTP_TIMEOUT, use_cache=True,
+                 max_responses=FETCH_WINDOW):
+        self.cache = ResponseCache(cache_dir, ttl) if use_cache else None
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []  # type: List[http.client.HTTPConnection]
+        self._lock = threading.Lock()
+        # most recent responses, oldest first - enough for a window of fetch_all
+        self._responses = {}  # type: Dict[str, Response]
+        self.max_responses = max_responses
+        self._pool = None  # type: Optional[ThreadPoolExecutor]
+
+    def fetch(self, url: str) -> Response:
+        url = normalize_url(url)
+        with self._lock:
+            if url in self._responses:
+                return self._responses[url]
+        host = urlsplit(url).netloc
+        with metrics.timer('fetch', host=host):
+            response = self._fetch_cached(url)
+        metrics.counter('fetch_requests', host=host, status=str(response.status))
+        if response.error is not None:
+            metrics.write(metrics.WARNING, 'fetch failed', url=url, error=response.error)
+        with self._lock:
+            self._responses[url] = response
+            while len(self._responses) > self.max_responses:
+                del self._responses[next(iter(self._responses))]
+        return response
+
+    def take(self, url: str) -> Response:
+        '''
+        fetch for callers using the body once: the response isn't kept in memory afterwards
+        '''
+        response = self.fetch(url)
+        with self._lock:
+            self._responses.pop(normalize_url(url), None)
+        return response
+
+    def fetch_all(self, urls: Iterable[str]) -> Dict[str, Response]:
+        '''
+        Fetch all urls concurrently. Duplicate urls are fetched once.
+        Result is keyed by the urls as passed in.
+        '''
+        unique = list(dict.fromkeys(urls))
+        if len(unique) <= 1:
+            return {url: self.fetch(url) for url in unique}
+        if self._pool is None:
+            # the pool outlives a single batch so its threads keep their connections
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return dict(zip(unique, self._pool.map(self.fetch, unique)))
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _fetch_cached(self, url: str) -> Response:
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None and self.cache.is_fresh(entry):
+            metrics.counter('fetch_cache', result='fresh')
+            return Response(url, 200, entry['body'].encode('utf-8'), None)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            status, body, resp_headers = self._request(url, headers)
+        except (OSError, http.client.HTTPException) as err:
+            if entry is not None:
+                # stale is better than nothing when offline
+                metrics.counter('fetch_cache', result='stale')
+                return Response(url, 200, entry['body'].encode('utf-8'), None)
+            return Response(url, None, b'', str(err))
+
+        etag, last_modified = resp_headers.get('etag'), resp_headers.get('last-modified')
+        if status == 304 and entry is not None:
+            metrics.counter('fetch_cache', result='revalidated')
+            body = entry['body'].encode('utf-8')
+            status = 200
+            # a 304 doesn't have to repeat the validators, keep the ones we have
+            etag = etag or entry.get('etag')
+            last_modified = last_modified or entry.get('last_modified')
+        if status == 200 and self.cache is not None:
+            self.cache.put(url, body, etag, last_modified)
+        return Response(url, status, body, None)
+
+    def _request(self, url: str, headers: Dict[str, str]):
+        for _ in range(MAX_REDIRECTS + 1):
+            status, body, resp_headers = self._request_once(url, headers)
+            if status not in REDIRECT_CODES or 'location' not in resp_headers:
+                return status, body, resp_headers
+            url = urljoin(url, resp_headers['location'])
+        raise http.client.HTTPException(f'Too many redirects: {url}')
+
+    def _request_once(self, url: str, headers: Dict[str, str]):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {'User-Agent': 'lansync', 'Connection': 'keep-alive'}
+        request_headers.update(headers)
+
+        # a reused connection may have been closed by the server in the meantime - retry once on a fresh one
+        for attempt in range(2):
+            conn, reused = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=request_headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._drop_connection(parts.scheme, parts.netloc)
+                if reused and attempt == 0:
+                    continue
+                raise
+            except (OSError, http.client.HTTPException):
+                self._drop_connection(parts.scheme, parts.netloc)
+                raise
+            if resp.will_close:
+                self._drop_connection(parts.scheme, parts.netloc)
+            return resp.status, body, {k.lower(): v for k, v in resp.getheaders()}
+
+    def _connection(self, scheme: str, netloc: str):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        key = (scheme, netloc)
+        if key in conns:
+            return conns[key], True
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+        conns[key] = conn
+        with self._lock:
+            self._connections.append(conn)
+        return conn, False
+
+    def _drop_connection(self, scheme: str, netloc: str) -> None:
+        conn = self._local.conns.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+
+
+_default_fetcher = None  # type: Optional[Fetcher]
+
+
+def get_fetcher() -> Fetcher:
+    '''
+    Process wide fetcher so that e.g. checking a Github username and then
+    downloading its keys hits the network only once
+    '''
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = Fetcher()
+    return _default_fetcher
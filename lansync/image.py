@@ -0,0 +1,392 @@
+'''
+In-process creation of the share image: an MBR with a single FAT32 partition.
+
+Only the metadata (partition table, boot sectors, FSInfo and the first FAT
+sector) is written. The rest of the image is left as a hole or as
+preallocated unwritten extents, both of which read back as zeros, so
+provisioning a multi-GB share takes milliseconds and needs no external tools.
+'''
+import json
+import os
+import struct
+from collections import namedtuple
+from typing import Iterator, Optional, Tuple
+from lansync import metrics
+from lansync.settings import SHARE_GROWTH_FACTOR
+
+
+SECTOR_SIZE = 512
+# first partition starts at 1MiB like fdisk/parted do, or at 4KiB in images
+# too small to give up a whole MiB
+PARTITION_ALIGNMENT = 2048
+SMALL_PARTITION_ALIGNMENT = 8
+SMALL_IMAGE_SIZE = 4 * PARTITION_ALIGNMENT * 512
+RESERVED_SECTORS = 32
+NUM_FATS = 2
+ROOT_CLUSTER = 2
+FSINFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+FAT32_LBA_PARTITION_TYPE = 0x0C
+MEDIA_DESCRIPTOR = 0xF8
+BOOT_SIGNATURE = b'\x55\xaa'
+VOLUME_LABEL = b'LANSYNC    '
+END_OF_CHAIN = 0x0FFFFFFF
+
+MBR_PARTITION_TABLE_OFFSET = 446
+MBR_PARTITION_ENTRY = struct.Struct('<B3sB3sII')
+BPB = struct.Struct('<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s')
+FSINFO_FREE_COUNT_OFFSET = 488
+# peak disk usage of the image is kept in a file next to it
+STATS_SUFFIX = '.stats'
+
+# linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+ImageUsage = namedtuple('ImageUsage', ['logical', 'physical', 'peak'])
+Geometry = namedtuple('Geometry', ['total_sectors', 'partition_start', 'partition_sectors', 'sectors_per_cluster', 'fat_sectors', 'cluster_count'])
+
+
+def sectors_per_cluster(partition_bytes: int) -> int:
+    # Microsoft's recommended FAT32 cluster sizes
+    if partition_bytes <= 260 * 2**20:
+        return 1
+    if partition_bytes <= 8 * 2**30:
+        return 8
+    if partition_bytes <= 16 * 2**30:
+        return 16
+    if partition_bytes <= 32 * 2**30:
+        return 32
+    return 64
+
+
+def fat_sectors_for(data_sectors: int, spc: int) -> int:
+    '''
+    Smallest FAT that can address every cluster that fits next to it
+    '''
+    fat_sectors = 1
+    while True:
+        clusters = (data_sectors - NUM_FATS * fat_sectors) // spc
+        needed = -(-(clusters + 2) * 4 // SECTOR_SIZE)
+        if needed <= fat_sectors:
+            return fat_sectors
+        fat_sectors = needed
+
+
+def partition_sectors_for(size: int, partition_start=PARTITION_ALIGNMENT) -> int:
+    # FAT32 addresses at most 2^32 - 1 sectors per partition
+    return min(size // SECTOR_SIZE - partition_start, 2**32 - 1)
+
+
+def get_geometry(size: int, max_size: Optional[int] = None) -> Geometry:
+    '''
+    Layout of a size byte image. The FAT is made big enough to address
+    max_size bytes so the filesystem can later be grown in place.
+    '''
+    max_size = size if max_size is None else max(size, max_size)
+    partition_start = PARTITION_ALIGNMENT if size >= SMALL_IMAGE_SIZE else SMALL_PARTITION_ALIGNMENT
+    partition_sectors = partition_sectors_for(size, partition_start)
+    if partition_sectors < RESERVED_SECTORS + 64:
+        raise ValueError(f'Share size too small: {size}')
+    max_partition_sectors = partition_sectors_for(max_size, partition_start)
+    spc = sectors_per_cluster(max_partition_sectors * SECTOR_SIZE)
+    fat_sectors = fat_sectors_for(max_partition_sectors - RESERVED_SECTORS, spc)
+    cluster_count = (partition_sectors - data_start_sector(fat_sectors)) // spc
+    if cluster_count < 1:
+        raise ValueError(f'Share size too small: {size}')
+    return Geometry(size // SECTOR_SIZE, partition_start, partition_sectors, spc, fat_sectors, cluster_count)
+
+
+def data_start_sector(fat_sectors: int) -> int:
+    # relative to the start of the partition
+    return RESERVED_SECTORS + NUM_FATS * fat_sectors
+
+
+def fat_capacity(geometry: Geometry) -> int:
+    # number of data clusters the FAT can address
+    return geometry.fat_sectors * SECTOR_SIZE // 4 - 2
+
+
+def build_mbr(geometry: Geometry, disk_id: int) -> bytes:
+    mbr = bytearray(SECTOR_SIZE)
+    struct.pack_into('<I', mbr, 440, disk_id)
+    # CHS fields are maxed out - everything uses the LBA values
+    entry = MBR_PARTITION_ENTRY.pack(0x00, b'\xfe\xff\xff', FAT32_LBA_PARTITION_TYPE, b'\xfe\xff\xff', geometry.partition_start, geometry.partition_sectors)
+    mbr[MBR_PARTITION_TABLE_OFFSET:MBR_PARTITION_TABLE_OFFSET + len(entry)] = entry
+    mbr[510:512] = BOOT_SIGNATURE
+    return bytes(mbr)
+
+
+def build_boot_sector(geometry: Geometry, volume_id: int) -> bytes:
+    sector = bytearray(SECTOR_SIZE)
+    bpb = BPB.pack(
+        b'\xeb\x58\x90', b'lansync ', SECTOR_SIZE, geometry.sectors_per_cluster, RESERVED_SECTORS, NUM_FATS,
+        0,  # root entries - FAT32 keeps the root directory in a cluster chain
+        0,  # 16 bit total sectors
+        MEDIA_DESCRIPTOR,
+        0,  # 16 bit FAT size - 0 marks the volume as FAT32
+        32, 64,  # sectors per track and heads, unused with LBA
+        geometry.partition_start, geometry.partition_sectors, geometry.fat_sectors,
+        0, 0,  # ext flags - FATs are mirrored, version 0.0
+        ROOT_CLUSTER, FSINFO_SECTOR, BACKUP_BOOT_SECTOR, bytes(12),
+        0x80, 0, 0x29, volume_id, VOLUME_LABEL, b'FAT32   ')
+    sector[:len(bpb)] = bpb
+    sector[510:512] = BOOT_SIGNATURE
+    return bytes(sector)
+
+
+def build_fsinfo(free_clusters: int, next_free: int) -> bytes:
+    sector = bytearray(SECTOR_SIZE)
+    struct.pack_into('<I', sector, 0, 0x41615252)
+    struct.pack_into('<III', sector, 484, 0x61417272, free_clusters, next_free)
+    struct.pack_into('<I', sector, 508, 0xAA550000)
+    return bytes(sector)
+
+
+def build_fat_head() -> bytes:
+    # media descriptor, reserved entry and the end of the root directory chain
+    return struct.pack('<III', 0x0FFFFF00 | MEDIA_DESCRIPTOR, END_OF_CHAIN, END_OF_CHAIN)
+
+
+def write_filesystem(fd: int, geometry: Geometry, volume_id: int) -> None:
+    '''
+    Write the FAT32 metadata of a freshly zeroed partition
+    '''
+    base = geometry.partition_start * SECTOR_SIZE
+    boot = build_boot_sector(geometry, volume_id)
+    fsinfo = build_fsinfo(geometry.cluster_count - 1, ROOT_CLUSTER + 1)
+    for start in (0, BACKUP_BOOT_SECTOR):
+        os.pwrite(fd, boot, base + start * SECTOR_SIZE)
+        os.pwrite(fd, fsinfo, base + (start + FSINFO_SECTOR) * SECTOR_SIZE)
+    fat_head = build_fat_head()
+    for fat in range(NUM_FATS):
+        os.pwrite(fd, fat_head, base + (RESERVED_SECTORS + fat * geometry.fat_sectors) * SECTOR_SIZE)
+
+
+def create_image(path: str, size: int, volume_id: Optional[int] = None, thin=False, max_size: Optional[int] = None) -> Geometry:
+    '''
+    Create (or overwrite) path as a size byte disk image holding one empty
+    FAT32 partition. The space is reserved up front with posix_fallocate
+    unless thin is set, in which case only written blocks use disk space.
+    The filesystem can later be grown up to max_size with resize_image.
+    The share has to be unmounted while this runs.
+    '''
+    if is_attached(path):
+        raise ValueError(f'Share {path} is mounted, unmount it first')
+    if max_size is None:
+        max_size = size * SHARE_GROWTH_FACTOR
+    geometry = get_geometry(size, max_size)
+    if volume_id is None:
+        volume_id = int.from_bytes(os.urandom(4), 'little')
+    with metrics.timer('image_create', thin=thin):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # drop any old contents so nothing but the new metadata is ever read back
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            if not thin and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            os.pwrite(fd, build_mbr(geometry, volume_id), 0)
+            write_filesystem(fd, geometry, volume_id)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    metrics.write(metrics.INFO, 'image created', path=path, size=size, thin=thin)
+    if os.path.exists(path + STATS_SUFFIX):
+        os.remove(path + STATS_SUFFIX)
+    return geometry
+
+
+def is_fat_boot_sector(sector: bytes) -> bool:
+    return sector[510:512] == BOOT_SIGNATURE and (sector[82:87] == b'FAT32' or sector[54:57] == b'FAT')
+
+
+def get_partition_offset(path: str) -> int:
+    '''
+    Byte offset of the first partition, read straight from the MBR.
+    Images formatted without a partition table (e.g. by mkfs.fat) start at 0.
+    '''
+    with open(path, 'rb') as f:
+        sector = f.read(SECTOR_SIZE)
+    if len(sector) < SECTOR_SIZE or sector[510:512] != BOOT_SIGNATURE:
+        raise ValueError(f'No partition table found in {path}')
+    if is_fat_boot_sector(sector):
+        return 0
+    for i in range(4):
+        offset = MBR_PARTITION_TABLE_OFFSET + i * MBR_PARTITION_ENTRY.size
+        _, _, part_type, _, lba_start, sectors = MBR_PARTITION_ENTRY.unpack_from(sector, offset)
+        if part_type != 0 and sectors > 0:
+            return lba_start * SECTOR_SIZE
+    raise ValueError(f'No partition found in {path}')
+
+
+def read_geometry(fd: int) -> Geometry:
+    '''
+    Geometry of an existing image created by create_image
+    '''
+    mbr = os.pread(fd, SECTOR_SIZE, 0)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != BOOT_SIGNATURE or is_fat_boot_sector(mbr):
+        raise ValueError('Share image has no partition table')
+    _, _, part_type, _, partition_start, partition_sectors = MBR_PARTITION_ENTRY.unpack_from(mbr, MBR_PARTITION_TABLE_OFFSET)
+    boot = os.pread(fd, SECTOR_SIZE, partition_start * SECTOR_SIZE)
+    if part_type != FAT32_LBA_PARTITION_TYPE or boot[82:90] != b'FAT32   ':
+        raise ValueError('Share image is not a FAT32 image')
+    fields = BPB.unpack_from(boot)
+    spc, fat_sectors = fields[3], fields[14]
+    cluster_count = (partition_sectors - data_start_sector(fat_sectors)) // spc
+    return Geometry(os.fstat(fd).st_size // SECTOR_SIZE, partition_start, partition_sectors, spc, fat_sectors, cluster_count)
+
+
+def is_attached(path: str) -> bool:
+    '''
+    Whether a loop device (e.g. the mounted share) is backed by path
+    '''
+    path = os.path.realpath(path)
+    try:
+        loops = [name for name in os.listdir('/sys/block') if name.startswith('loop')]
+    except OSError:
+        return False
+    for name in loops:
+        try:
+            with open(os.path.join('/sys/block', name, 'loop', 'backing_file'), 'r') as f:
+                if f.read().strip() == path:
+                    return True
+        except OSError:
+            continue
+    return False
+
+
+def is_thin(fd: int) -> bool:
+    # thick images have every byte allocated by posix_fallocate
+    st = os.fstat(fd)
+    return st.st_blocks * 512 < st.st_size
+
+
+def resize_image(path: str, new_size: int, thin: Optional[bool] = None) -> Geometry:
+    '''
+    Grow the image and its filesystem in place. New clusters are free as the
+    FAT was sized for growth when the image was created. The new space is
+    reserved like the old one unless thin says otherwise. The share has to be
+    unmounted while this runs.
+    '''
+    if is_attached(path):
+        raise ValueError(f'Share {path} is mounted, unmount it first')
+    fd = os.open(path, os.O_RDWR)
+    try:
+        old = read_geometry(fd)
+        new_partition_sectors = partition_sectors_for(new_size, old.partition_start)
+        if new_partition_sectors < old.partition_sectors:
+            raise ValueError('Shares can only grow')
+        new = old._replace(
+            total_sectors=new_size // SECTOR_SIZE,
+            partition_sectors=new_partition_sectors,
+            cluster_count=(new_partition_sectors - data_start_sector(old.fat_sectors)) // old.sectors_per_cluster)
+        if new.cluster_count > fat_capacity(old):
+            max_size = (old.partition_start + data_start_sector(old.fat_sectors) + fat_capacity(old) * old.sectors_per_cluster) * SECTOR_SIZE
+            raise ValueError(f'Share can grow to at most {max_size} bytes, recreate it to make it bigger')
+
+        old_size = os.fstat(fd).st_size
+        if thin is None:
+            thin = is_thin(fd)
+        if new_size > old_size:
+            os.ftruncate(fd, new_size)
+            if not thin and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, old_size, new_size - old_size)
+
+        mbr = bytearray(os.pread(fd, SECTOR_SIZE, 0))
+        struct.pack_into('<I', mbr, MBR_PARTITION_TABLE_OFFSET + 12, new.partition_sectors)
+        os.pwrite(fd, bytes(mbr), 0)
+        base = new.partition_start * SECTOR_SIZE
+        added = new.cluster_count - old.cluster_count
+        for start in (0, BACKUP_BOOT_SECTOR):
+            # total sectors in the boot sector, free cluster count in FSInfo
+            os.pwrite(fd, struct.pack('<I', new.partition_sectors), base + start * SECTOR_SIZE + 32)
+            fsinfo_offset = base + (start + FSINFO_SECTOR) * SECTOR_SIZE + FSINFO_FREE_COUNT_OFFSET
+            free, = struct.unpack('<I', os.pread(fd, 4, fsinfo_offset))
+            if free != 0xFFFFFFFF:
+                os.pwrite(fd, struct.pack('<I', free + added), fsinfo_offset)
+        os.fsync(fd)
+        return new
+    finally:
+        os.close(fd)
+
+
+def free_cluster_runs(fat: bytes, cluster_count: int) -> Iterator[Tuple[int, int]]:
+    '''
+    (first cluster, number of clusters) of every run of free clusters
+    '''
+    entries = memoryview(fat)[:(cluster_count + 2) * 4].cast('I')
+    run_start = None
+    for cluster in range(ROOT_CLUSTER, cluster_count + 2):
+        if entries[cluster] & 0x0FFFFFFF == 0:
+            if run_start is None:
+                run_start = cluster
+        elif run_start is not None:
+            yield run_start, cluster - run_start
+            run_start = None
+    if run_start is not None:
+        yield run_start, cluster_count + 2 - run_start
+
+
+def punch_hole(fd: int, offset: int, length: int) -> None:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    if libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def compact_image(path: str) -> int:
+    '''
+    Punch holes over the free clusters of the filesystem so space used by
+    deleted files goes back to the host. Returns the number of bytes released.
+    The share has to be unmounted while this runs.
+    '''
+    if is_attached(path):
+        raise ValueError(f'Share {path} is mounted, unmount it first')
+    fd = os.open(path, os.O_RDWR)
+    try:
+        geometry = read_geometry(fd)
+        base = geometry.partition_start * SECTOR_SIZE
+        fat = os.pread(fd, geometry.fat_sectors * SECTOR_SIZE, base + RESERVED_SECTORS * SECTOR_SIZE)
+        data_start = base + data_start_sector(geometry.fat_sectors) * SECTOR_SIZE
+        cluster_size = geometry.sectors_per_cluster * SECTOR_SIZE
+        block_size = os.fstat(fd).st_blksize
+        used_before = os.fstat(fd).st_blocks * 512
+        for first, count in free_cluster_runs(fat, geometry.cluster_count):
+            start = data_start + (first - ROOT_CLUSTER) * cluster_size
+            end = start + count * cluster_size
+            # only whole host blocks can be released
+            start = -(-start // block_size) * block_size
+            end = end // block_size * block_size
+            if end > start:
+                punch_hole(fd, start, end - start)
+        os.fsync(fd)
+        return max(used_before - os.fstat(fd).st_blocks * 512, 0)
+    finally:
+        os.close(fd)
+
+
+def image_usage(path: str) -> ImageUsage:
+    '''
+    Logical size and current/peak physical disk usage of the image. The peak
+    is whatever was highest whenever lansync looked, kept next to the image.
+    '''
+    st = os.stat(path)
+    physical = st.st_blocks * 512
+    stats_path = path + STATS_SUFFIX
+    try:
+        with open(stats_path, 'r') as f:
+            peak = json.load(f)['peak']
+    except (OSError, ValueError, KeyError, TypeError):
+        peak = 0
+    if physical > peak:
+        peak = physical
+        try:
+            with open(stats_path, 'w') as f:
+                json.dump({'peak': peak}, f)
+        except OSError as err:
+            metrics.log(f'Couldn\'t save share stats: {err}', metrics.WARNING)
+    return ImageUsage(st.st_size, physical, peak)
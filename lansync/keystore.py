@@ -0,0 +1,239 @@
+'''
+Indexed view of ~/.ssh/authorized_keys used to import keys in bulk
+'''
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional
+from lansync import metrics
+from lansync.settings import SECURE_OPTIONS, SERVER_FLAGS, AUTHORIZED_KEYS_PATH, AUTHORIZED_KEYS_INDEX_SUFFIX
+
+
+# updated keys were imported before with other options, e.g. another --compress codec
+ImportResult = namedtuple('ImportResult', ['imported', 'skipped', 'updated'])
+
+# key type followed by a base64 blob - options in front of it may contain
+# quoted spaces, so look for the pair instead of splitting on whitespace
+KEY_RE = re.compile(r'(?:^|\s)((?:ssh|ecdsa|sk)-[a-zA-Z0-9@.-]+)\s+(\S+)')
+# options of lines lansync wrote start with its forced command, whatever the codec.
+# Only those are rewritten, keys added by hand keep their options
+MANAGED_PREFIX = SECURE_OPTIONS[:SECURE_OPTIONS.index(SERVER_FLAGS)]
+
+
+def fingerprint(key: str) -> str:
+    '''
+    Return the OpenSSH style SHA256 fingerprint of a key or authorized_keys line.
+    Lines that don't look like keys are fingerprinted as a whole so they can
+    still be deduplicated.
+    '''
+    match = KEY_RE.search(key)
+    if match is None:
+        data = key.strip().encode('utf-8')
+    else:
+        try:
+            data = base64.b64decode(match.group(2), validate=True)
+        except (binascii.Error, ValueError):
+            data = match.group(2).encode('utf-8')
+    digest = base64.b64encode(hashlib.sha256(data).digest()).decode('ascii').rstrip('=')
+    return 'SHA256:' + digest
+
+
+def line_options(line: str) -> str:
+    '''
+    Options in front of the key of an authorized_keys line, '' when there are none
+    '''
+    match = KEY_RE.search(line)
+    if match is None:
+        return ''
+    return line[:match.start(1)].strip()
+
+
+class KeyStore(object):
+    '''
+    Loads authorized_keys once and keeps the fingerprints of all keys in it.
+    The index can be persisted next to the keys file so the next run doesn't
+    have to read it again unless it changed; after imports it is only written
+    by save(), so a run saves it once however many keys it imports. New keys are written with options
+    in front of them, keys lansync imported before with other options get
+    their line rewritten.
+    '''
+    def __init__(self, auth_keys_path=AUTHORIZED_KEYS_PATH, persist_index=False, options=SECURE_OPTIONS):
+        self.auth_keys_path = auth_keys_path
+        self.options = options
+        self.index_path = auth_keys_path + AUTHORIZED_KEYS_INDEX_SUFFIX
+        self.persist_index = persist_index
+        # fingerprint -> options of its line
+        self.index = {}  # type: Dict[str, str]
+        self._ends_with_newline = True
+        # stat of authorized_keys the index is up to date with, None when it doesn't exist
+        self._signature = None  # type: Optional[List[int]]
+        # keys were written since the persisted index was saved
+        self._dirty = False
+        self.load()
+
+    def load(self) -> None:
+        self.index = {}
+        self._ends_with_newline = True
+        self._signature = None
+        self._dirty = False
+        if not os.path.exists(self.auth_keys_path):
+            return
+        if self.persist_index and self._load_persisted():
+            metrics.counter('authorized_keys_index_hits')
+            self._signature = self._stat_signature()
+            return
+        with metrics.timer('authorized_keys_read'), open(self.auth_keys_path, 'r') as f:
+            line = ''
+            for line in f:
+                stripped = line.strip()
+                if stripped == '' or stripped.startswith('#'):
+                    continue
+                self.index[fingerprint(stripped)] = line_options(stripped)
+            self._ends_with_newline = line == '' or line.endswith('\n')
+            metrics.counter('authorized_keys_read_bytes', os.fstat(f.fileno()).st_size)
+        self._signature = self._stat_signature()
+        if self.persist_index:
+            self._save_persisted()
+
+    def is_current(self) -> bool:
+        '''
+        Whether authorized_keys is unchanged since it was last read or written by this store
+        '''
+        try:
+            return self._stat_signature() == self._signature
+        except OSError:
+            return self._signature is None
+
+    def __contains__(self, key: str) -> bool:
+        return fingerprint(key) in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def is_imported(self, key: str) -> bool:
+        return key in self
+
+    def is_up_to_date(self, key: str, key_fingerprint: Optional[str] = None) -> bool:
+        '''
+        Whether importing key would change nothing: it is imported with the
+        options it would be written with now, or was added by hand
+        '''
+        options = self.index.get(key_fingerprint or fingerprint(key))
+        if options is None:
+            return False
+        return options == line_options(self.options + ' ' + key) or not options.startswith(MANAGED_PREFIX)
+
+    def import_keys(self, keys: Iterable[str]) -> ImportResult:
+        '''
+        Dedupe the batch against the index and append all new keys with a single
+        write. Files with keys whose options changed are rewritten instead.
+        '''
+        to_write = []  # type: List[str]
+        updates = {}  # type: Dict[str, str]
+        skipped = 0
+        for key in keys:
+            key_fingerprint = fingerprint(key)
+            if self.is_up_to_date(key, key_fingerprint):
+                skipped += 1
+                continue
+            line = self.options + ' ' + key + '\n'
+            if key_fingerprint in self.index:
+                updates[key_fingerprint] = line
+            else:
+                to_write.append(line)
+            self.index[key_fingerprint] = line_options(line)
+        if len(updates) > 0:
+            self._rewrite(updates, to_write)
+        elif len(to_write) > 0:
+            self._append(to_write)
+        metrics.counter('keys_written', len(to_write))
+        metrics.counter('keys_updated', len(updates))
+        metrics.counter('keys_deduped', skipped, reason='imported')
+        return ImportResult(imported=len(to_write), skipped=skipped, updated=len(updates))
+
+    def import_key(self, key: str) -> Optional[str]:
+        result = self.import_keys([key])
+        return key if result.imported + result.updated == 1 else None
+
+    def _append(self, lines: List[str]) -> None:
+        data = ''.join(lines)
+        if not self._ends_with_newline:
+            data = '\n' + data
+        # a single O_APPEND write keeps the batch together if someone else appends too
+        encoded = data.encode('utf-8')
+        with metrics.timer('authorized_keys_write'):
+            fd = os.open(self.auth_keys_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                buf = memoryview(encoded)
+                while len(buf) > 0:
+                    buf = buf[os.write(fd, buf):]
+            finally:
+                os.close(fd)
+        metrics.counter('authorized_keys_written_bytes', len(encoded))
+        self._written()
+
+    def _rewrite(self, updates: Dict[str, str], lines: List[str]) -> None:
+        '''
+        Replace the lines lansync wrote for the keys in updates and append lines,
+        through a temporary file so readers never see half of it
+        '''
+        tmp_path = self.auth_keys_path + '.tmp'
+        with metrics.timer('authorized_keys_write'):
+            with open(self.auth_keys_path, 'r') as f:
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with open(fd, 'w') as out:
+                    os.fchmod(fd, os.fstat(f.fileno()).st_mode & 0o777)
+                    for line in f:
+                        stripped = line.strip()
+                        if stripped != '' and not stripped.startswith('#') and line_options(stripped).startswith(MANAGED_PREFIX):
+                            line = updates.get(fingerprint(stripped), line)
+                        out.write(line if line.endswith('\n') else line + '\n')
+                    out.writelines(lines)
+            os.replace(tmp_path, self.auth_keys_path)
+        metrics.counter('authorized_keys_written_bytes', os.path.getsize(self.auth_keys_path))
+        self._written()
+
+    def save(self) -> None:
+        '''
+        Persist the index if keys were written since it was last saved, unless
+        authorized_keys changed behind our back in the meantime
+        '''
+        if self._dirty and self.is_current():
+            self._save_persisted()
+        self._dirty = False
+
+    def _written(self) -> None:
+        self._ends_with_newline = True
+        self._signature = self._stat_signature()
+        self._dirty = self.persist_index
+
+    def _stat_signature(self) -> List[int]:
+        st = os.stat(self.auth_keys_path)
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def _load_persisted(self) -> bool:
+        try:
+            with open(self.index_path, 'r') as f:
+                persisted = json.load(f)
+            if persisted['stat'] != self._stat_signature():
+                return False
+            if not isinstance(persisted['index'], dict):
+                return False  # written before options were indexed
+            self.index = persisted['index']
+            self._ends_with_newline = persisted['ends_with_newline']
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def _save_persisted(self) -> None:
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'stat': self._stat_signature(), 'ends_with_newline': self._ends_with_newline, 'index': self.index}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as err:
+            metrics.log(f'Couldn\'t save key index: {err}', metrics.WARNING, path=self.index_path)
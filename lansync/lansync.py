@@ -1,20 +1,62 @@
+import atexit
 import os
+import sys
 # import guestfs
-from lansync.utilities import ArgParser, get_pub_keys, is_key_imported, import_key, get_local_ip, parse_size, get_first_partition_offset
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from lansync.netif import interfaces
+from lansync.utilities import ArgParser, get_local_ip, parse_size, format_size, get_first_partition_offset, log
+from lansync.keystore import KeyStore
+from lansync import metrics
+from lansync.image import compact_image, create_image, image_usage, resize_image
 from lansync.settings import CURRENT_USER, PATH_TO_PUBLIC_DIR, AUTHORIZED_KEYS_PATH, PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME
 
+# key validation, downloads, inotify and the transfer machinery are imported
+# by the commands that use them so that e.g. --size starts up quickly
+if TYPE_CHECKING:
+    from lansync.compression import Group
+    from lansync.discovery import Peer
+    from lansync.segments import AssembleResult
+    from lansync.send import FileEntry, GroupFiles, SendReport
+    from lansync.usage import UsageTracker
+    from lansync.verify import Check
+    from lansync.watch import BatchResult
+
 
 def main() -> None:
     args = ArgParser().parse_args()
+    if args.log_path is not None or args.metrics_port is not None:
+        try:
+            metrics.configure(args.log_path, args.log_level, args.metrics_port)
+        except OSError as err:
+            print(f'Couldn\'t start logging: {err}')
+        atexit.register(metrics.shutdown)
+    if args.command == 'send':
+        sys.exit(send(args.path, args.peer, args.jobs, args.segmented, not args.restart, args.resend, args.verify, args.compress, args.link_speed))
+    if args.command == 'receive':
+        receive_segments(args.follow)
+        return
+    if args.command == 'discover':
+        discover()
+        return
+    if args.command == 'peers':
+        show_peers()
+        return
+    if args.command == 'sync':
+        sys.exit(sync(args.src, args.dest, args.block_size))
+    if args.command == 'dedup':
+        sys.exit(dedup())
+    if args.command == 'verify':
+        sys.exit(verify_share(args.full, args.follow))
+    if args.command == 'watch':
+        sys.exit(watch(args.path, args.peers, args.debounce, args.rescan, args.compress, args.link_speed))
+
     # make sure conig file exists
     if not os.path.exists(PATH_TO_PUBLIC_DIR_FILE):
         os.makedirs(PATH_TO_PUBLIC_DIR_FILE)
 
     # Check for keys to import
-    keys_to_import = get_pub_keys(args.pub_key_arg)
-    if keys_to_import is not None and len(keys_to_import) > 0:
-        for key in keys_to_import:
-            parse_import_key(key)
+    if args.pub_key_arg is not None and args.pub_key_arg != '':
+        parse_import_keys(args.pub_key_arg, args.compress)
 
     # Check for setup dir
     if args.setup_dir_size is not None:
@@ -22,20 +64,314 @@ def main() -> None:
         if not os.path.exists(PATH_TO_PUBLIC_DIR):
             os.makedirs(PATH_TO_PUBLIC_DIR)
 
-        create_share(PUBLIC_DIR_FILE_NAME, args.setup_dir_size)
-        part_offset = get_first_partition_offset(os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME))
-        print('Created share "' + os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME) + '" and limited it to ' + args.setup_dir_size)
-        print('Mount share with the following command: \n\nsudo mount -o offset=' + str(part_offset) + ',nosuid,uid=' + CURRENT_USER + ',gid=' + CURRENT_USER + ',umask=0077 ' + os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME) + ' ' + PATH_TO_PUBLIC_DIR)
+        try:
+            create_share(PUBLIC_DIR_FILE_NAME, args.setup_dir_size, thin=args.thin is True)
+            part_offset = get_first_partition_offset(os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME))
+        except (OSError, ValueError) as err:
+            print(f'Couldn\'t create share: {err}')
+        else:
+            print('Created share "' + os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME) + '" and limited it to ' + args.setup_dir_size)
+            print('Mount share with the following command: \n\nsudo mount -o offset=' + str(part_offset) + ',nosuid,uid=' + CURRENT_USER + ',gid=' + CURRENT_USER + ',umask=0077 ' + os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME) + ' ' + PATH_TO_PUBLIC_DIR)
+
+    share_path = os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME)
+    if args.resize_size is not None:
+        try:
+            resize_image(share_path, parse_size(args.resize_size), thin=args.thin)
+            print('Resized share "' + share_path + '" to ' + args.resize_size + '. Mount it again to use the new space')
+        except (OSError, ValueError) as err:
+            print(f'Couldn\'t resize share: {err}')
+
+    if args.compact:
+        try:
+            released = compact_image(share_path)
+            print('Released ' + format_size(released) + ' of space used by deleted files')
+        except (OSError, ValueError) as err:
+            print(f'Couldn\'t compact share: {err}')
+
+    if (args.setup_dir_size is not None or args.resize_size is not None or args.compact) and os.path.exists(share_path):
+        usage = image_usage(share_path)
+        print('Share quota ' + format_size(usage.logical) + ', using ' + format_size(usage.physical) + ' on disk (peak ' + format_size(usage.peak) + ')')
+
+    if args.usage:
+        show_usage(args.follow)
 
     # run last
-    print('\nRsync from client with: rsync <src file> ' + CURRENT_USER + '@' + get_local_ip() + ':')
+    local_ip = get_local_ip()
+    print('\nRsync from client with: rsync <src file> ' + CURRENT_USER + '@' + local_ip + ':')
+    # docked laptops are reachable on more than one network, the default route isn't always the right one
+    other_addresses = [iface.address for iface in interfaces() if iface.address != local_ip]
+    if len(other_addresses) > 0:
+        print('or from other networks with: ' + ', '.join(CURRENT_USER + '@' + address + ':' for address in other_addresses))
+
+
+def parse_import_keys(pub_key_arg: str, compress: Optional[str] = None) -> None:
+    '''
+    Stream every key in the --import argument (or stdin) into authorized_keys
+    '''
+    from lansync.compression import secure_options
+    from lansync.pipeline import ingest
+    from lansync.validation import get_validation_cache
+    store = KeyStore(AUTHORIZED_KEYS_PATH, persist_index=True, options=secure_options(compress))
+    report = ingest(pub_key_arg, store)
+    get_validation_cache().save()
+    print(f'Imported {report.imported} key(s), updated the options of {report.updated}, skipped {report.skipped} already imported, {report.duplicates} duplicate(s), {report.invalid + report.errors} error(s)')
+
+
+def show_usage(follow=False) -> None:
+    from lansync.usage import UsageTracker
+    tracker = UsageTracker(on_soft_limit=warn_share_full)
+    tracker.refresh()
+    limit = ' of ' + format_size(tracker.limit) if tracker.limit is not None else ''
+    print('Share "' + PATH_TO_PUBLIC_DIR + '" is using ' + format_size(tracker.total) + limit)
+    for name, size in tracker.top():
+        print(f'{format_size(size):>10}  {name}')
+    tracker.check_soft_limit()
+    if follow:
+        try:
+            tracker.watch()
+        except KeyboardInterrupt:
+            tracker.save()
+
+
+def warn_share_full(tracker: 'UsageTracker') -> None:
+    log(f'Warning: share is {tracker.total * 100 // tracker.limit}% full ({format_size(tracker.total)} of {format_size(tracker.limit)})', metrics.WARNING, used=tracker.total, limit=tracker.limit)
+
+
+def send(path: str, peer: str, jobs: int, segmented=False, resume=True, resend: Optional[List[int]] = None, verify=False,
+         compress: Optional[str] = None, link_speed: Optional[int] = None) -> int:
+    '''
+    Send path to peer and return rsync's exit status
+    '''
+    from lansync.compression import LEVELS, Choice, CompressionError, client_options
+    from lansync.segments import send_file
+    from lansync.send import FileEntry, SendError, plan_tree, send_tree
+    from lansync.verify import Hasher, ship_expected
+
+    try:
+        if verify:
+            files = {os.path.basename(path): path} if segmented else {f.name: f.path for f in plan_tree(path)}
+            with Hasher() as hasher:
+                # a peer taking compressed transfers takes nothing else, the digests go at the fastest level
+                options = client_options(Choice(compress, LEVELS[compress][0], 1.0, 0.0), []) if compress is not None else []
+                returncode = ship_expected(os.path.basename(os.path.abspath(path)), files, peer, hasher, options=options)
+            if returncode != 0:
+                print(f'Couldn\'t send the digests of {path}, rsync exited with {returncode}')
+                print_protocol_hint(returncode)
+                return returncode
+        group_files = compression_groups(compress, link_speed, jobs) if compress is not None else None
+        if segmented:
+            options = []  # type: List[str]
+            if group_files is not None:
+                # segments are sent under names of their own, so an uncompressible file gets the cheapest level
+                size = os.path.getsize(path)
+                [(options, _)] = group_files([FileEntry(os.path.abspath(path), os.path.basename(path), size)])
+                options = [option for option in options if not option.startswith('--skip-compress=')]
+            report = send_file(path, peer, jobs, resume=resume, resend=resend or [], options=options, on_progress=print_send_progress)
+        else:
+            report = send_tree(path, peer, jobs, on_progress=print_send_progress, group_files=group_files)
+    except (OSError, SendError, CompressionError) as err:
+        print(f'Couldn\'t send {path}: {err}')
+        return 1
+    print('')
+    if not report.ok:
+        print(f'Couldn\'t send {len(report.failed_files)} {report.unit}, rsync exited with {report.returncode}:')
+        for failed in report.failed_files:
+            print('    ' + failed)
+        print_protocol_hint(report.returncode)
+        return report.returncode
+    print(f'Sent {report.sent_files} {report.unit}, {format_size(report.sent_size)} to {peer}')
+    if segmented:
+        print('Put the file together on the peer with: lansync receive')
+    if verify:
+        print('Check what arrived on the peer with: lansync verify')
+    return 0
+
+
+def compression_groups(compress: str, link_speed: Optional[int], jobs: int) -> 'GroupFiles':
+    '''
+    group_files of send_tree and Outbox sending every class of files at the level compression.plan picks for it
+    '''
+    from lansync.compression import plan
+
+    def group_by_class(files: List['FileEntry']) -> List[Tuple[List[str], List['FileEntry']]]:
+        groups = plan(files, compress, link_speed * 10**6 / 8 if link_speed is not None else None, jobs)
+        for group in groups:
+            print_compression_group(group)
+        return [(group.options, group.files) for group in groups]
+    return group_by_class
+
+
+def print_protocol_hint(returncode: Optional[int]) -> None:
+    from lansync.send import PROTOCOL_ERRORS
+    if returncode in PROTOCOL_ERRORS:
+        print('The peer may only take compressed transfers: if it imported your key with --compress <codec>, send with --compress <codec> too')
+
+
+def print_compression_group(group: 'Group') -> None:
+    size = format_size(sum(f.size for f in group.files))
+    if group.choice.level is None:
+        print(f'{group.kind}: {len(group.files)} file(s), {size}, sent uncompressed')
+    else:
+        print(f'{group.kind}: {len(group.files)} file(s), {size}, {group.choice.codec} level {group.choice.level} '
+              f'({group.choice.ratio:.1f}x, about {format_size(int(group.choice.throughput))}/s)')
+
 
+def print_send_progress(report: 'SendReport') -> None:
+    done = report.sent_files + len(report.failed_files)
+    print(f'\r{done}/{report.total_files} {report.unit}, {format_size(report.sent_size)} of {format_size(report.total_size)}', end='', flush=True)
+
+
+def receive_segments(follow=False) -> None:
+    from lansync.segments import assemble_all, receive
+    try:
+        if follow:
+            receive(on_result=print_assemble_result)
+        else:
+            for result in assemble_all():
+                print_assemble_result(result)
+    except KeyboardInterrupt:
+        pass
+    except OSError as err:
+        print(f'Couldn\'t receive segments: {err}')
+
+
+def print_assemble_result(result: 'AssembleResult') -> None:
+    if result.complete:
+        print(f'Received "{result.name}"')
+    else:
+        print(f'"{result.name}": {result.done}/{result.total} segments received')
+    if len(result.rejected) > 0:
+        print(f'"{result.name}": dropped {len(result.rejected)} corrupted segment(s), resend them with lansync send --segmented --resend {",".join(str(index) for index in result.rejected)}')
+
+
+def discover() -> None:
+    from lansync.discovery import DiscoveryDaemon, PeerCache
+    cache = PeerCache()
+    cache.load()
+    try:
+        with DiscoveryDaemon(cache, on_peer=print_peer) as daemon:
+            print(f'Announcing {CURRENT_USER} on port {daemon.port}, press Ctrl+C to stop')
+            daemon.run()
+    except KeyboardInterrupt:
+        cache.save()
+    except OSError as err:
+        print(f'Couldn\'t start discovery: {err}')
+
+
+def show_peers() -> None:
+    from lansync.discovery import PeerCache
+    cache = PeerCache()
+    cache.load()
+    peers = cache.peers()
+    if len(peers) == 0:
+        print('No peers found. Run lansync discover to look for them')
+    for peer in peers:
+        print_peer(peer)
+
+
+def print_peer(peer: 'Peer') -> None:
+    space = f'{format_size(peer.free)} free of {format_size(peer.capacity)}' if peer.capacity > 0 else f'{format_size(peer.free)} free'
+    print(f'{peer.user}@{peer.address}  ({peer.host}, {space})')
+
+
+def sync(src: str, dest: str, block_size: Optional[str] = None) -> int:
+    from lansync.delta import DeltaError, sync_file
+    try:
+        result = sync_file(src, dest, parse_size(block_size) if block_size is not None else None)
+    except (OSError, ValueError, DeltaError) as err:
+        print(f'Couldn\'t sync {src}: {err}')
+        return 1
+    print(f'Synced {format_size(result.size)}: {format_size(result.matched)} already there, {format_size(result.literal)} changed, wrote {format_size(result.written)}')
+    return 0
+
+
+def dedup() -> int:
+    from lansync.dedup import DedupError, DedupStore
+    store = DedupStore()
+    try:
+        store.load()
+        stats = store.update()
+        store.save()
+    except (OSError, DedupError) as err:
+        print(f'Couldn\'t deduplicate share: {err}')
+        return 1
+    ratio = stats.logical / stats.stored if stats.stored > 0 else 1
+    print(f'Deduplicated {stats.changed} changed file(s), collected {format_size(stats.collected)} of unused chunks')
+    print(f'{stats.files} file(s), {format_size(stats.logical)} stored in {format_size(stats.stored)}, dedup ratio {ratio:.2f}')
+    return 0
+
+
+def verify_share(full=False, follow=False) -> int:
+    '''
+    Hash what changed in the share and check it against the digests senders shipped
+    '''
+    from lansync.verify import STATUS_OK, Hasher, Manifest, follow as follow_checks, verify
+    manifest = Manifest()
+    manifest.load()
+    checks = []  # type: List[Check]
+    try:
+        with Hasher(manifest.chunk_size) as hasher:
+            if follow:
+                try:
+                    follow_checks(manifest, hasher, print_check)
+                except KeyboardInterrupt:
+                    pass
+            else:
+                checks = verify(manifest, hasher, full)
+        manifest.save()
+    except OSError as err:
+        print(f'Couldn\'t verify share: {err}')
+        return 1
+    for check in checks:
+        if check.status != STATUS_OK:
+            print_check(check)
+    failed = len([check for check in checks if check.status != STATUS_OK])
+    if not follow:
+        print(f'Verified {len(checks) - failed} file(s), {failed} problem(s), {len(manifest.entries)} file(s) in the manifest')
+    return 1 if failed > 0 else 0
+
+
+def print_check(check: 'Check') -> None:
+    print(f'"{check.name}": {check.status}')
+
+
+def watch(path: str, peers: List[str], debounce: float, rescan=False, compress: Optional[str] = None, link_speed: Optional[int] = None) -> int:
+    '''
+    Push everything written to path to peers until interrupted
+    '''
+    from lansync.compression import CompressionError, codec_functions
+    from lansync.watch import Outbox
+    if not os.path.isdir(path):
+        print(f'Couldn\'t watch {path}: not a directory')
+        return 1
+    try:
+        if compress is not None:
+            codec_functions(compress)
+    except CompressionError as err:
+        print(f'Couldn\'t watch {path}: {err}')
+        return 1
+    # every batch is a single rsync stream per peer
+    group_files = compression_groups(compress, link_speed, 1) if compress is not None else None
+    outbox = Outbox(path, peers, debounce=debounce, on_batch=print_batch_result, group_files=group_files)
+    outbox.refresh(rescan)
+    print(f'Sending what is written to {outbox.root} to {", ".join(peers)}')
+    try:
+        outbox.watch()
+    except KeyboardInterrupt:
+        outbox.save()
+    except OSError as err:
+        print(f'Couldn\'t watch {path}: {err}')
+        return 1
+    return 0
+
+
+def print_batch_result(result: 'BatchResult') -> None:
+    if len(result.sent) > 0:
+        print(f'Sent {len(result.sent)} file(s) to {result.peer}')
+    if len(result.failed) > 0:
+        print(f'Couldn\'t send {len(result.failed)} file(s) to {result.peer}, rsync exited with {result.returncode}. Retrying in {result.retry_in}s')
+        print_protocol_hint(result.returncode)
 
-def parse_import_key(key_to_import: str) -> None:
-    key_imported = is_key_imported(key_to_import)
-    if not key_imported:
-        import_key(key_to_import, AUTHORIZED_KEYS_PATH)
-        print(f'Imported key successfully: {key_to_import[:40]}...<trimmed>...{key_to_import[-20:]}')
 
 ###############################################################################
 # guestfs module is dodgy to install so commented out for now
@@ -61,19 +397,14 @@ def parse_import_key(key_to_import: str) -> None:
 #     return share_name
 
 
-def create_share(share_name, share_size='10M') -> str:
+def create_share(share_name, share_size='10M', thin=False) -> str:
     '''
-    Utilize some commonly found shell commands to create the share file
+    Create the share file as a disk image with a single FAT32 partition.
+    Thin shares only take up disk space for what is written to them.
     '''
     parsed_share_size = parse_size(share_size)
     output = os.path.join(PATH_TO_PUBLIC_DIR_FILE, share_name)
-
-    # create share file
-    fallocate_cmd = 'fallocate -l ' + str(parsed_share_size) + ' ' + output
-    os.system(fallocate_cmd)
-
-    # create partition on the file
-    os.system('mkfs.fat ' + output)
+    create_image(output, parsed_share_size, thin=thin)
     return output
 
 
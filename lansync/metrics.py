@@ -0,0 +1,212 @@
+'''
+Leveled JSON-lines logs, counters and timers.
+
+Nothing is recorded until configure() is called (lansync --log / --metrics-port),
+so counter() and timer() cost a function call when instrumentation is off.
+Counters and timers are written to the log when the process exits and can be
+scraped while it runs from a local Prometheus text endpoint.
+'''
+import json
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from lansync.settings import METRICS_ADDRESS
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+
+class Registry(object):
+    '''
+    Counters and timers by name and labels
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # type: Dict[Tuple[str, tuple], float]
+        # name, labels -> [count, total seconds]
+        self.timers = {}  # type: Dict[Tuple[str, tuple], list]
+
+    def add(self, name: str, value: float, labels: dict) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, labels: dict) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self.timers.setdefault(key, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+                'timers': [{'name': name, 'labels': dict(labels), 'count': count, 'seconds': seconds} for (name, labels), (count, seconds) in sorted(self.timers.items())],
+            }
+
+    def prometheus(self) -> str:
+        '''
+        Prometheus text exposition format, timers as summaries
+        '''
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'lansync_{name}_total{format_labels(labels)} {value}')
+            for (name, labels), (count, seconds) in sorted(self.timers.items()):
+                lines.append(f'lansync_{name}_seconds_count{format_labels(labels)} {count}')
+                lines.append(f'lansync_{name}_seconds_sum{format_labels(labels)} {seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Timer(object):
+    def __init__(self, registry: Registry, name: str, labels: dict):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.registry.observe(self.name, self.seconds, self.labels)
+        write(DEBUG, self.name, seconds=round(self.seconds, 6), **self.labels)
+
+
+class NullTimer(object):
+    seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+_registry = None  # type: Optional[Registry]
+_log_file = None
+_log_level = INFO
+_log_lock = threading.Lock()
+_server = None
+
+
+def configure(path: Optional[str] = None, level='info', port: Optional[int] = None, address=METRICS_ADDRESS) -> None:
+    '''
+    Start recording, logging to path and serving metrics on port when given
+    '''
+    global _registry, _log_file, _log_level
+    _log_level = LEVELS[level]
+    if _registry is None:
+        _registry = Registry()
+    if path is not None:
+        _log_file = open(path, 'a', buffering=1)
+    if port is not None:
+        serve(port, address)
+
+
+def shutdown() -> None:
+    '''
+    Write counters and timers to the log and stop recording
+    '''
+    global _registry, _log_file, _server
+    if _registry is not None:
+        write(INFO, 'metrics', **_registry.snapshot())
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    if _log_file is not None:
+        _log_file.close()
+        _log_file = None
+    _registry = None
+
+
+def enabled() -> bool:
+    return _registry is not None
+
+
+def registry() -> Optional[Registry]:
+    return _registry
+
+
+def log(msg: str, level=INFO, **fields) -> None:
+    '''
+    Tell the user and, with --log, append a JSON line with the extra fields
+    '''
+    if level >= INFO:
+        print(msg)
+    write(level, msg, **fields)
+
+
+def write(level: int, msg: str, **fields) -> None:
+    '''
+    Append a JSON line to the log only
+    '''
+    if _log_file is None or level < _log_level:
+        return
+    record = {'ts': round(time.time(), 6), 'level': LEVEL_NAMES.get(level, str(level)), 'msg': msg}
+    record.update(fields)
+    line = json.dumps(record, default=str)
+    with _log_lock:
+        if _log_file is not None:
+            _log_file.write(line + '\n')
+
+
+def counter(name: str, value: float = 1, **labels) -> None:
+    if _registry is not None:
+        _registry.add(name, value, labels)
+
+
+def timer(name: str, **labels):
+    '''
+    Context manager adding the time spent in it to the named timer
+    '''
+    if _registry is None:
+        return NULL_TIMER
+    return Timer(_registry, name, labels)
+
+
+def serve(port: int, address=METRICS_ADDRESS) -> int:
+    '''
+    Serve the metrics in Prometheus text format from a background thread, returns the port
+    '''
+    global _server
+    # only imported when asked for, http.server is slow to import
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = (_registry.prometheus() if _registry is not None else '').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _server = ThreadingHTTPServer((address, port), MetricsHandler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server.server_address[1]
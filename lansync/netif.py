@@ -0,0 +1,111 @@
+'''
+Local network interfaces and their IPv4 addresses, read from the kernel
+without sending anything on the network
+'''
+import fcntl
+import ipaddress
+import socket
+import struct
+from collections import namedtuple
+from typing import List, Optional
+
+
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+
+PROC_NET_ROUTE = '/proc/net/route'
+LOOPBACK_ADDRESS = '127.0.0.1'
+
+Interface = namedtuple('Interface', ['name', 'address', 'netmask', 'broadcast', 'flags'])
+
+
+def _ioctl(sock: socket.socket, request: int, name: str) -> bytes:
+    return fcntl.ioctl(sock.fileno(), request, struct.pack('256s', name.encode()[:15]))
+
+
+def _address(sock: socket.socket, request: int, name: str) -> Optional[str]:
+    try:
+        # struct ifreq: 16 bytes of name, then a sockaddr_in whose address starts at byte 4
+        return socket.inet_ntoa(_ioctl(sock, request, name)[20:24])
+    except OSError:
+        return None
+
+
+def get_interface(name: str, sock: Optional[socket.socket] = None) -> Optional[Interface]:
+    '''
+    IPv4 configuration of an interface, None when it has no IPv4 address
+    '''
+    own_sock = sock is None
+    sock = sock if sock is not None else socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        address = _address(sock, SIOCGIFADDR, name)
+        if address is None:
+            return None
+        flags = struct.unpack_from('H', _ioctl(sock, SIOCGIFFLAGS, name), 16)[0]
+        broadcast = _address(sock, SIOCGIFBRDADDR, name) if flags & IFF_BROADCAST else None
+        return Interface(name, address, _address(sock, SIOCGIFNETMASK, name), broadcast, flags)
+    except OSError:
+        return None
+    finally:
+        if own_sock:
+            sock.close()
+
+
+def interfaces(include_loopback=False) -> List[Interface]:
+    '''
+    Every interface that is up and has an IPv4 address
+    '''
+    result = []  # type: List[Interface]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            iface = get_interface(name, sock)
+            if iface is None or not iface.flags & IFF_UP:
+                continue
+            if iface.flags & IFF_LOOPBACK and not include_loopback:
+                continue
+            result.append(iface)
+    return result
+
+
+def default_route_interface(route_path=PROC_NET_ROUTE) -> Optional[str]:
+    '''
+    Name of the interface with the cheapest default route
+    '''
+    best = None
+    try:
+        with open(route_path, 'r') as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) < 8 or fields[1] != '00000000' or fields[7] != '00000000':
+                    continue
+                metric = int(fields[6])
+                if best is None or metric < best[0]:
+                    best = (metric, fields[0])
+    except (OSError, ValueError):
+        return None
+    return best[1] if best is not None else None
+
+
+def local_address() -> str:
+    '''
+    Address peers on the LAN can reach us at: the one on the default route,
+    else the first private address, else loopback
+    '''
+    name = default_route_interface()
+    if name is not None:
+        iface = get_interface(name)
+        if iface is not None:
+            return iface.address
+    candidates = interfaces()
+    for iface in candidates:
+        if ipaddress.ip_address(iface.address).is_private:
+            return iface.address
+    if len(candidates) > 0:
+        return candidates[0].address
+    return LOOPBACK_ADDRESS
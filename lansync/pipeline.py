@@ -0,0 +1,213 @@
+'''
+Streaming key ingest: source -> classify -> expand -> validate -> dedupe -> store.
+
+Every stage is a generator working on a bounded window of lines, so importing
+a dump with hundreds of thousands of lines never holds all of it in memory.
+Bad lines are reported through a callback and the batch carries on.
+'''
+import io
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Set
+from lansync import metrics
+from lansync.fetch import get_fetcher
+from lansync.keystore import KEY_RE, KeyStore
+from lansync.settings import FETCH_WINDOW, INGEST_BATCH_SIZE
+from lansync.utilities import github_keys_url, is_valid_username, is_valid_web_url
+from lansync.validation import PubKey, get_verdicts, to_record
+
+
+KIND_FILE = 'file'
+KIND_URL = 'url'
+KIND_USERNAME = 'username'
+KIND_KEY = 'key'
+
+STDIN_SOURCE = '-'
+
+# a line of input together with where it came from
+Line = namedtuple('Line', ['source', 'lineno', 'value'])
+Item = namedtuple('Item', ['source', 'lineno', 'kind', 'value'])
+LineError = namedtuple('LineError', ['source', 'lineno', 'value', 'reason'])
+
+
+class IngestReport(object):
+    def __init__(self):
+        self.lines = 0
+        self.keys = 0
+        self.invalid = 0
+        self.errors = 0
+        self.duplicates = 0
+        self.imported = 0
+        self.updated = 0
+        self.skipped = 0
+
+    def __repr__(self) -> str:
+        return 'IngestReport(' + ', '.join(f'{k}={v}' for k, v in vars(self).items()) + ')'
+
+
+def print_error(error: LineError) -> None:
+    metrics.log(f'{error.source}:{error.lineno}: {error.reason}', metrics.WARNING, source=error.source, lineno=error.lineno, reason=error.reason)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def read_lines(arg: Optional[str], stdin=None) -> Iterator[Line]:
+    '''
+    Lines of the --import argument, or of stdin when it is "-"
+    '''
+    if arg is None or arg == '':
+        return
+    if arg == STDIN_SOURCE:
+        stream = stdin if stdin is not None else sys.stdin
+        source = '<stdin>'
+    else:
+        stream = io.StringIO(arg)
+        source = '<import>'
+    for lineno, line in enumerate(stream, 1):
+        yield Line(source, lineno, line.rstrip('\r\n'))
+
+
+def classify_line(line: str) -> str:
+    # lines that start with a key type are keys - saves a stat() per key in big dumps
+    match = KEY_RE.match(line)
+    if match is not None and match.start(1) == 0:
+        return KIND_KEY
+    if os.path.exists(line):
+        return KIND_FILE
+    if is_valid_web_url(line):
+        return KIND_URL
+    if is_valid_username(line):
+        return KIND_USERNAME
+    return KIND_KEY
+
+
+def classify(lines: Iterable[Line]) -> Iterator[Item]:
+    for line in lines:
+        value = line.value.strip()
+        if value == '' or value.startswith('#'):
+            continue
+        yield Item(line.source, line.lineno, classify_line(value), value)
+
+
+def expand(items: Iterable[Item], report: IngestReport, on_error: Callable[[LineError], None] = print_error) -> Iterator[Line]:
+    '''
+    Turn files, urls and usernames into the key lines they contain. Remote
+    items are fetched concurrently, FETCH_WINDOW items at a time.
+    '''
+    for window in batched(items, FETCH_WINDOW):
+        urls = [item_url(item) for item in window]
+        get_fetcher().fetch_all(url for url in urls if url is not None)
+        for item, url in zip(window, urls):
+            report.lines += 1
+            metrics.counter('sources', kind=item.kind)
+            if item.kind == KIND_KEY:
+                yield Line(item.source, item.lineno, item.value)
+            elif item.kind == KIND_FILE:
+                yield from read_file(item, report, on_error)
+            else:
+                yield from read_url(item, url, report, on_error)
+
+
+def item_url(item: Item) -> Optional[str]:
+    if item.kind == KIND_URL:
+        return item.value
+    if item.kind == KIND_USERNAME:
+        return github_keys_url(item.value)
+    return None
+
+
+def read_file(item: Item, report: IngestReport, on_error: Callable[[LineError], None]) -> Iterator[Line]:
+    try:
+        with open(item.value, 'r') as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if line != '' and not line.startswith('#'):
+                    yield Line(item.value, lineno, line)
+    except (OSError, ValueError) as err:
+        report.errors += 1
+        on_error(LineError(item.source, item.lineno, item.value, f'Couldn\'t read file: {err}'))
+
+
+def read_url(item: Item, url: str, report: IngestReport, on_error: Callable[[LineError], None]) -> Iterator[Line]:
+    response = get_fetcher().take(url)
+    if response.status != 200:
+        report.errors += 1
+        reason = 'User not found' if item.kind == KIND_USERNAME and response.status == 404 else f'Couldn\'t download keys: {response.error or response.status}'
+        on_error(LineError(item.source, item.lineno, item.value, reason))
+        return
+    for lineno, line in enumerate(response.body.decode('utf-8', errors='replace').splitlines(), 1):
+        line = line.strip()
+        if line != '':
+            yield Line(url, lineno, line)
+
+
+def validate(lines: Iterable[Line], report: IngestReport, on_error: Callable[[LineError], None] = print_error, pool: Optional[Executor] = None) -> Iterator[PubKey]:
+    for batch in batched(lines, INGEST_BATCH_SIZE):
+        verdicts = get_verdicts([line.value for line in batch], pool=pool)
+        for line, verdict in zip(batch, verdicts):
+            record = to_record(line.value, verdict)
+            if record is None:
+                report.invalid += 1
+                on_error(LineError(line.source, line.lineno, line.value, verdict[1]))
+                continue
+            report.keys += 1
+            yield record
+
+
+def dedupe(records: Iterable[PubKey], report: IngestReport, store: Optional[KeyStore] = None) -> Iterator[PubKey]:
+    '''
+    Drop keys seen earlier in the input and keys the store already has with the same options.
+    Memory grows with the number of distinct keys, not with the input.
+    '''
+    seen = set()  # type: Set[str]
+    for record in records:
+        if record.fingerprint in seen:
+            report.duplicates += 1
+            metrics.counter('keys_deduped', reason='duplicate')
+            continue
+        seen.add(record.fingerprint)
+        if store is not None and store.is_up_to_date(record.line, record.fingerprint):
+            report.skipped += 1
+            metrics.counter('keys_deduped', reason='imported')
+            continue
+        yield record
+
+
+def store_keys(records: Iterable[PubKey], store: KeyStore, report: IngestReport) -> None:
+    for batch in batched(records, INGEST_BATCH_SIZE):
+        result = store.import_keys(record.line for record in batch)
+        report.imported += result.imported
+        report.updated += result.updated
+        report.skipped += result.skipped
+    store.save()
+
+
+def iter_keys(arg: Optional[str], report: Optional[IngestReport] = None, on_error: Callable[[LineError], None] = print_error, stdin=None, pool: Optional[Executor] = None) -> Iterator[PubKey]:
+    '''
+    All valid keys found in the --import argument, in input order
+    '''
+    report = report if report is not None else IngestReport()
+    return validate(expand(classify(read_lines(arg, stdin)), report, on_error), report, on_error, pool)
+
+
+def ingest(arg: Optional[str], store: KeyStore, on_error: Callable[[LineError], None] = print_error, stdin=None) -> IngestReport:
+    '''
+    Import every key in the --import argument into the store
+    '''
+    report = IngestReport()
+    # workers are only started once a batch is big enough to need them
+    with metrics.timer('ingest'), ProcessPoolExecutor() as pool:
+        records = iter_keys(arg, report, on_error, stdin, pool)
+        store_keys(dedupe(records, report, store), store, report)
+    metrics.write(metrics.INFO, 'ingest', **vars(report))
+    return report
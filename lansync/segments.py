@@ -0,0 +1,288 @@
+'''
+Segmented, resumable transfer of single huge files.
+
+A single rsync stream of one big file can't fill a fast link, so the sender
+cuts the file into fixed-size segments and sends them as separate files
+over parallel rsync streams, after a manifest holding every segment's
+digest. `lansync receive` on the peer verifies the segments as they arrive
+and writes them in place into the final file. Both sides journal the digests
+of finished segments, so an interrupted transfer, or one of a file that
+changed since, only redoes the segments that are missing or different.
+'''
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+from lansync.send import SendError, SendReport, rsync_command
+from lansync.settings import PATH_TO_PUBLIC_DIR, RSYNC_BINARY, SEGMENT_SIZE, SEND_JOBS, TRANSFER_JOURNAL_DIR
+from lansync import inotify
+
+
+MANIFEST_SUFFIX = '.lansync-manifest'
+PART_SUFFIX = '.lansync-part-'
+PARTIAL_SUFFIX = '.lansync-partial'
+
+Manifest = namedtuple('Manifest', ['name', 'size', 'segment_size', 'digests'])
+AssembleResult = namedtuple('AssembleResult', ['name', 'done', 'total', 'rejected', 'complete'])
+
+
+def segment_digest(data) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def part_name(name: str, index: int) -> str:
+    return f'{name}{PART_SUFFIX}{index:06}'
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return segment_digest(m)
+
+
+def hash_segments(path: str, segment_size=SEGMENT_SIZE, workers=SEND_JOBS) -> List[str]:
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            # hashlib drops the GIL for big buffers, so segments hash in parallel
+            with memoryview(m) as view, ThreadPoolExecutor(max_workers=workers) as pool:
+                return list(pool.map(lambda offset: segment_digest(view[offset:offset + segment_size]), range(0, size, segment_size)))
+
+
+def load_journal(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_journal(path: str, journal: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(journal, f)
+    os.replace(tmp_path, path)
+
+
+def copy_range(src_fd: int, dst_path: str, offset: int, length: int) -> None:
+    '''
+    Copy length bytes at offset into a new file. copy_file_range stays in the
+    kernel and shares extents on filesystems with reflinks.
+    '''
+    with open(dst_path, 'wb') as dst:
+        copied = 0
+        while copied < length:
+            try:
+                n = os.copy_file_range(src_fd, dst.fileno(), length - copied, offset + copied)
+            except OSError:
+                n = dst.write(os.pread(src_fd, min(length - copied, 2**20), offset + copied))
+            if n == 0:
+                raise SendError('Source file shrank while sending it')
+            copied += n
+
+
+def send_file(path: str, peer: str, jobs=SEND_JOBS, segment_size=SEGMENT_SIZE, rsync=RSYNC_BINARY,
+              journal_dir=TRANSFER_JOURNAL_DIR, resume=True, resend: Sequence[int] = (), options: Sequence[str] = (),
+              on_progress: Optional[Callable[[SendReport], None]] = None) -> SendReport:
+    '''
+    Send one file to peer as segments over up to jobs concurrent rsync processes,
+    all of them with the rsync options given. With resume, segments an earlier run
+    already sent with the same contents are skipped, except the ones in resend
+    (the peer rejected them).
+    '''
+    path = os.path.abspath(path)
+    if not os.path.isfile(path):
+        raise SendError(f'Not a file: {path}')
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    digests = hash_segments(path, segment_size, jobs)
+
+    journal_path = os.path.join(journal_dir, 'send-' + segment_digest(f'{peer}:{path}'.encode()) + '.json')
+    journal = load_journal(journal_path)
+    if not resume or (journal.get('size'), journal.get('segment_size')) != (size, segment_size):
+        journal = {'path': path, 'peer': peer, 'size': size, 'segment_size': segment_size, 'sent': {}}
+    sent = journal['sent']
+    for index in resend:
+        sent.pop(str(index), None)
+    missing = [index for index, digest in enumerate(digests) if sent.get(str(index)) != digest]
+
+    def length(index: int) -> int:
+        return min(segment_size, size - index * segment_size)
+
+    report = SendReport(len(missing), sum(length(index) for index in missing), unit='segments')
+    lock = threading.Lock()
+    os.makedirs(journal_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=journal_dir) as staging, open(path, 'rb') as src:
+        manifest_path = os.path.join(staging, name + MANIFEST_SUFFIX)
+        with open(manifest_path, 'w') as f:
+            json.dump({'size': size, 'segment_size': segment_size, 'digests': digests}, f)
+        # the receiver needs the digests before it can accept any segment
+        result = subprocess.run(rsync_command([manifest_path], peer, rsync, options), stdout=subprocess.DEVNULL)
+        if result.returncode != 0:
+            report.returncode = result.returncode
+            report.failed_files.append(manifest_path)
+            return report
+
+        def send_segment(index: int) -> None:
+            part = os.path.join(staging, part_name(name, index))
+            copy_range(src.fileno(), part, index * segment_size, length(index))
+            try:
+                # the peer would reject it, and it mustn't be journaled as sent
+                if file_digest(part) != digests[index]:
+                    with lock:
+                        report.failed_files.append(part_name(name, index) + ' (changed while sending)')
+                        report.returncode = report.returncode or 1
+                    return
+                result = subprocess.run(rsync_command([part], peer, rsync, options), stdout=subprocess.DEVNULL)
+            finally:
+                os.remove(part)
+            with lock:
+                if result.returncode == 0:
+                    report.sent_files += 1
+                    report.sent_size += length(index)
+                    sent[str(index)] = digests[index]
+                    save_journal(journal_path, journal)
+                else:
+                    report.failed_files.append(part_name(name, index))
+                    if report.returncode == 0:
+                        report.returncode = result.returncode
+                if on_progress is not None:
+                    on_progress(report)
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            list(pool.map(send_segment, missing))
+    return report
+
+
+def read_manifest(path: str) -> Optional[Manifest]:
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        manifest = Manifest(os.path.basename(path)[:-len(MANIFEST_SUFFIX)], int(data['size']), int(data['segment_size']), [str(d) for d in data['digests']])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if manifest.segment_size <= 0 or len(manifest.digests) != -(-manifest.size // manifest.segment_size):
+        return None
+    return manifest
+
+
+def write_segment(fd: int, part_path: str, offset: int, length: int, digest: str) -> bool:
+    '''
+    Verify a received segment and write it at its offset in the target file
+    '''
+    with open(part_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size != length:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if segment_digest(m) != digest:
+                return False
+            with memoryview(m) as view:
+                written = 0
+                while written < length:
+                    written += os.pwrite(fd, view[written:], offset + written)
+    return True
+
+
+def assemble(manifest_path: str, journal_dir=TRANSFER_JOURNAL_DIR) -> Optional[AssembleResult]:
+    '''
+    Write every segment of the manifest's file that arrived so far into place.
+    Verified segments are deleted, bad ones too so the sender can send them again.
+    Segments in place whose digest is the same in a newer manifest are kept.
+    '''
+    manifest = read_manifest(manifest_path)
+    if manifest is None:
+        return None
+    root = os.path.dirname(manifest_path)
+    journal_path = os.path.join(journal_dir, 'receive-' + segment_digest(os.path.abspath(manifest_path).encode()) + '.json')
+    journal = load_journal(journal_path)
+    target = os.path.join(root, manifest.name + PARTIAL_SUFFIX)
+    # segments the sender skips because it sent them before have to be there already:
+    # without a journal, start from what an earlier transfer of the file left behind
+    fresh = journal.get('segment_size') != manifest.segment_size
+    if fresh and not os.path.exists(target) and os.path.isfile(os.path.join(root, manifest.name)):
+        shutil.copyfile(os.path.join(root, manifest.name), target)
+    seeded = os.path.exists(target)
+    rejected = []  # type: List[int]
+    fd = os.open(target, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size != manifest.size:
+            os.ftruncate(fd, manifest.size)
+        if fresh:
+            digests = hash_segments(target, manifest.segment_size) if seeded else []
+            journal = {'segment_size': manifest.segment_size, 'done': {str(index): digest for index, digest in enumerate(digests)}}
+        in_place = journal['done']  # type: Dict[str, str]
+        done = {index for index, digest in enumerate(manifest.digests) if in_place.get(str(index)) == digest}
+        for index, digest in enumerate(manifest.digests):
+            part = os.path.join(root, part_name(manifest.name, index))
+            if not os.path.exists(part):
+                continue
+            if index not in done:
+                offset = index * manifest.segment_size
+                if write_segment(fd, part, offset, min(manifest.segment_size, manifest.size - offset), digest):
+                    done.add(index)
+                else:
+                    rejected.append(index)
+            os.remove(part)
+        if len(done) == len(manifest.digests):
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    complete = len(done) == len(manifest.digests)
+    if complete:
+        os.replace(target, os.path.join(root, manifest.name))
+        os.remove(manifest_path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+    else:
+        journal['done'] = {str(index): manifest.digests[index] for index in sorted(done)}
+        save_journal(journal_path, journal)
+    return AssembleResult(manifest.name, len(done), len(manifest.digests), rejected, complete)
+
+
+def assemble_all(root=PATH_TO_PUBLIC_DIR, journal_dir=TRANSFER_JOURNAL_DIR) -> List[AssembleResult]:
+    results = []  # type: List[AssembleResult]
+    for name in sorted(os.listdir(root)):
+        if name.endswith(MANIFEST_SUFFIX):
+            result = assemble(os.path.join(root, name), journal_dir)
+            if result is not None:
+                results.append(result)
+    return results
+
+
+def manifest_for(name: str) -> Optional[str]:
+    if name.endswith(MANIFEST_SUFFIX):
+        return name
+    if PART_SUFFIX in name:
+        return name.rpartition(PART_SUFFIX)[0] + MANIFEST_SUFFIX
+    return None
+
+
+def receive(root=PATH_TO_PUBLIC_DIR, journal_dir=TRANSFER_JOURNAL_DIR, on_result: Callable[[AssembleResult], None] = lambda result: None,
+            should_stop: Callable[[], bool] = lambda: False) -> None:
+    '''
+    Assemble segments as rsync moves them into the share until should_stop returns True
+    '''
+    with inotify.Inotify() as watcher:
+        watcher.add_watch(root, inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+        for result in assemble_all(root, journal_dir):
+            on_result(result)
+        while not should_stop():
+            manifests = set()
+            for event in watcher.read_events(timeout=1):
+                name = manifest_for(event.name)
+                if name is not None:
+                    manifests.add(name)
+            for name in sorted(manifests):
+                if os.path.exists(os.path.join(root, name)):
+                    result = assemble(os.path.join(root, name), journal_dir)
+                    if result is not None:
+                        on_result(result)
@@ -0,0 +1,145 @@
+'''
+Parallel multi-stream sending of a file tree to a peer.
+
+The receiving side only allows the forced `rsync --server` command from
+SECURE_OPTIONS, which takes plain files into the root of the share. So the
+tree is flattened into a list of files, split into shards balanced by size
+and file count and every shard is sent by its own rsync process. Files can
+be grouped first (see compression.plan), every group is then sharded and
+sent with its own rsync options.
+'''
+import heapq
+import os
+import subprocess
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from lansync.settings import RSYNC_BINARY, SEND_JOBS, SEND_PER_FILE_COST, SEND_MAX_ARGS_BYTES
+
+
+FileEntry = namedtuple('FileEntry', ['path', 'name', 'size'])
+Shard = namedtuple('Shard', ['files', 'size'])
+# groups of files and the rsync options every group is sent with, see compression.plan
+GroupFiles = Callable[[List[FileEntry]], List[Tuple[List[str], List[FileEntry]]]]
+
+# rsync exit codes of sessions both ends don't agree on, e.g. a peer that
+# imported the key with --compress receiving an uncompressed transfer
+PROTOCOL_ERRORS = (2, 12)
+
+
+class SendError(Exception):
+    pass
+
+
+class SendReport(object):
+    def __init__(self, total_files: int, total_size: int, unit='files'):
+        self.total_files = total_files
+        self.unit = unit
+        self.total_size = total_size
+        self.sent_files = 0
+        self.sent_size = 0
+        self.failed_files = []  # type: List[str]
+        self.returncode = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+def plan_tree(path: str) -> List[FileEntry]:
+    '''
+    Every regular file under path. Names have to be unique as they all end up
+    next to each other in the peer's share.
+    '''
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        return [FileEntry(path, os.path.basename(path), os.path.getsize(path))]
+    if not os.path.isdir(path):
+        raise SendError(f'No such file or directory: {path}')
+    files = []  # type: List[FileEntry]
+    seen = {}  # type: Dict[str, str]
+    stack = [path]
+    while len(stack) > 0:
+        current = stack.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if entry.name in seen:
+                        raise SendError(f'{entry.path} and {seen[entry.name]} would overwrite each other in the share')
+                    seen[entry.name] = entry.path
+                    files.append(FileEntry(entry.path, entry.name, entry.stat(follow_symlinks=False).st_size))
+    return files
+
+
+def shard_files(files: List[FileEntry], shards: int, per_file_cost=SEND_PER_FILE_COST) -> List[Shard]:
+    '''
+    Greedy longest-processing-time split: biggest files first, each into the
+    currently lightest shard. Every file also costs per_file_cost bytes to
+    account for rsync's per-file round trips.
+    '''
+    shards = max(1, min(shards, len(files)))
+    heap = [(0, i) for i in range(shards)]
+    assigned = [[] for _ in range(shards)]  # type: List[List[FileEntry]]
+    for entry in sorted(files, key=lambda f: f.size, reverse=True):
+        load, i = heapq.heappop(heap)
+        assigned[i].append(entry)
+        heapq.heappush(heap, (load + entry.size + per_file_cost, i))
+    return [Shard(shard, sum(f.size for f in shard)) for shard in assigned if len(shard) > 0]
+
+
+def chunk_args(files: List[FileEntry], max_bytes=SEND_MAX_ARGS_BYTES) -> Iterator[List[FileEntry]]:
+    '''
+    Split a shard so a single rsync command line stays well below ARG_MAX
+    '''
+    chunk = []  # type: List[FileEntry]
+    size = 0
+    for entry in files:
+        length = len(os.fsencode(entry.path)) + 1
+        if len(chunk) > 0 and size + length > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(entry)
+        size += length
+    if len(chunk) > 0:
+        yield chunk
+
+
+def rsync_command(files: List[str], peer: str, rsync=RSYNC_BINARY, options: Sequence[str] = ()) -> List[str]:
+    # same invocation the receiver's forced command expects: plain files into the share
+    return [rsync] + list(options) + files + [peer + ':']
+
+
+def send_tree(path: str, peer: str, jobs=SEND_JOBS, rsync=RSYNC_BINARY,
+              on_progress: Optional[Callable[[SendReport], None]] = None,
+              group_files: Optional[GroupFiles] = None) -> SendReport:
+    '''
+    Send every file under path to peer (user@host) over up to jobs concurrent rsync processes.
+    group_files splits the files into groups sent with different rsync options.
+    '''
+    files = plan_tree(path)
+    report = SendReport(len(files), sum(f.size for f in files))
+    lock = threading.Lock()
+    groups = group_files(files) if group_files is not None else [([], files)]
+
+    def run_shard(options: List[str], shard: Shard) -> None:
+        for chunk in chunk_args(shard.files):
+            result = subprocess.run(rsync_command([f.path for f in chunk], peer, rsync, options), stdout=subprocess.DEVNULL)
+            with lock:
+                if result.returncode == 0:
+                    report.sent_files += len(chunk)
+                    report.sent_size += sum(f.size for f in chunk)
+                else:
+                    report.failed_files.extend(f.path for f in chunk)
+                    if report.returncode == 0:
+                        report.returncode = result.returncode
+                if on_progress is not None:
+                    on_progress(report)
+
+    shards = [(options, shard) for options, members in groups for shard in shard_files(members, jobs)]
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(shards)))) as pool:
+        for future in [pool.submit(run_shard, options, shard) for options, shard in shards]:
+            future.result()
+    return report
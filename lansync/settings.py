@@ -7,9 +7,74 @@ PATH_TO_PUBLIC_DIR = os.path.expanduser('~/public/')
 # path to share virtual filesystem
 PATH_TO_PUBLIC_DIR_FILE = os.path.expanduser('~/.lansync/')
 PUBLIC_DIR_FILE_NAME = 'share.img'
+# the share's FAT is sized so that --resize can grow it up to this many times its initial size
+SHARE_GROWTH_FACTOR = 8
+# per file/directory disk usage of the share, see lansync --usage
+USAGE_INDEX_PATH = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'usage.json.gz')
+# warn once the share is this full
+USAGE_SOFT_LIMIT = 0.8
+USAGE_SAVE_INTERVAL = 30
+# downloaded key lists are cached here and revalidated after HTTP_CACHE_TTL seconds
+HTTP_CACHE_DIR = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'cache', 'http')
+HTTP_CACHE_TTL = 3600
+HTTP_MAX_WORKERS = 8
+HTTP_TIMEOUT = 10
+# verdicts of already parsed public keys
+KEY_CACHE_PATH = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'cache', 'validated_keys.json')
+KEY_CACHE_SIZE = 65536
+# batches with more keys to parse than this are validated in a process pool
+PARALLEL_VALIDATION_THRESHOLD = 256
+# keys are validated and written to authorized_keys in batches of this size
+INGEST_BATCH_SIZE = 4096
+# number of import lines whose urls/usernames are downloaded concurrently
+FETCH_WINDOW = 64
+# lansync send: rsync processes run concurrently, each file also counts as this many bytes when balancing them
+RSYNC_BINARY = 'rsync'
+SEND_JOBS = 4
+SEND_PER_FILE_COST = 64 * 1024
+# keep every rsync command line well below ARG_MAX
+SEND_MAX_ARGS_BYTES = 128 * 1024
+# lansync send --segmented: size of the pieces a single file is cut into, journals of interrupted transfers
+SEGMENT_SIZE = 64 * 2**20
+TRANSFER_JOURNAL_DIR = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'transfers')
+# lansync discover announces itself every DISCOVERY_INTERVAL seconds, peers not heard from for PEER_TTL seconds are forgotten
+DISCOVERY_PORT = 47474
+DISCOVERY_GROUP = '239.255.76.83'
+DISCOVERY_INTERVAL = 10
+PEER_TTL = 60
+PEER_CACHE_PATH = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'peers.json')
+# lansync sync: source bytes scanned for matching blocks per numpy pass, cached signatures of destination files
+DELTA_WINDOW = 2 * 2**20
+SIGNATURE_CACHE_DIR = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'cache', 'signatures')
+# chunk store and index of lansync dedup
+DEDUP_DIR = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'dedup')
+# lansync verify: files are hashed in pieces of this size in parallel, digests of the share are kept in the manifest
+HASH_CHUNK_SIZE = 8 * 2**20
+MANIFEST_PATH = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'manifest.json.gz')
+# lansync watch: seconds a file has to be quiet before it is sent (at most WATCH_MAX_DELAY after it started changing),
+# limits of a single batch, retry backoff of a failing peer and where what is left to send is kept
+WATCH_DEBOUNCE = 2
+WATCH_MAX_DELAY = 30
+WATCH_BATCH_FILES = 10000
+WATCH_BATCH_BYTES = 2**30
+WATCH_RETRY = 5
+WATCH_RETRY_MAX = 300
+WATCH_SAVE_INTERVAL = 5
+WATCH_STATE_DIR = os.path.join(PATH_TO_PUBLIC_DIR_FILE, 'watch')
+# lansync send --compress: bytes per second assumed for the link when the interface doesn't report its speed (1 Gbit/s),
+# and how much faster than sending uncompressed a class of files has to get to be compressed
+LINK_SPEED = 125 * 10**6
+COMPRESSION_CODECS = ['zlib', 'zstd', 'lz4']
+COMPRESS_MIN_GAIN = 1.1
+# lansync --metrics-port only listens locally
+METRICS_ADDRESS = '127.0.0.1'
 # options to limit the permissions of the authorized key. change with care!
-SECURE_OPTIONS = 'command="rsync --server -e.LsfxC . ' + PATH_TO_PUBLIC_DIR + '",no-pty,no-agent-forwarding,no-port-forwarding'
+# lansync --import --compress puts z (and the codec) in front of SERVER_FLAGS
+SERVER_FLAGS = '-e.LsfxC'
+SECURE_OPTIONS = 'command="rsync --server ' + SERVER_FLAGS + ' . ' + PATH_TO_PUBLIC_DIR + '",no-pty,no-agent-forwarding,no-port-forwarding'
 
 AUTHORIZED_KEYS_PATH = os.path.expanduser('~/.ssh/authorized_keys')
+# fingerprint index of authorized_keys is kept next to it with this suffix
+AUTHORIZED_KEYS_INDEX_SUFFIX = '.lansync-index'
 CURRENT_USER = getpass.getuser()
 
@@ -0,0 +1,90 @@
+import gzip
+import os
+import random
+import sys
+sys.path.append('.')
+from compression import CLASS_BINARY, CLASS_COMPRESSED, CLASS_TEXT, Choice, choose, classify, classify_files, client_options, link_speed, plan, secure_options
+from keystore import KeyStore
+from send import FileEntry, send_tree
+from settings import SECURE_OPTIONS
+from test_send import fake_rsync  # noqa: F401
+
+
+def log_lines(count, seed=0):
+    rng = random.Random(seed)
+    return ''.join(f'2024-05-{rng.randint(1, 28):02d} 12:00:{rng.randint(0, 59):02d} INFO worker-{rng.randint(0, 9)} handled request {rng.randint(0, 10**6)}\n'
+                   for _ in range(count)).encode()
+
+
+def records(count, seed=0):
+    # fixed width records, most of every one noise
+    rng = random.Random(seed)
+    return b''.join(b'REC' + i.to_bytes(4, 'little') + bytes(rng.getrandbits(8) for _ in range(21)) + bytes(4) for i in range(count))
+
+
+def write(root, name, data):
+    path = root / name
+    path.write_bytes(data)
+    return FileEntry(str(path), name, len(data))
+
+
+class TestCompression(object):
+    def test_classify(self):
+        assert classify([log_lines(1000)]) == CLASS_TEXT
+        assert classify([records(2000)]) == CLASS_BINARY
+        assert classify([os.urandom(65536)]) == CLASS_COMPRESSED
+        # compressed formats are known by their magic bytes, whatever the entropy
+        assert classify([gzip.compress(bytes(65536))]) == CLASS_COMPRESSED
+        assert classify([b'\x00\x00\x00\x18ftypmp42' + bytes(1000)]) == CLASS_COMPRESSED
+
+    def test_choice_depends_on_link_speed(self):
+        text = log_lines(20000)
+        slow = choose('zlib', text, 10**6, 1)
+        assert slow.level is not None and slow.ratio > 2
+        # nothing compresses fast enough to beat a link this fast
+        assert choose('zlib', text, 10**12, 1).level is None
+        assert choose('zlib', os.urandom(2**20), 10**6, 1).level is None
+
+    def test_plan(self, tmp_path):
+        files = [write(tmp_path, 'app.log', log_lines(5000)), write(tmp_path, 'movie.mp4', os.urandom(50000)),
+                 write(tmp_path, 'blob', os.urandom(50000)), write(tmp_path, 'empty', b'')]
+        assert {kind: sorted(f.name for f in members) for kind, (members, _) in classify_files(files).items()} == {
+            CLASS_TEXT: ['app.log'], CLASS_COMPRESSED: ['blob', 'empty', 'movie.mp4']}
+        groups = {group.kind: group for group in plan(files, 'zlib', speed=10**6)}
+        assert groups[CLASS_TEXT].options[:2] == ['-z', '--compress-level=' + str(groups[CLASS_TEXT].choice.level)]
+        assert groups[CLASS_COMPRESSED].choice.level is None
+        assert groups[CLASS_COMPRESSED].options == ['-z', '--compress-level=1', '--skip-compress=mp4']
+
+    def test_client_and_server_options_agree(self, tmp_path):
+        assert client_options(Choice('zstd', 3, 2.0, 1.0), []) == ['-z', '--compress-choice=zstd', '--compress-level=3']
+        assert secure_options(None) == SECURE_OPTIONS
+        assert 'rsync --server -ze.LsfxC . ' in secure_options('zlib')
+        assert 'rsync --server -ze.LsfxC --compress-choice=zstd . ' in secure_options('zstd')
+        store = KeyStore(str(tmp_path / 'authorized_keys'), options=secure_options('zlib'))
+        store.import_keys(['ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIKaMwL2RuYbhwZZnCTxwOVQzUXOMQ1W0ry3Z5nMzFbmv test@lansync'])
+        assert (tmp_path / 'authorized_keys').read_text().startswith(secure_options('zlib') + ' ssh-ed25519 ')
+
+    def test_link_speed(self, tmp_path):
+        (tmp_path / 'eth0').mkdir()
+        (tmp_path / 'eth0' / 'speed').write_text('1000\n')
+        (tmp_path / 'wlan0').mkdir()
+        (tmp_path / 'wlan0' / 'speed').write_text('-1\n')
+        assert link_speed('eth0', str(tmp_path)) == 125 * 10**6
+        assert link_speed('wlan0', str(tmp_path)) is None
+        assert link_speed('nope', str(tmp_path)) is None
+
+    def test_send_groups(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        (tmp_path / 'src').mkdir()
+        write(tmp_path / 'src', 'app.log', log_lines(5000))
+        write(tmp_path / 'src', 'photo.jpg', b'\xff\xd8\xff' + os.urandom(5000))
+
+        def group_files(files):
+            return [(group.options, group.files) for group in plan(files, 'zlib', speed=10**6, jobs=2)]
+
+        report = send_tree(str(tmp_path / 'src'), 'user@10.0.0.1', jobs=2, rsync=rsync, group_files=group_files)
+        assert report.ok and report.sent_files == 2
+        assert sorted(os.listdir(str(share))) == ['app.log', 'photo.jpg']
+        options = (tmp_path / 'rsync-options').read_text().splitlines()
+        assert len(options) == 2 and '-z --compress-level=1 --skip-compress=jpg' in options
+        assert all(line.startswith('-z --compress-level=') for line in options)
@@ -0,0 +1,142 @@
+import os
+import random
+import sys
+import pytest
+sys.path.append('.')
+np = pytest.importorskip('numpy')
+import dedup
+from dedup import ALIGN, MAX_CHUNK, MIN_CHUNK, DedupError, DedupStore, chunk_boundaries, chunk_file, supports_reflink
+
+
+def boundaries(data):
+    return list(chunk_boundaries(np.frombuffer(data, dtype=np.uint8)))
+
+
+@pytest.fixture
+def clones(monkeypatch):
+    '''
+    Byte copying stand-ins for the reflink ioctls, which the filesystem running the tests may not have
+    '''
+    calls = []
+
+    def clone_range(src_fd, src_offset, length, dest_fd, dest_offset):
+        if length == 0:
+            length = os.fstat(src_fd).st_size - src_offset
+        calls.append(length)
+        os.pwrite(dest_fd, os.pread(src_fd, length, src_offset), dest_offset)
+
+    def dedupe_range(src_fd, length, dest_fd, dest_offset):
+        return os.pread(src_fd, length, 0) == os.pread(dest_fd, length, dest_offset)
+
+    monkeypatch.setattr(dedup, 'clone_range', clone_range)
+    monkeypatch.setattr(dedup, 'dedupe_range', dedupe_range)
+    return calls
+
+
+@pytest.fixture
+def store(tmp_path, clones):
+    (tmp_path / 'share').mkdir()
+    store = DedupStore(str(tmp_path / 'share'), str(tmp_path / 'store'))
+    store.load()
+    clones.clear()
+    return store
+
+
+def write(store, name, data):
+    path = os.path.join(store.root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class TestDedup(object):
+    def test_chunk_sizes(self):
+        data = os.urandom(4 * 2**20 + 100)
+        ends = boundaries(data)
+        sizes = np.diff([0] + ends)
+        assert ends[-1] == len(data)
+        assert all(end % ALIGN == 0 for end in ends[:-1])
+        assert sizes[:-1].min() >= MIN_CHUNK and sizes.max() <= MAX_CHUNK
+
+    def test_chunks_survive_an_insertion(self):
+        # seeded - how many chunks around the insertion change depends on the data
+        rng = random.Random(0)
+        data = rng.getrandbits(8 * 2 * 2**20).to_bytes(2 * 2**20, 'little')
+        inserted = data[:100000] + rng.getrandbits(8 * ALIGN).to_bytes(ALIGN, 'little') + data[100000:]
+        before = set(boundaries(data))
+        after = set(end - ALIGN for end in boundaries(inserted))
+        assert len(before & after) >= len(before) - 2
+
+    def test_chunk_file_digests(self, tmp_path):
+        data = os.urandom(300 * 1024)
+        (tmp_path / 'a').write_bytes(data)
+        (tmp_path / 'b').write_bytes(data[:200 * 1024] + b'changed' + data[200 * 1024 + 7:])
+        a, b = chunk_file(str(tmp_path / 'a')), chunk_file(str(tmp_path / 'b'))
+        assert sum(chunk.length for chunk in a) == len(data)
+        assert a[0].digest == b[0].digest
+        assert [chunk.digest for chunk in a] != [chunk.digest for chunk in b]
+
+    def test_identical_files_stay_separate(self, store):
+        data = os.urandom(100 * 1024)
+        paths = [write(store, name, data) for name in ['one.img', 'two.img', 'sub/three.img']]
+        stats = store.update()
+        assert len({os.stat(path).st_ino for path in paths}) == 3
+        assert (stats.files, stats.logical, stats.stored, stats.changed) == (3, 3 * len(data), len(data), 3)
+        # what lansync sync does: write into the file in place
+        with open(paths[0], 'r+b') as f:
+            f.write(b'changed')
+        assert open(paths[1], 'rb').read() == data
+
+    def test_hardlinks_are_broken(self, store):
+        path = write(store, 'one.img', os.urandom(50 * 1024))
+        os.link(path, os.path.join(store.root, 'two.img'))
+        store.update()
+        assert os.stat(path).st_ino != os.stat(os.path.join(store.root, 'two.img')).st_ino
+        assert os.stat(path).st_nlink == 1
+
+    def test_update_only_touches_changed_files(self, store):
+        for name in ['a', 'b', 'c']:
+            write(store, name, os.urandom(50 * 1024))
+        store.update()
+        store.save()
+
+        reloaded = DedupStore(store.root, store.store_dir)
+        reloaded.load()
+        assert reloaded.update().changed == 0
+        write(store, 'a', os.urandom(10 * 1024))
+        os.remove(os.path.join(store.root, 'b'))
+        stats = reloaded.update()
+        assert stats.changed == 2
+        assert stats.collected == 100 * 1024
+        assert (stats.files, stats.stored) == (2, 60 * 1024)
+
+    def test_changed_file_keeps_its_unchanged_chunks(self, store, clones):
+        rng = random.Random(0)
+        data = rng.getrandbits(8 * 2**20).to_bytes(2**20, 'little')
+        path = write(store, 'disk.img', data)
+        store.update()
+        before = {chunk.digest: chunk.length for chunk in chunk_file(path)}
+        clones.clear()
+        with open(path, 'r+b') as f:
+            f.seek(len(data) - 1000)
+            f.write(b'x' * 1000)
+        stats = store.update()
+        after = {chunk.digest: chunk.length for chunk in chunk_file(path)}
+        # only the chunks that are gone are collected, and only new ones are cloned into the store
+        assert stats.collected == sum(length for digest, length in before.items() if digest not in after)
+        assert sorted(clones) == sorted(length for digest, length in after.items() if digest not in before)
+        assert all(os.path.exists(store.object_path(digest)) for digest in after)
+
+    def test_refuses_without_reflinks(self, tmp_path):
+        (tmp_path / 'share').mkdir()
+        if supports_reflink(str(tmp_path / 'share'), str(tmp_path / 'store')):
+            pytest.skip('the filesystem running the tests has reflinks')
+        with pytest.raises(DedupError):
+            DedupStore(str(tmp_path / 'share'), str(tmp_path / 'store')).load()
+        assert os.listdir(str(tmp_path / 'share')) == []
+
+    def test_supports_reflink(self, tmp_path):
+        (tmp_path / 'share').mkdir()
+        assert supports_reflink(str(tmp_path / 'share'), str(tmp_path / 'store')) in (True, False)
+        assert os.listdir(str(tmp_path / 'share')) == os.listdir(str(tmp_path / 'store')) == []
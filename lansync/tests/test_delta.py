@@ -0,0 +1,86 @@
+import os
+import pytest
+import sys
+sys.path.append('.')
+np = pytest.importorskip('numpy')
+from delta import Copy, Literal, SignatureCache, block_checksums, delta, rolling_checksums, signature, sync_file
+
+
+def as_array(data):
+    return np.frombuffer(bytes(data), dtype=np.uint8)
+
+
+def apply(basis, data, ops, block_size):
+    out = b''
+    for op in ops:
+        if isinstance(op, Copy):
+            out += basis[op.block * block_size:(op.block + op.count) * block_size]
+        else:
+            out += data[op.offset:op.offset + op.length]
+    return out
+
+
+class TestDelta(object):
+    def test_rolling_checksums_match_block_checksums(self):
+        data = as_array(os.urandom(10 * 1000 + 123))
+        rolling = rolling_checksums(data, 1000)
+        assert len(rolling) == len(data) - 1000 + 1
+        assert list(rolling[::1000][:10]) == list(block_checksums(data, 1000)[:10])
+        window = data[17:1017].astype(np.int64)
+        a = int(window.sum()) & 0xffff
+        b = int((window * np.arange(1000, 0, -1)).sum()) & 0xffff
+        assert rolling[17] == a | b << 16
+
+    def test_delta_of_shifted_and_changed_data(self, tmp_path):
+        basis = os.urandom(50 * 1024 + 300)
+        changed = bytearray(basis)
+        changed[10:10] = b'inserted'
+        changed[30 * 1024:30 * 1024 + 5] = b'12345'
+        (tmp_path / 'basis').write_bytes(basis)
+        sig = signature(str(tmp_path / 'basis'), 1024)
+        ops = delta(as_array(changed), sig, window=8 * 1024)
+        assert apply(basis, bytes(changed), ops, 1024) == bytes(changed)
+        literal = sum(op.length for op in ops if isinstance(op, Literal))
+        assert literal < 3 * 1024
+        # the short last block is matched too
+        assert isinstance(ops[-1], Copy) and ops[-1].block + ops[-1].count == 51
+
+    def test_inplace_delta_never_reads_overwritten_blocks(self, tmp_path):
+        basis = os.urandom(20 * 1024)
+        # blocks moved towards the start can't be copied in place
+        changed = basis[8 * 1024:] + basis[:8 * 1024]
+        (tmp_path / 'basis').write_bytes(basis)
+        ops = delta(as_array(changed), signature(str(tmp_path / 'basis'), 1024), inplace=True)
+        out = 0
+        for op in ops:
+            if isinstance(op, Copy):
+                assert op.block * 1024 >= out
+                out += op.count * 1024
+            else:
+                out += op.length
+
+    def test_sync_file_only_writes_changes(self, tmp_path):
+        src, dest = tmp_path / 'src.img', tmp_path / 'dest.img'
+        data = bytearray(os.urandom(256 * 1024))
+        dest.write_bytes(bytes(data))
+        data[100 * 1024:100 * 1024 + 10] = b'x' * 10
+        data += b'appended'
+        src.write_bytes(bytes(data))
+        cache = SignatureCache(str(tmp_path / 'cache'))
+        result = sync_file(str(src), str(dest), 4096, cache)
+        assert dest.read_bytes() == bytes(data)
+        assert result.written <= 2 * 4096 + 8
+        assert result.matched + result.literal == len(data)
+        again = sync_file(str(src), str(dest), 4096, cache)
+        assert (again.literal, again.written) == (0, 0)
+
+    def test_sync_file_into_directory_and_shrink(self, tmp_path):
+        (tmp_path / 'share').mkdir()
+        src = tmp_path / 'file'
+        src.write_bytes(os.urandom(10000))
+        cache = SignatureCache(str(tmp_path / 'cache'))
+        sync_file(str(src), str(tmp_path / 'share'), 1000, cache)
+        assert (tmp_path / 'share' / 'file').read_bytes() == src.read_bytes()
+        src.write_bytes(src.read_bytes()[:4500])
+        sync_file(str(src), str(tmp_path / 'share'), 1000, cache)
+        assert (tmp_path / 'share' / 'file').read_bytes() == src.read_bytes()
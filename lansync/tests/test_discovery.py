@@ -0,0 +1,56 @@
+import socket
+import sys
+sys.path.append('.')
+from discovery import Beacon, DiscoveryDaemon, PeerCache, decode_beacon, encode_beacon
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def beacon(user='alice', instance=b'12345678'):
+    return Beacon(instance, user, 'laptop', 10 * 2**30, 4 * 2**30)
+
+
+class TestDiscovery(object):
+    def test_beacon_round_trip(self):
+        data = encode_beacon(beacon())
+        assert len(data) < 64
+        assert decode_beacon(data) == beacon()
+
+    def test_garbage_is_not_a_beacon(self):
+        data = encode_beacon(beacon())
+        assert decode_beacon(b'') is None
+        assert decode_beacon(b'XXXX' + data[4:]) is None
+        assert decode_beacon(data[:-1]) is None
+
+    def test_peers_expire(self, tmp_path):
+        clock = FakeClock()
+        cache = PeerCache(str(tmp_path / 'peers.json'), ttl=60, clock=clock)
+        assert cache.update(beacon(), '10.0.0.2')
+        assert not cache.update(beacon(), '10.0.0.2')
+        clock.now += 30
+        cache.update(beacon('bob'), '10.0.0.3')
+        cache.save()
+
+        loaded = PeerCache(str(tmp_path / 'peers.json'), ttl=60, clock=clock)
+        loaded.load()
+        assert [(peer.user, peer.address, peer.free) for peer in loaded.peers()] == [('alice', '10.0.0.2', 4 * 2**30), ('bob', '10.0.0.3', 4 * 2**30)]
+        clock.now += 40
+        assert [peer.user for peer in loaded.peers()] == ['bob']
+
+    def test_daemon_hears_beacons_but_not_itself(self, tmp_path):
+        cache = PeerCache(str(tmp_path / 'peers.json'))
+        found = []
+        with DiscoveryDaemon(cache, port=0, bind_address='127.0.0.1', on_peer=found.append) as daemon:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+                sender.sendto(encode_beacon(beacon()), ('127.0.0.1', daemon.port))
+                sender.sendto(b'not a beacon', ('127.0.0.1', daemon.port))
+                sender.sendto(encode_beacon(beacon('me', daemon.instance)), ('127.0.0.1', daemon.port))
+            daemon.poll(0.2)
+        assert [(peer.user, peer.address, peer.host) for peer in found] == [('alice', '127.0.0.1', 'laptop')]
+        assert len(cache.peers()) == 1
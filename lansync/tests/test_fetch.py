@@ -0,0 +1,126 @@
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append('.')
+from fetch import Fetcher
+
+
+class KeysHandler(BaseHTTPRequestHandler):
+    '''
+    Local stand-in for https://github.com/<user>.keys
+    '''
+    protocol_version = 'HTTP/1.1'
+    etag = '"v1"'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == '/missing.keys':
+            self._reply(404, b'Not Found')
+        elif self.path == '/moved.keys':
+            self.send_response(301)
+            self.send_header('Location', '/user0.keys')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == self.etag:
+            self.server.revalidated += 1
+            self.send_response(304)
+            if self.server.etag_on_304:
+                self.send_header('ETag', self.etag)
+            self.end_headers()
+        else:
+            self._reply(200, ('ssh-rsa AAAA' + self.path + ' user@host\n').encode('utf-8'))
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetcher(object):
+    def start_server(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeysHandler)
+        server.daemon_threads = True
+        server.requests = []
+        server.connections = 0
+        server.revalidated = 0
+        server.etag_on_304 = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, 'http://127.0.0.1:' + str(server.server_address[1])
+
+    def test_fetch_all_fetches_each_url_once(self, tmp_path):
+        server, base = self.start_server()
+        urls = [base + '/user' + str(i) + '.keys' for i in range(50)]
+        with Fetcher(cache_dir=str(tmp_path), max_workers=4) as fetcher:
+            responses = fetcher.fetch_all(urls + urls)
+            assert sorted(responses) == sorted(urls)
+            for url in urls:
+                assert responses[url].status == 200
+                assert responses[url].body.startswith(b'ssh-rsa AAAA/user')
+            fetcher.fetch(urls[0])
+        server.shutdown()
+        assert len(server.requests) == 50
+        # keep-alive: at most one connection per worker thread
+        assert server.connections <= 4
+
+    def test_responses_in_memory_are_bounded(self, tmp_path):
+        server, base = self.start_server()
+        urls = [base + '/user' + str(i) + '.keys' for i in range(10)]
+        with Fetcher(cache_dir=str(tmp_path), max_responses=4) as fetcher:
+            fetcher.fetch_all(urls)
+            kept = list(fetcher._responses)
+            assert len(kept) == 4
+            # served from memory, then dropped
+            assert fetcher.take(kept[0]).status == 200
+            assert list(fetcher._responses) == kept[1:]
+        server.shutdown()
+        assert len(server.requests) == 10
+
+    def test_missing_url_and_redirect(self, tmp_path):
+        server, base = self.start_server()
+        with Fetcher(cache_dir=str(tmp_path)) as fetcher:
+            assert fetcher.fetch(base + '/missing.keys').status == 404
+            moved = fetcher.fetch(base + '/moved.keys')
+            assert moved.status == 200
+            assert moved.body == b'ssh-rsa AAAA/user0.keys user@host\n'
+        server.shutdown()
+
+    def test_cache_is_fresh_then_revalidated(self, tmp_path):
+        server, base = self.start_server()
+        url = base + '/user0.keys'
+        with Fetcher(cache_dir=str(tmp_path)) as fetcher:
+            body = fetcher.fetch(url).body
+        with Fetcher(cache_dir=str(tmp_path)) as fetcher:
+            assert fetcher.fetch(url).body == body
+        assert len(server.requests) == 1
+
+        with Fetcher(cache_dir=str(tmp_path), ttl=0) as fetcher:
+            response = fetcher.fetch(url)
+        server.shutdown()
+        assert response.status == 200
+        assert response.body == body
+        assert server.revalidated == 1
+
+    def test_revalidation_keeps_validators_the_304_left_out(self, tmp_path):
+        server, base = self.start_server()
+        server.etag_on_304 = False
+        url = base + '/user0.keys'
+        for _ in range(3):
+            with Fetcher(cache_dir=str(tmp_path), ttl=0) as fetcher:
+                assert fetcher.fetch(url).status == 200
+        server.shutdown()
+        assert server.revalidated == 2
+
+    def test_unreachable_host_reports_error(self, tmp_path):
+        with Fetcher(cache_dir=str(tmp_path), timeout=1) as fetcher:
+            response = fetcher.fetch('http://127.0.0.1:1/user.keys')
+        assert response.status is None
+        assert response.error is not None
@@ -0,0 +1,125 @@
+import os
+import pytest
+import struct
+import sys
+sys.path.append('.')
+from image import compact_image, create_image, get_geometry, get_partition_offset, image_usage, read_geometry, resize_image, SECTOR_SIZE
+
+
+class TestImage(object):
+    def test_partition_offset(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        create_image(path, 10 * 2**20)
+        assert os.path.getsize(path) == 10 * 2**20
+        assert get_partition_offset(path) == 2**20
+
+    def test_boot_sector(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        geometry = create_image(path, 300 * 2**20)
+        with open(path, 'rb') as f:
+            f.seek(get_partition_offset(path))
+            boot = f.read(SECTOR_SIZE)
+        assert boot[510:512] == b'\x55\xaa'
+        assert boot[82:90] == b'FAT32   '
+        bytes_per_sector, spc, reserved, fats = struct.unpack_from('<HBHB', boot, 11)
+        total_sectors, fat_sectors = struct.unpack_from('<II', boot, 32)
+        assert (bytes_per_sector, spc, fats) == (512, geometry.sectors_per_cluster, 2)
+        assert total_sectors == geometry.partition_sectors
+        assert fat_sectors * SECTOR_SIZE // 4 >= geometry.cluster_count + 2
+
+    def test_recreating_clears_old_contents(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        with open(path, 'wb') as f:
+            f.write(b'\xff' * 4 * 2**20)
+        create_image(path, 4 * 2**20)
+        with open(path, 'rb') as f:
+            f.seek(2 * 2**20)
+            assert f.read(2**20) == bytes(2**20)
+
+    def test_mounted_image_is_not_recreated(self, tmp_path, monkeypatch):
+        import image
+        path = str(tmp_path / 'share.img')
+        with open(path, 'wb') as f:
+            f.write(b'\xff' * 4 * 2**20)
+        monkeypatch.setattr(image, 'is_attached', lambda p: p == path)
+        with pytest.raises(ValueError):
+            create_image(path, 4 * 2**20)
+        assert open(path, 'rb').read() == b'\xff' * 4 * 2**20
+
+    def test_unpartitioned_image_starts_at_zero(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        boot = bytearray(SECTOR_SIZE)
+        boot[82:90] = b'FAT32   '
+        boot[510:512] = b'\x55\xaa'
+        open(path, 'wb').write(bytes(boot))
+        assert get_partition_offset(path) == 0
+
+    def test_too_small(self):
+        with pytest.raises(ValueError):
+            get_geometry(32 * 1024)
+
+    def test_small_image(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        geometry = create_image(path, 2**20)
+        # too small to start the partition at 1MiB
+        assert get_partition_offset(path) == 4096
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            assert read_geometry(fd) == geometry
+        finally:
+            os.close(fd)
+        assert resize_image(path, 2 * 2**20).partition_start == geometry.partition_start
+
+    def test_thin_image_is_sparse(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        create_image(path, 256 * 2**20, thin=True)
+        usage = image_usage(path)
+        assert usage.logical == 256 * 2**20
+        assert usage.physical < 2**20
+
+    def test_resize_grows_filesystem(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        old = create_image(path, 64 * 2**20, thin=True)
+        new = resize_image(path, 128 * 2**20, thin=True)
+        assert os.path.getsize(path) == 128 * 2**20
+        assert new.cluster_count > old.cluster_count
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            assert read_geometry(fd) == new
+            free, = struct.unpack('<I', os.pread(fd, 4, 2**20 + SECTOR_SIZE + 488))
+        finally:
+            os.close(fd)
+        assert free == new.cluster_count - 1
+        with pytest.raises(ValueError):
+            resize_image(path, 32 * 2**20)
+        with pytest.raises(ValueError):
+            resize_image(path, 64 * 64 * 2**20)
+
+    def test_resize_keeps_thin_and_thick_images(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        create_image(path, 4 * 2**20, thin=True)
+        resize_image(path, 8 * 2**20)
+        assert image_usage(path).physical < 2**20
+        create_image(path, 4 * 2**20)
+        resize_image(path, 8 * 2**20)
+        assert image_usage(path).physical >= 8 * 2**20
+        create_image(path, 4 * 2**20, thin=True)
+        resize_image(path, 8 * 2**20, thin=False)
+        assert image_usage(path).physical >= 4 * 2**20
+
+    def test_compact_releases_free_clusters(self, tmp_path):
+        path = str(tmp_path / 'share.img')
+        geometry = create_image(path, 64 * 2**20, thin=True)
+        data_start = 2**20 + (32 + 2 * geometry.fat_sectors) * SECTOR_SIZE
+        with open(path, 'r+b') as f:
+            # data left behind by deleted files - its clusters are free in the FAT
+            f.seek(data_start + 2**20)
+            f.write(b'\xff' * 8 * 2**20)
+        before = image_usage(path).physical
+        released = compact_image(path)
+        assert released >= 7 * 2**20
+        assert image_usage(path).physical == before - released
+        assert image_usage(path).peak == before
+        with open(path, 'rb') as f:
+            f.seek(data_start + 2**20)
+            assert f.read(8 * 2**20) == bytes(8 * 2**20)
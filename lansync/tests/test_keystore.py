@@ -0,0 +1,105 @@
+import os
+import sys
+sys.path.append('.')
+from keystore import KeyStore, fingerprint, line_options
+from lansync.settings import SECURE_OPTIONS
+
+
+class TestKeyStore(object):
+    pub_key_file_path = 'tests/data/id_rsa.pub'
+    auth_keys_file_path = 'tests/data/authorized_keys'
+
+    def valid_key(self):
+        return open(self.pub_key_file_path, 'r').readline().replace('\n', '')
+
+    def test_fingerprint_ignores_options_and_comment(self):
+        key = self.valid_key()
+        blob = ' '.join(key.split(' ')[:2])
+        assert fingerprint(key) == fingerprint(blob)
+        assert fingerprint(key) == fingerprint(SECURE_OPTIONS + ' ' + blob + ' other@host')
+
+    def test_existing_keys_are_indexed(self):
+        store = KeyStore(self.auth_keys_file_path)
+        assert len(store) > 0
+        for line in open(self.auth_keys_file_path, 'r'):
+            if line.strip() != '':
+                assert store.is_imported(line)
+
+    def test_missing_file_is_empty(self, tmp_path):
+        store = KeyStore(str(tmp_path / 'authorized_keys'))
+        assert len(store) == 0
+        assert not store.is_imported(self.valid_key())
+
+    def test_import_keys_dedupes_batch(self, tmp_path):
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        keys = ['ssh-rsa AAAA' + str(i) + ' user@host' for i in range(100)]
+        result = KeyStore(auth_keys_path).import_keys(keys + keys[:10])
+        assert result.imported == 100
+        assert result.skipped == 10
+        lines = open(auth_keys_path, 'r').readlines()
+        assert lines == [SECURE_OPTIONS + ' ' + key + '\n' for key in keys]
+
+        result = KeyStore(auth_keys_path).import_keys(keys)
+        assert result.imported == 0
+        assert result.skipped == 100
+
+    def test_import_keys_fixes_missing_newline(self, tmp_path):
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        open(auth_keys_path, 'w').write('ssh-rsa AAAAexisting user@host')
+        KeyStore(auth_keys_path).import_keys(['ssh-rsa AAAAnew user@host'])
+        lines = open(auth_keys_path, 'r').readlines()
+        assert lines == ['ssh-rsa AAAAexisting user@host\n', SECURE_OPTIONS + ' ssh-rsa AAAAnew user@host\n']
+
+    def test_import_keys_updates_options(self, tmp_path):
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        zstd_options = SECURE_OPTIONS.replace('-e.LsfxC', '-ze.LsfxC --compress-choice=zstd')
+        open(auth_keys_path, 'w').write('ssh-rsa AAAAmine user@host\n# comment\n' + SECURE_OPTIONS + ' ssh-rsa AAAA1 user@host\n')
+        store = KeyStore(auth_keys_path, persist_index=True, options=zstd_options)
+        assert store.index[fingerprint('ssh-rsa AAAA1')] == SECURE_OPTIONS
+        result = store.import_keys(['ssh-rsa AAAA1 user@host', 'ssh-rsa AAAAmine user@host', 'ssh-rsa AAAA2 user@host', 'ssh-rsa AAAA1 user@host'])
+        assert (result.imported, result.updated, result.skipped) == (1, 1, 2)
+        # keys added by hand keep their options
+        assert open(auth_keys_path, 'r').readlines() == ['ssh-rsa AAAAmine user@host\n', '# comment\n', zstd_options + ' ssh-rsa AAAA1 user@host\n',
+                                                         zstd_options + ' ssh-rsa AAAA2 user@host\n']
+        assert KeyStore(auth_keys_path, persist_index=True).index == store.index
+        assert KeyStore(auth_keys_path, options=zstd_options).import_keys(['ssh-rsa AAAA1 user@host']).skipped == 1
+        assert line_options('ssh-rsa AAAA1 user@host') == ''
+
+    def test_persisted_index_is_reused(self, tmp_path):
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        store = KeyStore(auth_keys_path, persist_index=True)
+        store.import_keys(['ssh-rsa AAAA1 user@host'])
+        store.import_keys(['ssh-rsa AAAA2 user@host'])
+        # only written when saved, not after every import
+        assert not os.path.exists(store.index_path)
+        store.save()
+        reloaded = KeyStore(auth_keys_path, persist_index=True)
+        assert reloaded.index == store.index
+        assert reloaded.is_imported('ssh-rsa AAAA2 user@host')
+
+        # changes behind our back invalidate the persisted index
+        open(auth_keys_path, 'a').write('ssh-rsa AAAA3 user@host\n')
+        reloaded = KeyStore(auth_keys_path, persist_index=True)
+        assert reloaded.is_imported('ssh-rsa AAAA3 user@host')
+
+    def test_index_of_a_file_changed_since_is_not_saved(self, tmp_path):
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        store = KeyStore(auth_keys_path, persist_index=True)
+        store.import_keys(['ssh-rsa AAAA1 user@host'])
+        open(auth_keys_path, 'a').write('ssh-rsa AAAA2 user@host\n')
+        store.save()
+        assert not os.path.exists(store.index_path)
+
+    def test_single_key_functions_share_a_store(self, tmp_path, monkeypatch):
+        from utilities import get_key_store, import_key, is_key_imported
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        import_key('ssh-rsa AAAA1 user@host', auth_keys_path)
+        store = get_key_store(auth_keys_path)
+        monkeypatch.setattr(store, 'load', lambda: (_ for _ in ()).throw(AssertionError('read again')))
+        assert is_key_imported('ssh-rsa AAAA1 user@host', auth_keys_path)
+        import_key('ssh-rsa AAAA2 user@host', auth_keys_path)
+        assert get_key_store(auth_keys_path) is store
+        monkeypatch.undo()
+        # only read again once someone else changed the file
+        open(auth_keys_path, 'a').write('ssh-rsa AAAA3 user@host\n')
+        assert is_key_imported('ssh-rsa AAAA3 user@host', auth_keys_path)
@@ -0,0 +1,78 @@
+import json
+import sys
+import urllib.request
+import pytest
+sys.path.append('.')
+from lansync import metrics
+from keystore import KeyStore
+
+
+KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIKaMwL2RuYbhwZZnCTxwOVQzUXOMQ1W0ry3Z5nMzFbmv test@lansync'
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    path = tmp_path / 'lansync.log'
+    metrics.configure(str(path), level='debug')
+    yield path
+    metrics.shutdown()
+
+
+def read_log(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+class TestMetrics(object):
+    def test_disabled_by_default(self, capsys):
+        assert not metrics.enabled()
+        metrics.counter('keys_written', 3)
+        with metrics.timer('fetch', host='github.com') as timer:
+            pass
+        assert timer is metrics.NULL_TIMER
+        metrics.log('hello', metrics.WARNING, url='x')
+        assert capsys.readouterr().out == 'hello\n'
+
+    def test_log_lines(self, log_path, capsys):
+        metrics.log('Couldn\'t read file', metrics.ERROR, path='/nope')
+        metrics.log('debug only', metrics.DEBUG)
+        metrics.write(metrics.INFO, 'ingest', imported=2)
+        assert capsys.readouterr().out == 'Couldn\'t read file\n'
+        records = read_log(log_path)
+        assert [(r['level'], r['msg']) for r in records] == [('error', 'Couldn\'t read file'), ('debug', 'debug only'), ('info', 'ingest')]
+        assert records[0]['path'] == '/nope'
+        assert records[2]['imported'] == 2
+
+    def test_counters_and_timers(self, log_path):
+        metrics.counter('keys_deduped', reason='duplicate')
+        metrics.counter('keys_deduped', 2, reason='duplicate')
+        for _ in range(2):
+            with metrics.timer('fetch', host='github.com'):
+                pass
+        text = metrics.registry().prometheus()
+        assert 'lansync_keys_deduped_total{reason="duplicate"} 3' in text
+        assert 'lansync_fetch_seconds_count{host="github.com"} 2' in text
+        metrics.shutdown()
+        summary = read_log(log_path)[-1]
+        assert summary['msg'] == 'metrics'
+        assert summary['counters'] == [{'name': 'keys_deduped', 'labels': {'reason': 'duplicate'}, 'value': 3}]
+        assert summary['timers'][0]['count'] == 2
+        # written twice as timer events at debug level
+        assert len([r for r in read_log(log_path) if r['msg'] == 'fetch']) == 2
+
+    def test_keystore_bytes(self, log_path, tmp_path):
+        store = KeyStore(str(tmp_path / 'authorized_keys'))
+        store.import_keys([KEY, KEY])
+        KeyStore(str(tmp_path / 'authorized_keys'))
+        counters = {c['name']: c['value'] for c in metrics.registry().snapshot()['counters']}
+        size = (tmp_path / 'authorized_keys').stat().st_size
+        assert counters['keys_written'] == 1
+        assert counters['keys_deduped'] == 1
+        assert counters['authorized_keys_written_bytes'] == size
+        assert counters['authorized_keys_read_bytes'] == size
+
+    def test_prometheus_endpoint(self, log_path):
+        metrics.counter('sources', kind='url')
+        port = metrics.serve(0)
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert 'lansync_sources_total{kind="url"} 1' in response.read().decode()
@@ -0,0 +1,34 @@
+import socket
+import sys
+sys.path.append('.')
+from netif import default_route_interface, interfaces, local_address
+from utilities import get_local_ip
+
+
+ROUTES = '''Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT
+wlan0\t00000000\t0101A8C0\t0003\t0\t0\t600\t00000000\t0\t0\t0
+eth0\t00000000\t0100000A\t0003\t0\t0\t100\t00000000\t0\t0\t0
+eth0\t0000000A\t00000000\t0001\t0\t0\t100\t00FFFFFF\t0\t0\t0
+'''
+
+
+class TestNetif(object):
+    def test_default_route_interface_picks_lowest_metric(self, tmp_path):
+        path = tmp_path / 'route'
+        path.write_text(ROUTES)
+        assert default_route_interface(str(path)) == 'eth0'
+        path.write_text(ROUTES.splitlines()[0] + '\n')
+        assert default_route_interface(str(path)) is None
+        assert default_route_interface(str(tmp_path / 'missing')) is None
+
+    def test_loopback_is_skipped_by_default(self):
+        assert all(iface.name != 'lo' for iface in interfaces())
+        assert any(iface.address == '127.0.0.1' for iface in interfaces(include_loopback=True))
+
+    def test_local_ip_does_not_connect(self, monkeypatch):
+        def no_connect(*args):
+            raise AssertionError('get_local_ip connected out')
+        monkeypatch.setattr(socket.socket, 'connect', no_connect)
+        address = get_local_ip()
+        assert address == local_address()
+        socket.inet_aton(address)
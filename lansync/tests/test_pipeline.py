@@ -0,0 +1,49 @@
+import io
+import sys
+sys.path.append('.')
+from keystore import KeyStore
+from pipeline import IngestReport, classify, ingest, iter_keys, read_lines, KIND_FILE, KIND_KEY, KIND_URL, KIND_USERNAME
+from lansync.settings import SECURE_OPTIONS
+
+
+class TestPipeline(object):
+    pub_key_file_path = 'tests/data/id_rsa.pub'
+
+    def valid_key(self):
+        return open(self.pub_key_file_path, 'r').readline().replace('\n', '')
+
+    def test_classify(self):
+        lines = read_lines('\n'.join([self.valid_key(), self.pub_key_file_path, 'https://github.com/viktorbarzin.keys', 'viktorbarzin', '', '# comment']))
+        kinds = [item.kind for item in classify(lines)]
+        assert kinds == [KIND_KEY, KIND_FILE, KIND_URL, KIND_USERNAME]
+
+    def test_errors_do_not_abort_batch(self):
+        errors = []
+        report = IngestReport()
+        arg = '\n'.join(['ssh-rsa AAAAnotakey user@host', self.valid_key(), 'ssh-rsa AAAAnotakey2', self.pub_key_file_path])
+        keys = list(iter_keys(arg, report, errors.append))
+        assert [key.line for key in keys] == [self.valid_key(), self.valid_key()]
+        assert [(e.source, e.lineno) for e in errors] == [('<import>', 1), ('<import>', 3)]
+        assert report.invalid == 2
+        assert report.keys == 2
+
+    def test_ingest_from_stdin(self, tmp_path):
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        stdin = io.StringIO('\n'.join([self.valid_key(), 'ssh-rsa AAAAnotakey', self.valid_key(), self.pub_key_file_path]) + '\n')
+        report = ingest('-', KeyStore(auth_keys_path), on_error=lambda e: None, stdin=stdin)
+        assert report.imported == 1
+        assert report.duplicates == 2
+        assert report.invalid == 1
+        assert open(auth_keys_path, 'r').readlines() == [SECURE_OPTIONS + ' ' + self.valid_key() + '\n']
+
+        report = ingest(self.pub_key_file_path, KeyStore(auth_keys_path))
+        assert report.imported == 0
+        assert report.skipped == 1
+
+    def test_ingest_updates_options(self, tmp_path):
+        auth_keys_path = str(tmp_path / 'authorized_keys')
+        ingest(self.pub_key_file_path, KeyStore(auth_keys_path))
+        zlib_options = SECURE_OPTIONS.replace('-e.LsfxC', '-ze.LsfxC')
+        report = ingest(self.pub_key_file_path, KeyStore(auth_keys_path, options=zlib_options))
+        assert (report.imported, report.updated, report.skipped) == (0, 1, 0)
+        assert open(auth_keys_path, 'r').readlines() == [zlib_options + ' ' + self.valid_key() + '\n']
@@ -0,0 +1,136 @@
+import json
+import os
+import sys
+sys.path.append('.')
+from segments import assemble, assemble_all, hash_segments, part_name, read_manifest, send_file, MANIFEST_SUFFIX, PARTIAL_SUFFIX
+from test_send import fake_rsync  # noqa: F401
+
+
+SEGMENT = 64 * 1024
+
+
+def make_file(path, size):
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return data
+
+
+class TestSegments(object):
+    def test_hash_segments(self, tmp_path):
+        make_file(tmp_path / 'big', 3 * SEGMENT + 10)
+        digests = hash_segments(str(tmp_path / 'big'), SEGMENT)
+        assert len(digests) == 4
+        assert len(set(digests)) == 4
+        make_file(tmp_path / 'empty', 0)
+        assert hash_segments(str(tmp_path / 'empty'), SEGMENT) == []
+
+    def test_send_and_assemble(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        data = make_file(tmp_path / 'disk.img', 5 * SEGMENT + 123)
+        report = send_file(str(tmp_path / 'disk.img'), 'user@127.0.0.1', jobs=3, segment_size=SEGMENT, rsync=rsync, journal_dir=str(tmp_path / 'journal'))
+        assert report.ok
+        assert report.sent_files == 6
+        assert len(os.listdir(share)) == 7
+        results = assemble_all(str(share), str(tmp_path / 'receiver'))
+        assert [(r.name, r.done, r.total, r.complete) for r in results] == [('disk.img', 6, 6, True)]
+        assert os.listdir(share) == ['disk.img']
+        assert (share / 'disk.img').read_bytes() == data
+
+    def test_resume_only_sends_missing_and_changed_segments(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        source = tmp_path / 'disk.img'
+        data = bytearray(make_file(source, 4 * SEGMENT))
+        journal = str(tmp_path / 'journal')
+        assert send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal).sent_files == 4
+        data[SEGMENT + 5] ^= 0xff
+        source.write_bytes(bytes(data))
+        report = send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal)
+        assert report.sent_files == 1
+        assert send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal, resume=False).sent_files == 4
+
+    def test_assemble_partial_transfer_and_reject_bad_segment(self, tmp_path):
+        share = tmp_path / 'share'
+        share.mkdir()
+        source = tmp_path / 'disk.img'
+        data = make_file(source, 3 * SEGMENT)
+        digests = hash_segments(str(source), SEGMENT)
+        (share / ('disk.img' + MANIFEST_SUFFIX)).write_text(json.dumps({'size': len(data), 'segment_size': SEGMENT, 'digests': digests}))
+        (share / part_name('disk.img', 0)).write_bytes(data[:SEGMENT])
+        (share / part_name('disk.img', 2)).write_bytes(b'x' * SEGMENT)
+        manifest_path = str(share / ('disk.img' + MANIFEST_SUFFIX))
+        journal = str(tmp_path / 'receiver')
+
+        result = assemble(manifest_path, journal)
+        assert (result.done, result.total, result.rejected, result.complete) == (1, 3, [2], False)
+        assert os.path.getsize(share / ('disk.img' + PARTIAL_SUFFIX)) == len(data)
+        assert not os.path.exists(share / part_name('disk.img', 2))
+
+        # resumes from the journal, the first segment is already in place
+        (share / part_name('disk.img', 1)).write_bytes(data[SEGMENT:2 * SEGMENT])
+        (share / part_name('disk.img', 2)).write_bytes(data[2 * SEGMENT:])
+        result = assemble(manifest_path, journal)
+        assert (result.done, result.rejected, result.complete) == (3, [], True)
+        assert (share / 'disk.img').read_bytes() == data
+
+    def test_read_manifest_rejects_inconsistent_manifest(self, tmp_path):
+        path = tmp_path / ('x' + MANIFEST_SUFFIX)
+        path.write_text(json.dumps({'size': 10, 'segment_size': 4, 'digests': ['a']}))
+        assert read_manifest(str(path)) is None
+        path.write_text('not json')
+        assert read_manifest(str(path)) is None
+
+    def test_changed_file_of_the_same_size_completes(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        source = tmp_path / 'disk.img'
+        data = bytearray(make_file(source, 4 * SEGMENT))
+        journal, receiver = str(tmp_path / 'journal'), str(tmp_path / 'receiver')
+        send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal)
+        # an interrupted transfer: two segments are in place when the file changes
+        for index in [2, 3]:
+            os.remove(share / part_name('disk.img', index))
+        assert assemble_all(str(share), receiver)[0].done == 2
+        data[5] ^= 0xff
+        source.write_bytes(bytes(data))
+        assert send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal).sent_files == 1
+        result = assemble_all(str(share), receiver)[0]
+        # segment 1 is kept, 2 and 3 are missing until they are resent
+        assert (result.done, result.complete) == (2, False)
+        assert send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal, resend=[2, 3]).sent_files == 2
+        assert assemble_all(str(share), receiver)[0].complete
+        assert (share / 'disk.img').read_bytes() == bytes(data)
+
+        # once the file is complete, a changed copy is put together from the one in place
+        data[3 * SEGMENT] ^= 0xff
+        source.write_bytes(bytes(data))
+        assert send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal).sent_files == 1
+        assert assemble_all(str(share), receiver)[0].complete
+        assert (share / 'disk.img').read_bytes() == bytes(data)
+
+    def test_segment_changed_while_sending_is_not_journaled(self, tmp_path, fake_rsync, monkeypatch):  # noqa: F811
+        import segments
+        rsync, share = fake_rsync
+        source = tmp_path / 'disk.img'
+        make_file(source, 2 * SEGMENT)
+        real_copy = segments.copy_range
+
+        def copy_changed(src_fd, dst_path, offset, length):
+            real_copy(src_fd, dst_path, offset, length)
+            if offset == 0:
+                with open(dst_path, 'r+b') as f:
+                    f.write(b'changed')
+
+        monkeypatch.setattr(segments, 'copy_range', copy_changed)
+        journal = str(tmp_path / 'journal')
+        report = send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal)
+        assert not report.ok and report.sent_files == 1
+        assert report.failed_files == [part_name('disk.img', 0) + ' (changed while sending)']
+        monkeypatch.setattr(segments, 'copy_range', real_copy)
+        assert send_file(str(source), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=journal).sent_files == 1
+
+    def test_options_are_passed_to_every_rsync_run(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        make_file(tmp_path / 'disk.img', 2 * SEGMENT)
+        send_file(str(tmp_path / 'disk.img'), 'user@127.0.0.1', segment_size=SEGMENT, rsync=rsync, journal_dir=str(tmp_path / 'journal'),
+                  options=['-z', '--compress-level=1'])
+        # the manifest and both segments
+        assert (tmp_path / 'rsync-options').read_text().splitlines() == ['-z --compress-level=1'] * 3
@@ -0,0 +1,93 @@
+import os
+import pytest
+import stat
+import sys
+sys.path.append('.')
+from send import SendError, chunk_args, plan_tree, rsync_command, send_tree, shard_files, FileEntry
+
+
+# loopback stand-in for rsync: copies its file arguments into $FAKE_SHARE, fails on files named fail*.
+# Options of every run are appended to $FAKE_SHARE/../rsync-options
+FAKE_RSYNC = '''#!{python}
+import os, shutil, sys
+args, peer = sys.argv[1:-1], sys.argv[-1]
+assert peer.endswith(':')
+files = [arg for arg in args if not arg.startswith('-')]
+options = [arg for arg in args if arg.startswith('-')]
+with open(os.path.join(os.environ['FAKE_SHARE'], '..', 'rsync-options'), 'a') as f:
+    f.write(' '.join(options) + '\\n')
+if any(os.path.basename(f).startswith('fail') for f in files):
+    sys.exit(23)
+for f in files:
+    shutil.copy(f, os.environ['FAKE_SHARE'])
+'''
+
+
+@pytest.fixture
+def fake_rsync(tmp_path, monkeypatch):
+    path = tmp_path / 'rsync'
+    path.write_text(FAKE_RSYNC.format(python=sys.executable))
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    share = tmp_path / 'share'
+    share.mkdir()
+    monkeypatch.setenv('FAKE_SHARE', str(share))
+    return str(path), share
+
+
+def make_tree(root, files):
+    for name, size in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(size))
+
+
+class TestSend(object):
+    def test_plan_tree(self, tmp_path):
+        make_tree(tmp_path / 'src', {'a': 10, 'sub/b': 20, 'sub/deeper/c': 30})
+        files = plan_tree(str(tmp_path / 'src'))
+        assert sorted((f.name, f.size) for f in files) == [('a', 10), ('b', 20), ('c', 30)]
+
+    def test_plan_tree_rejects_clashing_names(self, tmp_path):
+        make_tree(tmp_path / 'src', {'one/a': 1, 'two/a': 1})
+        with pytest.raises(SendError):
+            plan_tree(str(tmp_path / 'src'))
+
+    def test_shards_are_balanced(self):
+        files = [FileEntry(f'/big{i}', f'big{i}', 100 * 2**20) for i in range(4)]
+        files += [FileEntry(f'/small{i}', f'small{i}', 1024) for i in range(400)]
+        shards = shard_files(files, 4)
+        assert len(shards) == 4
+        assert sorted(f.name for shard in shards for f in shard.files) == sorted(f.name for f in files)
+        assert all(sum(1 for f in shard.files if f.name.startswith('big')) == 1 for shard in shards)
+        assert max(len(shard.files) for shard in shards) - min(len(shard.files) for shard in shards) <= 1
+
+    def test_never_more_shards_than_files(self):
+        assert len(shard_files([FileEntry('/a', 'a', 1)], 8)) == 1
+
+    def test_chunk_args(self):
+        files = [FileEntry(f'/{i:04}', str(i), 1) for i in range(100)]
+        chunks = list(chunk_args(files, max_bytes=60))
+        assert [f for chunk in chunks for f in chunk] == files
+        assert all(len(chunk) == 10 for chunk in chunks)
+
+    def test_rsync_command(self):
+        assert rsync_command(['/a', '/b'], 'user@10.0.0.2') == ['rsync', '/a', '/b', 'user@10.0.0.2:']
+
+    def test_send_tree(self, tmp_path, fake_rsync):
+        rsync, share = fake_rsync
+        make_tree(tmp_path / 'src', {f'd{i % 3}/f{i}': i * 100 for i in range(20)})
+        progress = []
+        report = send_tree(str(tmp_path / 'src'), 'user@127.0.0.1', jobs=3, rsync=rsync, on_progress=lambda r: progress.append(r.sent_files))
+        assert report.ok
+        assert (report.sent_files, report.sent_size) == (20, sum(i * 100 for i in range(20)))
+        assert sorted(os.listdir(share)) == sorted(f'f{i}' for i in range(20))
+        assert progress[-1] == 20
+
+    def test_send_tree_reports_failures(self, tmp_path, fake_rsync):
+        rsync, share = fake_rsync
+        make_tree(tmp_path / 'src', {'ok': 10, 'fail': 10})
+        report = send_tree(str(tmp_path / 'src'), 'user@127.0.0.1', jobs=2, rsync=rsync)
+        assert not report.ok
+        assert report.returncode == 23
+        assert report.failed_files == [str(tmp_path / 'src' / 'fail')]
+        assert os.listdir(share) == ['ok']
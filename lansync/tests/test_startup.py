@@ -0,0 +1,31 @@
+import os
+import re
+import subprocess
+import sys
+
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+# cumulative import time of lansync.lansync, about 25ms on a laptop
+IMPORT_BUDGET_US = 80 * 1000
+HEAVY_MODULES = ['sshpubkeys', 'cryptography', 'http.client', 'urllib.request', 'concurrent.futures', 'lansync.fetch', 'lansync.validation', 'lansync.pipeline']
+
+
+def run_python(*args):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    return subprocess.run([sys.executable] + list(args), cwd=REPO_ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+class TestStartup(object):
+    def test_heavy_modules_are_not_imported(self):
+        out = run_python('-c', 'import sys, lansync.lansync; print("\\n".join(sys.modules))').stdout.split()
+        assert [module for module in HEAVY_MODULES if module in out] == []
+
+    def test_import_time_budget(self):
+        # best of a few runs, the first one may pay for a cold page cache
+        totals = []
+        for _ in range(3):
+            stderr = run_python('-X', 'importtime', '-c', 'import lansync.lansync').stderr
+            match = re.search(r'^import time:\s+\d+ \|\s+(\d+) \| lansync\.lansync$', stderr, re.MULTILINE)
+            assert match is not None
+            totals.append(int(match.group(1)))
+        assert min(totals) < IMPORT_BUDGET_US
@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import time
+sys.path.append('.')
+from usage import UsageTracker
+
+
+class TestUsageTracker(object):
+    def make_tree(self, root):
+        os.makedirs(os.path.join(root, 'peer1', 'nested'))
+        os.makedirs(os.path.join(root, 'peer2'))
+        open(os.path.join(root, 'peer1', 'a.bin'), 'wb').write(os.urandom(10000))
+        open(os.path.join(root, 'peer1', 'nested', 'b.bin'), 'wb').write(os.urandom(20000))
+        open(os.path.join(root, 'peer2', 'c.bin'), 'wb').write(os.urandom(50000))
+
+    def du(self, root):
+        total = 0
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+        return total
+
+    def tracker(self, tmp_path, **kwargs):
+        return UsageTracker(str(tmp_path / 'public'), str(tmp_path / 'usage.json.gz'), **kwargs)
+
+    def test_scan(self, tmp_path):
+        root = str(tmp_path / 'public')
+        self.make_tree(root)
+        tracker = self.tracker(tmp_path, limit=10**6)
+        tracker.refresh()
+        assert tracker.total == self.du(root)
+        assert tracker.totals['peer1'] == self.du(os.path.join(root, 'peer1'))
+        assert [name for name, _ in tracker.top()] == ['peer2', 'peer1']
+
+    def test_restart_only_rescans_changed_dirs(self, tmp_path):
+        root = str(tmp_path / 'public')
+        self.make_tree(root)
+        self.tracker(tmp_path, limit=10**6).refresh()
+        os.remove(os.path.join(root, 'peer2', 'c.bin'))
+        open(os.path.join(root, 'peer1', 'nested', 'd.bin'), 'wb').write(os.urandom(5000))
+        os.makedirs(os.path.join(root, 'peer3'))
+        open(os.path.join(root, 'peer3', 'e.bin'), 'wb').write(os.urandom(5000))
+
+        tracker = self.tracker(tmp_path, limit=10**6)
+        assert tracker.load()
+        tracker.reconcile()
+        assert tracker.total == self.du(root)
+        assert 'peer2/c.bin' not in tracker.files
+        assert 'peer3/e.bin' in tracker.files
+
+    def test_watch_follows_changes_and_warns(self, tmp_path):
+        root = str(tmp_path / 'public')
+        self.make_tree(root)
+        warnings = []
+        tracker = self.tracker(tmp_path, limit=300000, soft_limit=0.5, on_soft_limit=warnings.append)
+        tracker.refresh()
+        stop = threading.Event()
+        thread = threading.Thread(target=tracker.watch, kwargs={'save_interval': 0, 'should_stop': stop.is_set})
+        thread.start()
+        time.sleep(0.2)
+        os.makedirs(os.path.join(root, 'peer3', 'deep'))
+        open(os.path.join(root, 'peer3', 'deep', 'f.bin'), 'wb').write(os.urandom(150000))
+        os.rename(os.path.join(root, 'peer1'), os.path.join(root, 'renamed'))
+        os.remove(os.path.join(root, 'peer2', 'c.bin'))
+        time.sleep(0.5)
+        stop.set()
+        thread.join()
+        assert tracker.total == self.du(root)
+        assert 'renamed/nested/b.bin' in tracker.files
+        assert 'peer1' not in tracker.totals
+        assert len(warnings) == 1
+
+        reloaded = self.tracker(tmp_path, limit=300000)
+        assert reloaded.load()
+        assert reloaded.total == tracker.total
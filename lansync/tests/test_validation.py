@@ -0,0 +1,72 @@
+import sys
+sys.path.append('.')
+import validation
+from validation import ValidationCache, validate_key, validate_keys
+
+
+class TestValidation(object):
+    pub_key_file_path = 'tests/data/id_rsa.pub'
+
+    def valid_key(self):
+        return open(self.pub_key_file_path, 'r').readline().replace('\n', '')
+
+    def count_parses(self, monkeypatch):
+        calls = []
+        check_key = validation.check_key
+
+        def counting_check_key(key):
+            calls.append(key)
+            return check_key(key)
+        monkeypatch.setattr(validation, 'check_key', counting_check_key)
+        return calls
+
+    def test_valid_key_record(self):
+        record = validate_key(self.valid_key(), ValidationCache())
+        assert record.line == self.valid_key()
+        assert record.key_type == 'ssh-rsa'
+        assert record.bits == 16384
+        assert record.comment == 'viktor@yuhu'
+        assert record.fingerprint.startswith('SHA256:')
+
+    def test_invalid_key(self):
+        assert validate_key('ssh-rsa AAAAnotakey user@host', ValidationCache()) is None
+        assert validate_key('', ValidationCache()) is None
+
+    def test_same_blob_is_parsed_once(self, monkeypatch):
+        calls = self.count_parses(monkeypatch)
+        cache = ValidationCache()
+        key = self.valid_key()
+        blob = ' '.join(key.split(' ')[:2])
+        records = validate_keys([key, key, blob + ' other@host', 'ssh-rsa AAAAnotakey', 'ssh-rsa AAAAnotakey'], cache)
+        assert [r is not None for r in records] == [True, True, True, False, False]
+        assert records[2].comment == 'other@host'
+        assert len(calls) == 2
+
+        assert validate_key(key, cache) is not None
+        assert len(calls) == 2
+
+    def test_lru_eviction(self):
+        cache = ValidationCache(max_entries=2)
+        for i in range(3):
+            cache.put(str(i), (True, 1024))
+        assert cache.get('0') is None
+        assert cache.get('1') == (True, 1024)
+        cache.put('3', (True, 1024))
+        assert cache.get('2') is None
+        assert cache.get('1') is not None
+
+    def test_persisted_cache(self, tmp_path, monkeypatch):
+        path = str(tmp_path / 'validated_keys.json')
+        cache = ValidationCache(path)
+        validate_key(self.valid_key(), cache)
+        cache.save()
+
+        calls = self.count_parses(monkeypatch)
+        assert validate_key(self.valid_key(), ValidationCache(path)) is not None
+        assert calls == []
+
+    def test_parallel_validation(self, monkeypatch):
+        monkeypatch.setattr(validation, 'PARALLEL_VALIDATION_THRESHOLD', 2)
+        keys = [self.valid_key(), 'ssh-rsa AAAAnotakey', 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIK0wmN/Cr3JXqmLW7u+g9pTh+wyqDHpSQEIQczXkVx9q']
+        records = validate_keys(keys, ValidationCache(), processes=2)
+        assert [r is not None for r in records] == [True, False, True]
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import sys
+import threading
+sys.path.append('.')
+from verify import follow, ship_expected, verify, write_expected, Hasher, Manifest, EXPECTED_SUFFIX, STATUS_CHANGED, STATUS_MISMATCH, STATUS_MISSING, STATUS_OK
+from test_send import fake_rsync  # noqa: F401
+
+
+CHUNK = 64 * 1024
+
+
+def tree_digest(data, chunk_size):
+    digests = [hashlib.blake2b(data[offset:offset + chunk_size], digest_size=32).digest() for offset in range(0, len(data), chunk_size)]
+    return hashlib.blake2b(b''.join(digests), digest_size=32).hexdigest()
+
+
+def make_manifest(tmp_path):
+    share = tmp_path / 'share'
+    share.mkdir(exist_ok=True)
+    return Manifest(str(share), str(tmp_path / 'manifest.json.gz'), CHUNK)
+
+
+class TestVerify(object):
+    def test_hash_in_pieces(self, tmp_path):
+        data = os.urandom(5 * CHUNK + 17)
+        (tmp_path / 'big').write_bytes(data)
+        (tmp_path / 'empty').write_bytes(b'')
+        with Hasher(CHUNK, workers=3) as hasher:
+            digests = hasher.hash_files([str(tmp_path / 'big'), str(tmp_path / 'empty'), str(tmp_path / 'gone')])
+        assert digests == {str(tmp_path / 'big'): tree_digest(data, CHUNK), str(tmp_path / 'empty'): tree_digest(b'', CHUNK)}
+
+    def test_only_changed_files_are_hashed(self, tmp_path):
+        manifest = make_manifest(tmp_path)
+        for name in ['a', 'b', 'sub/c']:
+            path = tmp_path / 'share' / name
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(os.urandom(1000))
+        hashed = []
+        with Hasher(CHUNK) as hasher:
+            hash_files = hasher.hash_files
+            hasher.hash_files = lambda paths, **kwargs: hashed.append(sorted(os.path.relpath(p, manifest.root) for p in paths)) or hash_files(paths, **kwargs)
+            manifest.update(hasher)
+            manifest.save()
+            manifest = make_manifest(tmp_path)
+            manifest.load()
+            (tmp_path / 'share' / 'b').write_bytes(os.urandom(1001))
+            os.remove(str(tmp_path / 'share' / 'a'))
+            assert manifest.update(hasher) == []
+        assert hashed == [['a', 'b', 'sub/c'], ['b']]
+        assert sorted(manifest.entries) == ['b', 'sub/c']
+
+    def test_full_finds_silent_changes(self, tmp_path):
+        manifest = make_manifest(tmp_path)
+        path = tmp_path / 'share' / 'a'
+        path.write_bytes(b'x' * 1000)
+        with Hasher(CHUNK) as hasher:
+            manifest.update(hasher)
+            st = path.stat()
+            path.write_bytes(b'y' * 1000)
+            os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns))
+            assert manifest.update(hasher) == []
+            assert [(c.name, c.status) for c in manifest.update(hasher, full=True)] == [('a', STATUS_CHANGED)]
+
+    def test_check_against_expected(self, tmp_path):
+        manifest = make_manifest(tmp_path)
+        share = tmp_path / 'share'
+        sent = {}
+        for name in ['good', 'bad', 'missing']:
+            (tmp_path / name).write_bytes(os.urandom(3 * CHUNK))
+            sent[name] = str(tmp_path / name)
+        with Hasher(CHUNK) as hasher:
+            write_expected(str(share / ('src' + EXPECTED_SUFFIX)), sent, hasher)
+            (share / 'good').write_bytes((tmp_path / 'good').read_bytes())
+            (share / 'bad').write_bytes(b'z' * 3 * CHUNK)
+            checks = verify(manifest, hasher)
+        assert sorted((c.name, c.status) for c in checks) == [('bad', STATUS_MISMATCH), ('good', STATUS_OK), ('missing', STATUS_MISSING)]
+        assert sorted(manifest.entries) == ['bad', 'good']
+
+    def test_ship_expected(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        (tmp_path / 'a').write_bytes(b'a' * 100)
+        with Hasher(CHUNK) as hasher:
+            assert ship_expected('src', {'a': str(tmp_path / 'a')}, 'user@127.0.0.1', hasher, rsync) == 0
+        assert os.listdir(str(share)) == ['src' + EXPECTED_SUFFIX]
+
+    def test_follow_checks_arriving_files(self, tmp_path):
+        manifest = make_manifest(tmp_path)
+        share = tmp_path / 'share'
+        (tmp_path / 'a').write_bytes(os.urandom(2 * CHUNK))
+        checks = []
+        arrived = threading.Event()
+
+        def on_check(check):
+            checks.append(check)
+            arrived.set()
+
+        with Hasher(CHUNK) as hasher:
+            write_expected(str(share / ('src' + EXPECTED_SUFFIX)), {'a': str(tmp_path / 'a')}, hasher)
+            thread = threading.Thread(target=follow, args=(manifest, hasher, on_check, lambda: arrived.is_set()))
+            thread.start()
+            (tmp_path / 'tmp').write_bytes((tmp_path / 'a').read_bytes())
+            os.rename(str(tmp_path / 'tmp'), str(share / 'a'))
+            thread.join(10)
+        assert [(c.name, c.status) for c in checks] == [('a', STATUS_OK)]
@@ -0,0 +1,145 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append('.')
+from watch import Outbox
+from settings import WATCH_RETRY
+from test_send import fake_rsync  # noqa: F401
+
+
+PEERS = ['user@10.0.0.1', 'user@10.0.0.2']
+
+
+def run_until(outbox, condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    thread = threading.Thread(target=outbox.watch, args=(lambda: condition() or time.monotonic() > deadline,))
+    thread.start()
+    return thread
+
+
+class TestWatch(object):
+    def make_outbox(self, tmp_path, rsync, peers=PEERS, **kwargs):
+        return Outbox(str(tmp_path / 'outbox'), peers, state_dir=str(tmp_path / 'state'), rsync=rsync, **kwargs)
+
+    def test_push_to_every_peer(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        (tmp_path / 'outbox' / 'sub').mkdir(parents=True)
+        (tmp_path / 'outbox' / 'a').write_bytes(b'a')
+        (tmp_path / 'outbox' / 'sub' / 'b').write_bytes(b'b')
+        results = []
+        outbox = self.make_outbox(tmp_path, rsync, debounce=0.1, on_batch=results.append)
+        outbox.refresh()
+        thread = run_until(outbox, lambda: outbox.idle() and (share / 'c').exists())
+        time.sleep(0.3)
+        (tmp_path / 'outbox' / 'sub' / 'c').write_bytes(b'c')
+        thread.join()
+        assert sorted(os.listdir(str(share))) == ['a', 'b', 'c']
+        for peer in PEERS:
+            assert sorted(rel for result in results if result.peer == peer for rel in result.sent) == ['a', 'sub/b', 'sub/c']
+        assert all(result.failed == [] for result in results)
+
+    def test_bursts_are_coalesced(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        (tmp_path / 'outbox').mkdir()
+        results = []
+        outbox = self.make_outbox(tmp_path, rsync, peers=PEERS[:1], debounce=0.5, on_batch=results.append)
+        outbox.refresh()
+        thread = run_until(outbox, lambda: len(results) > 0 and outbox.idle())
+        time.sleep(0.2)
+        for i in range(5):
+            with open(str(tmp_path / 'outbox' / 'log'), 'a') as f:
+                f.write(f'line {i}\n')
+            (tmp_path / 'outbox' / f'file{i}').write_bytes(b'x')
+            time.sleep(0.05)
+        thread.join()
+        # one batch with every file in it, sent once
+        assert len(results) == 1
+        assert sorted(results[0].sent) == ['file0', 'file1', 'file2', 'file3', 'file4', 'log']
+        assert (share / 'log').read_text().count('line') == 5
+
+    def test_failed_batch_backs_off(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        (tmp_path / 'outbox').mkdir()
+        (tmp_path / 'outbox' / 'fail1').write_bytes(b'x')
+        now = [1000.0]
+        results = []
+        outbox = self.make_outbox(tmp_path, rsync, peers=PEERS[:1], on_batch=results.append, clock=lambda: now[0])
+        outbox.refresh()
+        queue = outbox.queues[PEERS[0]]
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            outbox.pump(pool)
+            queue.running.result()
+            outbox.pump(pool)
+            assert results[0].failed == ['fail1']
+            assert results[0].retry_in == WATCH_RETRY
+            assert queue.pending == {'fail1'}
+            outbox.pump(pool)
+            assert queue.running is None
+            now[0] += WATCH_RETRY
+            outbox.pump(pool)
+            queue.running.result()
+            outbox.pump(pool)
+        assert results[1].retry_in == 2 * WATCH_RETRY
+
+    def test_restart_keeps_queue_without_rescan(self, tmp_path, fake_rsync, monkeypatch):  # noqa: F811
+        rsync, share = fake_rsync
+        (tmp_path / 'outbox' / 'sub').mkdir(parents=True)
+        (tmp_path / 'outbox' / 'a').write_bytes(b'a')
+        (tmp_path / 'outbox' / 'sub' / 'b').write_bytes(b'b')
+        outbox = self.make_outbox(tmp_path, rsync)
+        outbox.refresh()
+        outbox.queues[PEERS[0]].pending.discard('a')
+        outbox.save()
+
+        (tmp_path / 'outbox' / 'sub' / 'new').write_bytes(b'n')
+        restarted = self.make_outbox(tmp_path, rsync, peers=PEERS + ['user@10.0.0.3'])
+        monkeypatch.setattr(restarted, '_scan_dir', lambda rel: (_ for _ in ()).throw(AssertionError('full scan')))
+        restarted.refresh()
+        assert restarted.queues[PEERS[0]].pending == {'sub/b', 'sub/new'}
+        assert restarted.queues[PEERS[1]].pending == {'a', 'sub/b', 'sub/new'}
+        # a peer that wasn't there before gets everything
+        assert restarted.queues['user@10.0.0.3'].pending == {'a', 'sub/b', 'sub/new'}
+
+    def test_clashing_names_are_held_back(self, tmp_path, fake_rsync, capsys):  # noqa: F811
+        rsync, share = fake_rsync
+        for name in ['one/a', 'two/a', 'b']:
+            (tmp_path / 'outbox' / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / 'outbox' / name).write_bytes(name.encode())
+        results = []
+        outbox = self.make_outbox(tmp_path, rsync, peers=PEERS[:1], debounce=0.1, on_batch=results.append)
+        outbox.refresh()
+        queue = outbox.queues[PEERS[0]]
+        assert [entry.name for entry in outbox.next_batch(queue)] == ['b']
+        assert queue.pending == {'b', 'one/a', 'two/a'}
+        assert 'would overwrite each other' in capsys.readouterr().out
+        queue.batch = {}
+        # reported once, not on every batch
+        outbox.next_batch(queue)
+        assert capsys.readouterr().out == ''
+        queue.batch = {}
+
+        (tmp_path / 'outbox' / 'two' / 'a').unlink()
+        outbox.reconcile()
+        thread = run_until(outbox, lambda: outbox.idle())
+        thread.join()
+        assert sorted(os.listdir(str(share))) == ['a', 'b']
+        assert (share / 'a').read_bytes() == b'one/a'
+        assert outbox.idle()
+
+    def test_batches_are_sent_in_groups(self, tmp_path, fake_rsync):  # noqa: F811
+        rsync, share = fake_rsync
+        (tmp_path / 'outbox').mkdir()
+        for name in ['a.log', 'b.jpg']:
+            (tmp_path / 'outbox' / name).write_bytes(name.encode())
+
+        def group_files(files):
+            return [(['-z', '--compress-level=' + str(len(entry.name))], [entry]) for entry in files]
+
+        outbox = self.make_outbox(tmp_path, rsync, peers=PEERS[:1], group_files=group_files)
+        outbox.refresh()
+        queue = outbox.queues[PEERS[0]]
+        result = outbox.finish(queue, outbox.transfer(PEERS[0], outbox.next_batch(queue)))
+        assert sorted(result.sent) == ['a.log', 'b.jpg'] and queue.pending == set()
+        assert (tmp_path / 'rsync-options').read_text().splitlines() == ['-z --compress-level=5'] * 2
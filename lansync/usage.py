@@ -0,0 +1,296 @@
+'''
+Incremental disk usage accounting of the public share.
+
+The share is walked once, after that per-file and per-directory totals are
+kept up to date from inotify events and persisted to a compact index so a
+restart only has to look at directories that changed in the meantime.
+'''
+import gzip
+import itertools
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+from lansync.settings import PATH_TO_PUBLIC_DIR, PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME, USAGE_INDEX_PATH, USAGE_SOFT_LIMIT, USAGE_SAVE_INTERVAL
+from lansync import inotify
+from lansync.metrics import WARNING, log
+
+
+def disk_usage(st: os.stat_result) -> int:
+    # allocated rather than apparent size - that's what fills up the share
+    return st.st_blocks * 512
+
+
+def parent(rel: str) -> str:
+    return rel.rpartition('/')[0]
+
+
+def join(rel: str, name: str) -> str:
+    return rel + '/' + name if rel != '' else name
+
+
+def share_limit(root: str) -> Optional[int]:
+    '''
+    Size of the filesystem mounted on the share, or of the share image when it isn't mounted
+    '''
+    if os.path.ismount(root):
+        st = os.statvfs(root)
+        return st.f_blocks * st.f_frsize
+    image_path = os.path.join(PATH_TO_PUBLIC_DIR_FILE, PUBLIC_DIR_FILE_NAME)
+    if os.path.exists(image_path):
+        return os.path.getsize(image_path)
+    return None
+
+
+class UsageTracker(object):
+    '''
+    Keeps the disk usage of every file under root and the recursive total of
+    every directory. on_soft_limit is called with the tracker every time the
+    total goes over soft_limit * limit.
+    '''
+    def __init__(self, root=PATH_TO_PUBLIC_DIR, index_path=USAGE_INDEX_PATH, limit: Optional[int] = None, soft_limit=USAGE_SOFT_LIMIT,
+                 on_soft_limit: Optional[Callable[['UsageTracker'], None]] = None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path
+        self.limit = limit if limit is not None else share_limit(self.root)
+        self.soft_limit = soft_limit
+        self.on_soft_limit = on_soft_limit
+        self.files = {}  # type: Dict[str, int]
+        self.dirs = {}  # type: Dict[str, int]
+        self.totals = {}  # type: Dict[str, int]
+        self._watches = {}  # type: Dict[int, str]
+        self._over_soft_limit = False
+
+    @property
+    def total(self) -> int:
+        return self.totals.get('', 0)
+
+    def top(self, n=10) -> List[Tuple[str, int]]:
+        '''
+        Biggest entries directly in the share
+        '''
+        entries = [(name, size) for name, size in self.files.items() if '/' not in name]
+        entries += [(name, size) for name, size in self.totals.items() if name != '' and '/' not in name]
+        return sorted(entries, key=lambda entry: entry[1], reverse=True)[:n]
+
+    def refresh(self) -> None:
+        '''
+        Load the persisted index and catch up with changes made while nobody was
+        watching, or scan the whole share if there is no index yet
+        '''
+        if self.load():
+            self.reconcile()
+        else:
+            self.scan()
+        self.save()
+
+    def scan(self) -> None:
+        self.files = {}
+        self.dirs = {}
+        self.totals = {}
+        self._scan_dir('')
+
+    def load(self) -> bool:
+        try:
+            with gzip.open(self.index_path, 'rt') as f:
+                index = json.load(f)
+            if index['root'] != self.root:
+                return False
+            self.files = index['files']
+            self.dirs = index['dirs']
+        except (OSError, ValueError, KeyError, TypeError, EOFError):
+            return False
+        self.totals = {rel: 0 for rel in self.dirs}
+        for rel, size in self.files.items():
+            self._add(parent(rel), size)
+        return True
+
+    def save(self) -> None:
+        tmp_path = self.index_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with gzip.open(tmp_path, 'wt') as f:
+                json.dump({'root': self.root, 'files': self.files, 'dirs': self.dirs}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+        except OSError as err:
+            log(f'Couldn\'t save usage index: {err}', WARNING, path=self.index_path)
+
+    def reconcile(self) -> None:
+        '''
+        Rescan directories whose mtime changed. rsync writes into a temporary
+        file and renames it, so every received file bumps its directory's mtime.
+        '''
+        children = defaultdict(list)  # type: Dict[str, List[str]]
+        for name in itertools.chain(self.files, self.dirs):
+            if name != '':
+                children[parent(name)].append(name)
+        for rel in sorted(self.dirs, key=len):
+            if rel not in self.dirs:
+                continue  # dropped together with its parent
+            try:
+                st = os.stat(os.path.join(self.root, rel))
+            except OSError:
+                self._drop_dir(rel)
+                continue
+            if st.st_mtime_ns != self.dirs[rel]:
+                self._rescan_entries(rel, children[rel])
+
+    def _scan_dir(self, rel: str) -> None:
+        stack = [rel]
+        while len(stack) > 0:
+            current = stack.pop()
+            try:
+                self.dirs[current] = os.stat(os.path.join(self.root, current)).st_mtime_ns
+                self.totals.setdefault(current, 0)
+                with os.scandir(os.path.join(self.root, current)) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(join(current, entry.name))
+                        else:
+                            self._set_file(join(current, entry.name), disk_usage(entry.stat(follow_symlinks=False)))
+            except OSError:
+                continue
+
+    def _rescan_entries(self, rel: str, known: List[str]) -> None:
+        '''
+        Sync the direct children of rel with the disk. known are the children in the index
+        '''
+        path = os.path.join(self.root, rel)
+        try:
+            self.dirs[rel] = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                entries = {entry.name: entry for entry in it}
+        except OSError:
+            self._drop_dir(rel)
+            return
+        prefix_length = len(rel) + 1 if rel != '' else 0
+        for name in known:
+            entry = entries.get(name[prefix_length:])
+            if name in self.files and (entry is None or entry.is_dir(follow_symlinks=False)):
+                self._remove_file(name)
+            elif name in self.dirs and (entry is None or not entry.is_dir(follow_symlinks=False)):
+                self._drop_dir(name)
+        for name, entry in entries.items():
+            child = join(rel, name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if child not in self.dirs:
+                        self._scan_dir(child)
+                else:
+                    self._set_file(child, disk_usage(entry.stat(follow_symlinks=False)))
+            except OSError:
+                continue
+
+    def _add(self, rel: str, delta: int) -> None:
+        while True:
+            self.totals[rel] = self.totals.get(rel, 0) + delta
+            if rel == '':
+                return
+            rel = parent(rel)
+
+    def _set_file(self, rel: str, size: int) -> None:
+        delta = size - self.files.get(rel, 0)
+        self.files[rel] = size
+        if delta != 0:
+            self._add(parent(rel), delta)
+
+    def _remove_file(self, rel: str) -> None:
+        size = self.files.pop(rel, None)
+        if size is not None:
+            self._add(parent(rel), -size)
+
+    def _drop_dir(self, rel: str) -> None:
+        if rel == '':
+            self.files, self.dirs, self.totals = {}, {}, {}
+            return
+        prefix = rel + '/'
+        for name in [name for name in self.files if name.startswith(prefix)]:
+            self._remove_file(name)
+        for name in [name for name in self.dirs if name == rel or name.startswith(prefix)]:
+            del self.dirs[name]
+            self.totals.pop(name, None)
+
+    def check_soft_limit(self) -> None:
+        if self.limit is None or self.on_soft_limit is None:
+            return
+        over = self.total >= self.limit * self.soft_limit
+        if over and not self._over_soft_limit:
+            self.on_soft_limit(self)
+        self._over_soft_limit = over
+
+    def _add_watch(self, watcher: inotify.Inotify, rel: str) -> None:
+        try:
+            wd = watcher.add_watch(os.path.join(self.root, rel), inotify.TREE_EVENTS | inotify.IN_ONLYDIR)
+            self._watches[wd] = rel
+        except OSError as err:
+            path = os.path.join(self.root, rel)
+            log(f'Couldn\'t watch {path}: {err}', WARNING, path=path)
+
+    def handle_event(self, watcher: inotify.Inotify, event: inotify.Event) -> None:
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            # events were lost - start over
+            self.scan()
+            for rel in self.dirs:
+                self._add_watch(watcher, rel)
+            return
+        rel = self._watches.get(event.wd)
+        if rel is None:
+            return
+        if event.mask & inotify.IN_IGNORED:
+            del self._watches[event.wd]
+            return
+        if event.name == '':
+            return  # events on the watched directory itself
+        child = join(rel, event.name)
+        path = os.path.join(self.root, child)
+        if event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            if event.mask & inotify.IN_ISDIR:
+                # watches follow a moved directory, drop them before it shows up under its new name
+                for wd, name in list(self._watches.items()):
+                    if name == child or name.startswith(child + '/'):
+                        watcher.rm_watch(wd)
+                        del self._watches[wd]
+                self._drop_dir(child)
+            else:
+                self._remove_file(child)
+        elif event.mask & inotify.IN_ISDIR:
+            if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO) and child not in self.dirs:
+                self._scan_dir(child)
+                for name in [name for name in self.dirs if name == child or name.startswith(child + '/')]:
+                    self._add_watch(watcher, name)
+        else:
+            try:
+                self._set_file(child, disk_usage(os.lstat(path)))
+            except OSError:
+                self._remove_file(child)
+        if rel in self.dirs:
+            try:
+                self.dirs[rel] = os.stat(os.path.join(self.root, rel)).st_mtime_ns
+            except OSError:
+                pass
+
+    def watch(self, save_interval=USAGE_SAVE_INTERVAL, should_stop: Callable[[], bool] = lambda: False) -> None:
+        '''
+        Follow changes with inotify until should_stop returns True,
+        saving the index every save_interval seconds
+        '''
+        with inotify.Inotify() as watcher:
+            for rel in list(self.dirs):
+                self._add_watch(watcher, rel)
+            self.check_soft_limit()
+            last_save = time.monotonic()
+            dirty = False
+            while not should_stop():
+                events = watcher.read_events(timeout=1)
+                for event in events:
+                    self.handle_event(watcher, event)
+                if len(events) > 0:
+                    dirty = True
+                    self.check_soft_limit()
+                if dirty and time.monotonic() - last_save >= save_interval:
+                    self.save()
+                    last_save = time.monotonic()
+                    dirty = False
+            if dirty:
+                self.save()
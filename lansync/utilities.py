@@ -2,40 +2,93 @@
 Read and parse commandline arguments
 '''
 import argparse
-import os
+import atexit
 import re
-import socket
-import sys
-from sshpubkeys import SSHKey, InvalidKeyError
-from typing import Optional, List
-from urllib.request import urlopen
-from lansync.settings import SECURE_OPTIONS, AUTHORIZED_KEYS_PATH
+from itertools import islice
+from typing import Dict, Optional, List
+from lansync.settings import AUTHORIZED_KEYS_PATH, INGEST_BATCH_SIZE, COMPRESSION_CODECS, METRICS_ADDRESS, SEND_JOBS, WATCH_DEBOUNCE
+from lansync.keystore import KeyStore
+from lansync.image import get_partition_offset
+from lansync.metrics import ERROR, WARNING, log
+# fetch (http.client) and validation (sshpubkeys, cryptography) are slow to
+# import, so the functions needing them import them on first use
 
-
-def log(msg, level=0) -> None:
-    '''
-    TODO: implemente some more advanced logging some time. Print for now
-    '''
-    print(msg)
+# authorized_keys path -> store, see get_key_store
+_key_stores = {}  # type: Dict[str, KeyStore]
 
 
 class ArgParser(object):
     '''
     Arguments list:
-        --import <public key file path>
+        --import <public key file path> [--compress <codec>]
         #--import <public key string> [--key-server <gpg server url>]
+        --log <path> [--log-level <level>] [--metrics-port <port>]
+        send <path> <user@host> [--jobs <n>] [--segmented [--restart] [--resend <segments>]] [--verify] [--compress <codec> [--link-speed <mbit/s>]]
+        receive [--follow]
+        discover
+        peers
+        sync <src file> <dest> [--block-size <size>]
+        dedup
+        verify [--full] [--follow]
+        watch <dir> --to <user@host> [--to <user@host> ...] [--debounce <seconds>] [--rescan] [--compress <codec> [--link-speed <mbit/s>]]
     '''
     def __init__(self):
         self.parser = argparse.ArgumentParser(description='Parse server arguments')
         # self.parser.add_argument('--import', type=str, help='Add public key to authorized_keys')
-        self.parser.add_argument('-i', '--import', dest='pub_key_arg', help='Public key to import. Can import from raw string, file and Github username')
+        self.parser.add_argument('-i', '--import', dest='pub_key_arg', help='Public key to import. Can import from raw string, file, url and Github username. Use - to read them from stdin')
         # self.parser.add_argument('--dir', dest='setup_dir', default=os.path.expanduser('~/public/'), help='Directory that will be allowed to share files to.')
+        self.parser.add_argument('--compress', choices=COMPRESSION_CODECS, help='With --import: let the imported keys send compressed with this codec. They then have to send with lansync send --compress and the same codec. zstd and lz4 need rsync 3.2 on both ends')
         self.parser.add_argument('--size', dest='setup_dir_size', help='Limit of the shared directory. Can use letters e.g: 1M, 2G, 512B, 1024K. Default size is in bytes')
+        self.parser.add_argument('--thin', action=argparse.BooleanOptionalAction, help='Only use disk space for data actually written to the share instead of reserving --size up front. --resize keeps what the share was created with unless --thin or --no-thin is given')
+        self.parser.add_argument('--resize', dest='resize_size', help='Grow the (unmounted) share to this size in place. Same format as --size')
+        self.parser.add_argument('--compact', action='store_true', help='Give space used by deleted files in the (unmounted) share back to the host')
+        self.parser.add_argument('--usage', action='store_true', help='Show how full the share is and what is taking up the space')
+        self.parser.add_argument('--follow', action='store_true', help='With --usage: keep tracking changes and warn when the share is getting full')
+        self.parser.add_argument('--log', dest='log_path', help='Append structured (JSON lines) logs, timings and counters to this file')
+        self.parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'error'], default='info', help='Lowest level written to --log. debug adds every timed phase. Default is info')
+        self.parser.add_argument('--metrics-port', type=int, help=f'Serve timings and counters in Prometheus text format on http://{METRICS_ADDRESS}:<port>/metrics while lansync runs')
+
+        commands = self.parser.add_subparsers(dest='command')
+        send = commands.add_parser('send', help='Send a file or directory tree to a peer\'s share over several rsync streams')
+        send.add_argument('path', help='File or directory to send. Directories are flattened into the root of the share')
+        send.add_argument('peer', help='Peer to send to, as user@host')
+        send.add_argument('-j', '--jobs', type=int, default=SEND_JOBS, help=f'Number of concurrent rsync processes. Default is {SEND_JOBS}')
+        send.add_argument('--segmented', action='store_true', help='Send a single big file in segments over parallel streams. Interrupted transfers resume where they stopped. The peer puts it together with lansync receive')
+        send.add_argument('--restart', action='store_true', help='With --segmented: send every segment again instead of resuming')
+        send.add_argument('--resend', type=parse_indices, help='With --segmented: also send these segments again, comma separated. lansync receive on the peer lists the ones it rejected')
+        send.add_argument('--verify', action='store_true', help='Send the digests of the files ahead of them, so the peer can check what arrived with lansync verify')
+        send.add_argument('--compress', choices=COMPRESSION_CODECS, help='Compress every kind of file at the level that is fastest over the link, or not at all. Use the codec the peer imported your key with')
+        send.add_argument('--link-speed', type=int, help='With --compress: speed of the link in Mbit/s. Default is what the network interface reports')
+        receive = commands.add_parser('receive', help='Put together files sent with send --segmented')
+        receive.add_argument('--follow', action='store_true', help='Keep putting segments in place as they arrive')
+        commands.add_parser('discover', help='Announce yourself on the local network and keep track of other lansync users')
+        commands.add_parser('peers', help='List lansync users found by lansync discover')
+        sync = commands.add_parser('sync', help='Update a copy of a file, e.g. in the mounted share, rewriting only the blocks that changed. Needs numpy')
+        sync.add_argument('src', help='File to copy')
+        sync.add_argument('dest', help='File or directory to update')
+        sync.add_argument('--block-size', help='Size of the compared blocks, same format as --size. Default is about the square root of the file size')
+        commands.add_parser('dedup', help='Keep a single copy of data shared between files in the share through reflinks. Needs numpy, and the share and ~/.lansync on one btrfs or xfs filesystem: '
+                                 'refuses to run on the FAT share image made with --size, and never falls back to hardlinking identical files')
+        verify = commands.add_parser('verify', help='Check received files against the digests sent with send --verify. Only files that changed since the last run are hashed')
+        verify.add_argument('--full', action='store_true', help='Hash every file again and report the ones whose contents changed without their size or modification time changing')
+        verify.add_argument('--follow', action='store_true', help='Keep checking files as they arrive')
+        watch = commands.add_parser('watch', help='Keep sending whatever is written to a directory to one or more peers')
+        watch.add_argument('path', help='Outbox directory. Files in subdirectories are sent into the root of the peer\'s share')
+        watch.add_argument('--to', dest='peers', action='append', required=True, help='Peer to send to, as user@host. Can be given more than once')
+        watch.add_argument('--debounce', type=float, default=WATCH_DEBOUNCE, help=f'Seconds a file has to stay unchanged before it is sent. Default is {WATCH_DEBOUNCE}')
+        watch.add_argument('--rescan', action='store_true', help='Look at every file in the outbox again on start, e.g. after files were changed in place while lansync watch wasn\'t running')
+        watch.add_argument('--compress', choices=COMPRESSION_CODECS, help='Compress every batch like lansync send --compress. Needed for peers that imported your key with --compress')
+        watch.add_argument('--link-speed', type=int, help='With --compress: speed of the link in Mbit/s. Default is what the network interface reports')
 
     def parse_args(self, inp=[]) -> argparse.Namespace:
         if inp == []:
-            return self.parser.parse_args()
-        return self.parser.parse_args(inp)
+            args = self.parser.parse_args()
+        else:
+            args = self.parser.parse_args(inp)
+        # lansync send has a --compress of its own
+        if args.command is None and args.compress is not None and not args.pub_key_arg:
+            self.parser.error('--compress only applies to keys imported with --import')
+        return args
 
 
 def get_pub_keys(key: str) -> List[str]:
@@ -44,73 +97,44 @@ def get_pub_keys(key: str) -> List[str]:
         - a public key string
         - a location to file containing a public key
         - a url to download a key
+        - a Github username
+    "-" reads the lines from stdin instead.
     '''
     if key is None or key == '':
         return []
-    keys = []
-    try:
-        for line in key.split('\n'):
-            extracted = None
-            if os.path.exists(line):
-                extracted = get_pub_keys_from_file(line)
-                keys.extend(extracted)
-            elif is_valid_web_url(line):
-                extracted = get_pub_keys_from_url(line)
-                keys.extend(extracted)
-            elif is_valid_username(line) and not line.startswith('ssh-rsa'):
-                # treat line as Github username
-                url = get_github_keys_url(line)
-                if url is None:
-                    continue
-                res = get_pub_keys_from_url(url)
-                if res is not None:
-                    for key in res:
-                        keys.append(key)
-            else:
-                # key is string
-                key_to_import = get_pub_key_from_string(line)
-                if key_to_import is not None:
-                    keys.append(key_to_import)
-
-                # there may be a better way to do this
-        return keys
-    except ValueError as err:
-        print(f'Invalid input: {err}')
-        return keys  # maybe return empty to signal error?
+    # imported here - the pipeline is built on top of this module
+    from lansync.pipeline import iter_keys
+    return [record.line for record in iter_keys(key)]
 
 
 def get_pub_keys_from_file(path: str) -> List[str]:
+    from lansync.validation import validate_keys
     try:
         keys = []  # type: List[str]
-        file_lines = map(lambda x: x.replace('\n', ''), open(path, 'r').readlines())
-        for line in file_lines:
-            extracted = get_pub_key_from_string(line)
-            if extracted is not None:
-                keys.append(extracted)
-        return keys
+        with open(path, 'r') as f:
+            # validate in bounded batches instead of reading the whole file first
+            while True:
+                file_lines = [line.replace('\n', '') for line in islice(f, INGEST_BATCH_SIZE)]
+                if len(file_lines) == 0:
+                    return keys
+                keys.extend(record.line for record in validate_keys(file_lines) if record is not None)
     except OSError as err:
-        print(f'Couldn\'t read file: {err}')
+        log(f'Couldn\'t read file: {err}', ERROR, path=path)
         return []
     except ValueError as err:
-        print(f'Invalid path: {err}')
+        log(f'Invalid path: {err}', ERROR, path=path)
         return []
 
 
 def get_pub_key_from_string(key: str) -> Optional[str]:
     if key is None or key == '':
         return None
-    ssh_key = SSHKey(key, strict=True)
-    try:
-        ssh_key.parse()
-    except InvalidKeyError as err:
-        print(f'Invalid key: {err}')
-        return None
-    except NotImplementedError as err:
-        print(f'Invalid key type: {err}')
+    from lansync.validation import validate_key
+    # verdicts are cached per key blob so the same key is never parsed twice
+    record = validate_key(key)
+    if record is None:
         return None
-    # Library can return some hash functions of the key
-    # I'm just using it for checking - if valid key, return it
-    return key
+    return record.line
 
 
 def get_pub_keys_from_url(url: str) -> List[str]:
@@ -118,13 +142,14 @@ def get_pub_keys_from_url(url: str) -> List[str]:
     # to allow retrieving multiple keys?
     if not is_valid_web_url(url):
         return []
-    lines = map(lambda x: x.decode('utf-8').replace('\n', ''), urlopen(url).readlines())
-    keys = []
-    for line in lines:
-        key = get_pub_key_from_string(line)  # allow string entries only
-        if key is not None:
-            keys.append(key)
-    return keys
+    from lansync.fetch import get_fetcher
+    from lansync.validation import validate_keys
+    response = get_fetcher().take(url)
+    if response.status != 200:
+        log(f'Couldn\'t download keys from {url}: {response.error or response.status}', WARNING, url=url, status=response.status)
+        return []
+    lines = response.body.decode('utf-8').splitlines()
+    return [record.line for record in validate_keys(lines) if record is not None]
 
 
 def is_valid_web_url(url: str) -> bool:
@@ -151,48 +176,68 @@ def is_valid_username(username: str) -> bool:
     return True
 
 
+def get_key_store(auth_keys_path=AUTHORIZED_KEYS_PATH) -> KeyStore:
+    '''
+    Store shared by the single key functions below. It is read again (from the
+    persisted index when that is current) only when authorized_keys changed,
+    and its index is saved once at exit instead of after every imported key.
+    '''
+    store = _key_stores.get(auth_keys_path)
+    if store is None:
+        store = _key_stores[auth_keys_path] = KeyStore(auth_keys_path, persist_index=True)
+        atexit.register(store.save)
+    elif not store.is_current():
+        store.load()
+    return store
+
+
 def is_key_imported(key: str, auth_keys_path=AUTHORIZED_KEYS_PATH) -> bool:
     '''
     Check if ~/.ssh/authorized_keys exists and if key is in there
     '''
-    if not os.path.exists(auth_keys_path):
-        return False
-    return SECURE_OPTIONS + ' ' + key + '\n' in open(auth_keys_path).readlines()
+    return get_key_store(auth_keys_path).is_imported(key)
 
 
 def import_key(key: str, auth_keys_path=AUTHORIZED_KEYS_PATH) -> Optional[str]:
     '''
-    Import ssh key only if not imported already
+    Import ssh key only if not imported already.
+    Use KeyStore.import_keys when importing more than one key.
     '''
-    if is_key_imported(key, auth_keys_path):
-        return None
-    with open(auth_keys_path, 'a') as f:
-        to_write = SECURE_OPTIONS + ' ' + key + '\n'
-        f.write(to_write)
-    return key
+    return get_key_store(auth_keys_path).import_key(key)
 
 
 def get_local_ip() -> str:
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(("8.8.8.8", 80))
-    iface = s.getsockname()[0]
-    s.close()
-    return iface
+    # asks the kernel instead of connecting out, works on networks without internet access
+    from lansync.netif import local_address
+    return local_address()
 
 
 def get_github_keys_url(username: str) -> Optional[str]:
     if username is None or username == '':
         return None
 
-    url = 'https://github.com/' + username + '.keys'
-    req = urlopen(url)
+    from lansync.fetch import get_fetcher
+    url = github_keys_url(username)
+    # the response is kept by the fetcher so downloading the keys afterwards is free
+    response = get_fetcher().fetch(url)
     # if url doesn't exits, exit
-    if req.getcode() != 200:
-        log(f'User not found: {username}')
+    if response.status != 200:
+        log(f'User not found: {username}', WARNING, username=username)
         return None
     return url
 
 
+def github_keys_url(username: str) -> str:
+    return 'https://github.com/' + username + '.keys'
+
+
+def parse_indices(indices: str) -> List[int]:
+    try:
+        return [int(index) for index in indices.split(',') if index.strip() != '']
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid segment list: {indices}')
+
+
 def parse_size(size: str) -> int:
     # if size is N - where N is a number - just return it
     size_split = re.findall(r'\d+', size)
@@ -208,13 +253,17 @@ def parse_size(size: str) -> int:
     return size_int * units[unit_str]
 
 
+def format_size(size: int) -> str:
+    '''
+    Inverse of parse_size, rounded to one decimal
+    '''
+    for unit in ['T', 'G', 'M', 'K']:
+        unit_size = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}[unit]
+        if size >= unit_size:
+            return f'{size / unit_size:.1f}{unit}'
+    return str(size)
+
+
 def get_first_partition_offset(drive_path: str) -> int:
-    # empirical tests showed that offset is 65536 most of the time
-    # if on linux, do some bashing, to extract
-    if sys.platform == 'linux' or sys.platform == 'linux2':
-        cmd = "parted -s " + drive_path + " unit B print |awk '/^Number/{p=1;next}; p{gsub(/[^[:digit:]]/, \"\", $2); print $2}'"
-        result = os.popen(cmd).read()  # run and read output
-        size = int(result.split('\n')[0])  # assert first netry is num
-    else:
-        size = 65536  # seems to work okay
-    return size
+    # read the partition table ourselves instead of asking parted
+    return get_partition_offset(drive_path)
@@ -0,0 +1,189 @@
+'''
+Cached (and for big batches parallel) validation of public keys.
+
+Parsing a key with sshpubkeys is expensive, especially for large RSA keys, so
+the verdict for every key blob is kept in a bounded LRU cache that can be
+persisted under ~/.lansync/.
+'''
+import json
+import os
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+from lansync import metrics
+from lansync.keystore import KEY_RE, fingerprint
+from lansync.settings import KEY_CACHE_PATH, KEY_CACHE_SIZE, PARALLEL_VALIDATION_THRESHOLD
+
+
+# normalized record of a valid key
+PubKey = namedtuple('PubKey', ['line', 'key_type', 'blob', 'comment', 'fingerprint', 'bits'])
+# (is valid, number of bits or the reason it is invalid)
+Verdict = Tuple[bool, object]
+
+
+def check_key(key: str) -> Verdict:
+    '''
+    Fully parse the key. Module level so that it can run in a worker process
+    '''
+    # sshpubkeys pulls in cryptography, only pay for it once a key actually needs parsing
+    from sshpubkeys import SSHKey, InvalidKeyError
+    ssh_key = SSHKey(key, strict=True)
+    try:
+        ssh_key.parse()
+    except InvalidKeyError as err:
+        return False, f'Invalid key: {err}'
+    except NotImplementedError as err:
+        return False, f'Invalid key type: {err}'
+    return True, ssh_key.bits
+
+
+def cache_key(key: str) -> Optional[str]:
+    '''
+    Validity only depends on the key type and blob, not on the comment.
+    Keys with options in front of them are not cached.
+    '''
+    match = KEY_RE.search(key)
+    if match is None or match.start(1) != 0:
+        return None
+    return match.group(1) + ' ' + fingerprint(key)
+
+
+class ValidationCache(object):
+    '''
+    Bounded LRU cache of key verdicts, optionally persisted as JSON
+    '''
+    def __init__(self, path: Optional[str] = None, max_entries=KEY_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # type: OrderedDict
+        self._dirty = False
+        if path is not None:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> Optional[Verdict]:
+        verdict = self.entries.get(key)
+        if verdict is not None:
+            self.entries.move_to_end(key)
+        return verdict
+
+    def put(self, key: str, verdict: Verdict) -> None:
+        self.entries[key] = verdict
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self._dirty = True
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                for key, valid, info in json.load(f):
+                    self.entries[key] = (valid, info)
+        except (OSError, ValueError, TypeError):
+            self.entries = OrderedDict()
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self) -> None:
+        if self.path is None or not self._dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump([[key, valid, info] for key, (valid, info) in self.entries.items()], f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as err:
+            metrics.log(f'Couldn\'t save key cache: {err}', metrics.WARNING, path=self.path)
+
+
+_default_cache = None  # type: Optional[ValidationCache]
+
+
+def get_validation_cache() -> ValidationCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ValidationCache(KEY_CACHE_PATH)
+    return _default_cache
+
+
+def to_record(key: str, verdict: Verdict) -> Optional[PubKey]:
+    valid, info = verdict
+    if not valid:
+        return None
+    match = KEY_RE.search(key)
+    if match is None:
+        return PubKey(line=key, key_type=None, blob=None, comment=None, fingerprint=fingerprint(key), bits=info)
+    comment = key[match.end(2):].strip()
+    return PubKey(line=key, key_type=match.group(1), blob=match.group(2), comment=comment or None, fingerprint=fingerprint(key), bits=info)
+
+
+def validate_key(key: str, cache: Optional[ValidationCache] = None) -> Optional[PubKey]:
+    return validate_keys([key], cache)[0]
+
+
+def validate_keys(keys: Iterable[str], cache: Optional[ValidationCache] = None, processes: Optional[int] = None) -> List[Optional[PubKey]]:
+    '''
+    Validate a batch of keys, printing why invalid ones were rejected
+    '''
+    keys = list(keys)
+    records = []  # type: List[Optional[PubKey]]
+    for key, verdict in zip(keys, get_verdicts(keys, cache, processes)):
+        if verdict is not None and not verdict[0]:
+            metrics.log(verdict[1], metrics.WARNING)
+        records.append(None if verdict is None else to_record(key, verdict))
+    return records
+
+
+def get_verdicts(keys: List[str], cache: Optional[ValidationCache] = None, processes: Optional[int] = None, pool: Optional[Executor] = None) -> List[Optional[Verdict]]:
+    '''
+    Verdict for every key in the batch (None for empty ones). Each distinct key
+    is parsed at most once and batches with more than
+    PARALLEL_VALIDATION_THRESHOLD unparsed keys are spread over a process pool.
+    Callers validating many batches can pass their own pool to reuse it.
+    '''
+    cache = cache if cache is not None else get_validation_cache()
+    # keys that can't be cached are still deduplicated within the batch by their whole line
+    lookups = []  # type: List[Optional[str]]
+    verdicts = {}  # type: Dict[str, Verdict]
+    pending = OrderedDict()  # type: OrderedDict
+    for key in keys:
+        if key is None or key == '':
+            lookups.append(None)
+            continue
+        ckey = cache_key(key)
+        lookup = ckey if ckey is not None else key
+        lookups.append(lookup)
+        if lookup in verdicts or lookup in pending:
+            continue
+        verdict = cache.get(ckey) if ckey is not None else None
+        if verdict is not None:
+            verdicts[lookup] = verdict
+        else:
+            pending[lookup] = (key, ckey is not None)
+
+    if len(pending) > 0:
+        to_check = [key for key, _ in pending.values()]
+        with metrics.timer('key_parse'):
+            if len(to_check) > PARALLEL_VALIDATION_THRESHOLD and pool is not None:
+                results = list(pool.map(check_key, to_check, chunksize=64))
+            elif len(to_check) > PARALLEL_VALIDATION_THRESHOLD and (processes is None or processes > 1):
+                with ProcessPoolExecutor(max_workers=processes) as pool:
+                    results = list(pool.map(check_key, to_check, chunksize=64))
+            else:
+                results = [check_key(key) for key in to_check]
+        metrics.counter('keys_parsed', len(to_check))
+        for (lookup, (_, cacheable)), verdict in zip(pending.items(), results):
+            verdicts[lookup] = verdict
+            if cacheable:
+                cache.put(lookup, verdict)
+
+    result = [None if lookup is None else verdicts[lookup] for lookup in lookups]
+    if metrics.enabled():
+        valid = sum(1 for verdict in result if verdict is not None and verdict[0])
+        metrics.counter('keys_validated', valid, result='valid')
+        metrics.counter('keys_validated', len(keys) - lookups.count(None) - valid, result='invalid')
+    return result
@@ -0,0 +1,256 @@
+'''
+Integrity manifest of the share.
+
+The manifest keeps (size, mtime_ns, inode, digest) of every file in the
+share and only hashes files whose stat metadata changed since the last run.
+Files are hashed in HASH_CHUNK_SIZE pieces through mmap on a thread pool -
+hashlib drops the GIL while hashing - and a file's digest is the BLAKE2b of
+the digests of its pieces, so big files hash on every core.
+
+Senders can ship the digests of what they are about to send as a
+`<name>.lansync-expected` file; received files are checked against it,
+with --follow while the transfer is still running.
+'''
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import subprocess
+import tempfile
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from lansync.metrics import ERROR, WARNING, log
+from lansync.send import rsync_command
+from lansync.settings import HASH_CHUNK_SIZE, MANIFEST_PATH, PATH_TO_PUBLIC_DIR, RSYNC_BINARY
+from lansync import inotify
+
+
+EXPECTED_SUFFIX = '.lansync-expected'
+DIGEST_SIZE = 32
+# files hashed concurrently at most, each keeps an mmap open until it's done
+HASH_BATCH = 256
+
+STATUS_OK = 'ok'
+STATUS_MISMATCH = 'mismatch'
+STATUS_MISSING = 'missing'
+STATUS_CHANGED = 'changed on disk'
+
+Check = namedtuple('Check', ['name', 'status'])
+
+
+def combine(digests: Iterable[bytes]) -> str:
+    return hashlib.blake2b(b''.join(digests), digest_size=DIGEST_SIZE).hexdigest()
+
+
+def chunk_hash(view: memoryview) -> bytes:
+    return hashlib.blake2b(view, digest_size=DIGEST_SIZE).digest()
+
+
+class Hasher(object):
+    '''
+    Hashes files on a thread pool, every HASH_CHUNK_SIZE piece of a file separately
+    '''
+    def __init__(self, chunk_size=HASH_CHUNK_SIZE, workers: Optional[int] = None):
+        self.chunk_size = chunk_size
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+
+    def _submit(self, path: str) -> Tuple[Optional[mmap.mmap], List[Future]]:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None, []
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(m)
+        futures = [self.pool.submit(chunk_hash, view[offset:offset + self.chunk_size]) for offset in range(0, size, self.chunk_size)]
+        view.release()
+        return m, futures
+
+    def hash_files(self, paths: List[str], on_error: Callable[[str, OSError], None] = lambda path, err: None) -> Dict[str, str]:
+        digests = {}  # type: Dict[str, str]
+        for start in range(0, len(paths), HASH_BATCH):
+            pending = []
+            for path in paths[start:start + HASH_BATCH]:
+                try:
+                    pending.append((path,) + self._submit(path))
+                except (OSError, ValueError) as err:
+                    on_error(path, err)
+            for path, m, futures in pending:
+                digests[path] = combine(future.result() for future in futures)
+                if m is not None:
+                    m.close()
+        return digests
+
+    def hash_file(self, path: str) -> str:
+        return self.hash_files([path])[path]
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def walk(root: str) -> Iterable[Tuple[str, os.stat_result]]:
+    stack = ['']
+    while len(stack) > 0:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel)) as entries:
+            for entry in entries:
+                child = os.path.join(rel, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(child)
+                elif entry.is_file(follow_symlinks=False):
+                    yield child, entry.stat(follow_symlinks=False)
+
+
+class Manifest(object):
+    def __init__(self, root=PATH_TO_PUBLIC_DIR, path=MANIFEST_PATH, chunk_size=HASH_CHUNK_SIZE):
+        self.root = os.path.abspath(root)
+        self.path = path
+        self.chunk_size = chunk_size
+        # rel path -> [size, mtime_ns, inode, digest]
+        self.entries = {}  # type: Dict[str, list]
+
+    def load(self) -> None:
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                data = json.load(f)
+            if data['root'] == self.root and data['chunk_size'] == self.chunk_size:
+                self.entries = data['entries']
+        except (OSError, ValueError, KeyError, EOFError):
+            self.entries = {}
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with gzip.open(tmp_path, 'wt') as f:
+            json.dump({'root': self.root, 'chunk_size': self.chunk_size, 'entries': self.entries}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def update(self, hasher: Hasher, full=False, names: Optional[Iterable[str]] = None) -> List[Check]:
+        '''
+        Rehash files whose size, mtime or inode changed, or every file with full.
+        Files whose contents changed while their metadata didn't are returned.
+        Only looks at names when given.
+        '''
+        if names is None:
+            found = {rel: st for rel, st in walk(self.root) if not rel.endswith(EXPECTED_SUFFIX)}
+            for rel in [rel for rel in self.entries if rel not in found]:
+                del self.entries[rel]
+        else:
+            found = {}
+            for rel in names:
+                try:
+                    found[rel] = os.stat(os.path.join(self.root, rel))
+                except OSError:
+                    self.entries.pop(rel, None)
+        stale = {}  # type: Dict[str, list]
+        for rel, st in found.items():
+            signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = self.entries.get(rel)
+            if full or entry is None or entry[:3] != signature:
+                stale[rel] = signature
+        digests = hasher.hash_files([os.path.join(self.root, rel) for rel in stale], on_error=lambda path, err: log(f'Couldn\'t hash {path}: {err}', ERROR, path=path))
+        changed = []  # type: List[Check]
+        for rel, signature in stale.items():
+            digest = digests.get(os.path.join(self.root, rel))
+            if digest is None:
+                continue
+            entry = self.entries.get(rel)
+            if entry is not None and entry[:3] == signature and entry[3] != digest:
+                changed.append(Check(rel, STATUS_CHANGED))
+            self.entries[rel] = signature + [digest]
+        return changed
+
+
+def write_expected(path: str, files: Dict[str, str], hasher: Hasher) -> None:
+    '''
+    Manifest of files (name in the share -> local path) for the receiver to check against
+    '''
+    digests = hasher.hash_files(list(files.values()))
+    expected = {name: [os.path.getsize(local), digests[local]] for name, local in files.items()}
+    with open(path, 'w') as f:
+        json.dump({'chunk_size': hasher.chunk_size, 'files': expected}, f)
+
+
+def ship_expected(name: str, files: Dict[str, str], peer: str, hasher: Hasher, rsync=RSYNC_BINARY, options: Sequence[str] = ()) -> int:
+    '''
+    Send the manifest of files to peer ahead of them, returns rsync's exit status
+    '''
+    with tempfile.TemporaryDirectory() as staging:
+        path = os.path.join(staging, name + EXPECTED_SUFFIX)
+        write_expected(path, files, hasher)
+        return subprocess.run(rsync_command([path], peer, rsync, options), stdout=subprocess.DEVNULL).returncode
+
+
+def read_expected(path: str) -> Tuple[int, Dict[str, list]]:
+    with open(path, 'r') as f:
+        data = json.load(f)
+    return int(data['chunk_size']), data['files']
+
+
+def check_expected(manifest: Manifest, expected: Dict[str, list]) -> List[Check]:
+    checks = []  # type: List[Check]
+    for name, (size, digest) in sorted(expected.items()):
+        entry = manifest.entries.get(name)
+        if entry is None:
+            checks.append(Check(name, STATUS_MISSING))
+        elif entry[0] == size and entry[3] == digest:
+            checks.append(Check(name, STATUS_OK))
+        else:
+            checks.append(Check(name, STATUS_MISMATCH))
+    return checks
+
+
+def expected_files(root: str, chunk_size=HASH_CHUNK_SIZE) -> Dict[str, list]:
+    '''
+    Files every manifest shipped by senders expects, name in the share -> [size, digest]
+    '''
+    expected = {}  # type: Dict[str, list]
+    for name in sorted(os.listdir(root)):
+        if name.endswith(EXPECTED_SUFFIX):
+            try:
+                sender_chunk_size, files = read_expected(os.path.join(root, name))
+            except (OSError, ValueError, KeyError, TypeError) as err:
+                log(f'Couldn\'t read {name}: {err}', WARNING, path=os.path.join(root, name))
+                continue
+            if sender_chunk_size != chunk_size:
+                # digests over different pieces never match
+                log(f'Couldn\'t check {name}: hashed in {sender_chunk_size} byte pieces instead of {chunk_size}', WARNING, path=os.path.join(root, name))
+                continue
+            expected.update(files)
+    return expected
+
+
+def verify(manifest: Manifest, hasher: Hasher, full=False) -> List[Check]:
+    changed = manifest.update(hasher, full)
+    return changed + check_expected(manifest, expected_files(manifest.root, manifest.chunk_size))
+
+
+def follow(manifest: Manifest, hasher: Hasher, on_check: Callable[[Check], None], should_stop: Callable[[], bool] = lambda: False) -> None:
+    '''
+    Check expected files as they arrive until should_stop returns True
+    '''
+    with inotify.Inotify() as watcher:
+        watcher.add_watch(manifest.root, inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+        reported = {}  # type: Dict[str, str]
+
+        def report(checks: List[Check]) -> None:
+            for check in checks:
+                if check.status != STATUS_MISSING and reported.get(check.name) != check.status:
+                    reported[check.name] = check.status
+                    on_check(check)
+
+        report(verify(manifest, hasher))
+        while not should_stop():
+            names = {event.name for event in watcher.read_events(timeout=1) if event.name != ''}
+            if len(names) == 0:
+                continue
+            expected = expected_files(manifest.root, manifest.chunk_size)
+            manifest.update(hasher, names=[name for name in names if name in expected])
+            report(check_expected(manifest, expected))
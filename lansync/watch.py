@@ -0,0 +1,395 @@
+'''
+Push an outbox directory to peers as files show up in it.
+
+inotify events are coalesced per file: a file is sent once it has been
+quiet for the debounce window (or has been changing for max_delay seconds).
+Every peer gets its changed files in batches over as few rsync processes as
+the command line allows, peers are served concurrently and each has at most
+one transfer in flight - whatever changes meanwhile joins its next batch.
+Failed batches are retried with exponential backoff. Like lansync send,
+batches can be grouped (compression.plan) and every group sent with its
+own rsync options. Files land in the root
+of the peer's share, so files with the same name in different directories
+are held back and reported until only one of them is left.
+
+What still has to be sent to whom, the retry state and the mtime of every
+directory are persisted, so a restart only rescans directories whose mtime
+changed instead of the whole outbox.
+'''
+import hashlib
+import json
+import os
+import subprocess
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set
+from lansync import inotify
+from lansync.metrics import ERROR, WARNING, log
+from lansync.send import FileEntry, GroupFiles, chunk_args, rsync_command
+from lansync.settings import (RSYNC_BINARY, WATCH_BATCH_BYTES, WATCH_BATCH_FILES, WATCH_DEBOUNCE, WATCH_MAX_DELAY, WATCH_RETRY,
+                              WATCH_RETRY_MAX, WATCH_SAVE_INTERVAL, WATCH_STATE_DIR)
+
+
+# sent and failed are relative paths, retry_in is None when the batch went through
+BatchResult = namedtuple('BatchResult', ['peer', 'sent', 'failed', 'returncode', 'retry_in'])
+
+
+def parent(rel: str) -> str:
+    return os.path.dirname(rel)
+
+
+def join(rel: str, name: str) -> str:
+    return name if rel == '' else rel + '/' + name
+
+
+def signature(st: os.stat_result) -> List[int]:
+    return [st.st_size, st.st_mtime_ns]
+
+
+def state_path(root: str, state_dir=WATCH_STATE_DIR) -> str:
+    return os.path.join(state_dir, hashlib.blake2b(os.path.abspath(root).encode(), digest_size=8).hexdigest() + '.json')
+
+
+class PeerQueue(object):
+    def __init__(self, pending: Optional[Set[str]] = None, attempts=0, next_try=0.0):
+        self.pending = pending if pending is not None else set()  # type: Set[str]
+        self.attempts = attempts
+        # wall clock time, so the backoff survives a restart
+        self.next_try = next_try
+        self.running = None  # type: Optional[Future]
+        # signatures of the files in the batch in flight
+        self.batch = {}  # type: Dict[str, List[int]]
+
+    def to_json(self) -> dict:
+        return {'pending': sorted(self.pending), 'attempts': self.attempts, 'next_try': self.next_try}
+
+
+class Outbox(object):
+    def __init__(self, root: str, peers: List[str], state_dir=WATCH_STATE_DIR, debounce=WATCH_DEBOUNCE, max_delay=WATCH_MAX_DELAY,
+                 rsync=RSYNC_BINARY, batch_files=WATCH_BATCH_FILES, batch_bytes=WATCH_BATCH_BYTES,
+                 on_batch: Callable[[BatchResult], None] = lambda result: None, clock: Callable[[], float] = time.time,
+                 group_files: Optional[GroupFiles] = None):
+        self.root = os.path.abspath(root)
+        self.path = state_path(self.root, state_dir)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.rsync = rsync
+        self.batch_files = batch_files
+        self.batch_bytes = batch_bytes
+        self.on_batch = on_batch
+        self.clock = clock
+        self.group_files = group_files
+        self.files = {}  # type: Dict[str, List[int]]
+        self.dirs = {}  # type: Dict[str, int]
+        self.queues = {peer: PeerQueue() for peer in peers}  # type: Dict[str, PeerQueue]
+        # rel -> [first event, last event] of files that are still changing
+        self.changing = {}  # type: Dict[str, List[float]]
+        self._watches = {}  # type: Dict[int, str]
+        self._dirty = False
+        # names of clashing files that were reported already
+        self._clashes = set()  # type: Set[str]
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            if state['root'] != self.root:
+                return False
+            files, dirs, peers = state['files'], state['dirs'], state['peers']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        self.files = files
+        self.dirs = dirs
+        for peer, queue in self.queues.items():
+            if peer in peers:
+                self.queues[peer] = PeerQueue(set(peers[peer]['pending']), peers[peer]['attempts'], peers[peer]['next_try'])
+            else:
+                # a peer added since the last run needs everything
+                queue.pending = set(self.files)
+        return True
+
+    def save(self) -> None:
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'root': self.root, 'files': self.files, 'dirs': self.dirs,
+                           'peers': {peer: queue.to_json() for peer, queue in self.queues.items()}}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as err:
+            log(f'Couldn\'t save watch state: {err}', WARNING, path=self.path)
+
+    def refresh(self, rescan=False) -> None:
+        '''
+        Load the persisted state and catch up with changes made while nobody
+        was watching, scanning everything only without state or with rescan
+        '''
+        if not self.load() or rescan:
+            self._scan_dir('')
+        else:
+            self.reconcile()
+        self.save()
+
+    def reconcile(self) -> None:
+        '''
+        Rescan directories whose mtime changed - creating, renaming and deleting
+        files bumps it. Files changed in place while nobody watched are missed.
+        '''
+        for rel in sorted(self.dirs, key=len):
+            if rel not in self.dirs:
+                continue  # dropped together with its parent
+            try:
+                st = os.stat(os.path.join(self.root, rel))
+            except OSError:
+                self._drop_dir(rel)
+                continue
+            if st.st_mtime_ns != self.dirs[rel]:
+                self._rescan_entries(rel)
+
+    def _scan_dir(self, rel: str) -> None:
+        stack = [rel]
+        while len(stack) > 0:
+            current = stack.pop()
+            try:
+                self.dirs[current] = os.stat(os.path.join(self.root, current)).st_mtime_ns
+                with os.scandir(os.path.join(self.root, current)) as entries:
+                    for entry in entries:
+                        child = join(current, entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(child)
+                        elif entry.is_file(follow_symlinks=False):
+                            self._changed(child, signature(entry.stat(follow_symlinks=False)))
+            except OSError as err:
+                path = os.path.join(self.root, current)
+                log(f'Couldn\'t scan {path}: {err}', WARNING, path=path)
+
+    def _rescan_entries(self, rel: str) -> None:
+        prefix = '' if rel == '' else rel + '/'
+        for child in [name for name in self.files if parent(name) == rel]:
+            if not os.path.isfile(os.path.join(self.root, child)):
+                self._removed(child)
+        for child in [name for name in self.dirs if name != '' and parent(name) == rel]:
+            if not os.path.isdir(os.path.join(self.root, child)):
+                self._drop_dir(child)
+        try:
+            self.dirs[rel] = os.stat(os.path.join(self.root, rel)).st_mtime_ns
+            with os.scandir(os.path.join(self.root, rel)) as entries:
+                for entry in entries:
+                    child = prefix + entry.name
+                    if entry.is_dir(follow_symlinks=False) and child not in self.dirs:
+                        self._scan_dir(child)
+                    elif entry.is_file(follow_symlinks=False):
+                        self._changed(child, signature(entry.stat(follow_symlinks=False)))
+        except OSError as err:
+            path = os.path.join(self.root, rel)
+            log(f'Couldn\'t scan {path}: {err}', WARNING, path=path)
+
+    def _changed(self, rel: str, sig: List[int]) -> None:
+        if self.files.get(rel) == sig:
+            return
+        self.files[rel] = sig
+        for queue in self.queues.values():
+            queue.pending.add(rel)
+        self._dirty = True
+
+    def _removed(self, rel: str) -> None:
+        # deletes aren't propagated, there is just nothing left to send
+        if self.files.pop(rel, None) is not None:
+            for queue in self.queues.values():
+                queue.pending.discard(rel)
+            self._dirty = True
+        self.changing.pop(rel, None)
+
+    def _drop_dir(self, rel: str) -> None:
+        prefix = rel + '/'
+        for name in [name for name in self.files if name.startswith(prefix)]:
+            self._removed(name)
+        for name in [name for name in self.dirs if name == rel or name.startswith(prefix)]:
+            del self.dirs[name]
+        self._dirty = True
+
+    def _add_watch(self, watcher: inotify.Inotify, rel: str) -> None:
+        try:
+            wd = watcher.add_watch(os.path.join(self.root, rel), inotify.TREE_EVENTS | inotify.IN_ONLYDIR)
+            self._watches[wd] = rel
+        except OSError as err:
+            path = os.path.join(self.root, rel)
+            log(f'Couldn\'t watch {path}: {err}', WARNING, path=path)
+
+    def handle_event(self, watcher: inotify.Inotify, event: inotify.Event, now: float) -> None:
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            # events were lost - look at everything again
+            self._scan_dir('')
+            for rel in self.dirs:
+                if rel not in self._watches.values():
+                    self._add_watch(watcher, rel)
+            return
+        rel = self._watches.get(event.wd)
+        if rel is None:
+            return
+        if event.mask & inotify.IN_IGNORED:
+            del self._watches[event.wd]
+            return
+        if event.name == '':
+            return
+        child = join(rel, event.name)
+        if event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            if event.mask & inotify.IN_ISDIR:
+                for wd, name in list(self._watches.items()):
+                    if name == child or name.startswith(child + '/'):
+                        watcher.rm_watch(wd)
+                        del self._watches[wd]
+                self._drop_dir(child)
+            else:
+                self._removed(child)
+        elif event.mask & inotify.IN_ISDIR:
+            if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO) and child not in self.dirs:
+                self._scan_dir(child)
+                for name in [name for name in self.dirs if name == child or name.startswith(child + '/')]:
+                    self._add_watch(watcher, name)
+        else:
+            first = self.changing.get(child, [now])[0]
+            self.changing[child] = [first, now]
+        if rel in self.dirs:
+            try:
+                self.dirs[rel] = os.stat(os.path.join(self.root, rel)).st_mtime_ns
+            except OSError:
+                pass
+
+    def settle(self, now: float) -> None:
+        '''
+        Queue files that have been quiet for the debounce window or changing for too long
+        '''
+        for rel, (first, last) in list(self.changing.items()):
+            if now - last < self.debounce and now - first < self.max_delay:
+                continue
+            del self.changing[rel]
+            try:
+                st = os.lstat(os.path.join(self.root, rel))
+            except OSError:
+                self._removed(rel)
+                continue
+            self._changed(rel, signature(st))
+
+    def clashes(self) -> Dict[str, List[str]]:
+        '''
+        Files that would overwrite each other in the peer's share, by name
+        '''
+        by_name = {}  # type: Dict[str, List[str]]
+        for rel in self.files:
+            by_name.setdefault(os.path.basename(rel), []).append(rel)
+        return {name: sorted(rels) for name, rels in by_name.items() if len(rels) > 1}
+
+    def next_batch(self, queue: PeerQueue) -> List[FileEntry]:
+        batch = []  # type: List[FileEntry]
+        size = 0
+        clashes = self.clashes()
+        for name in sorted(set(clashes) - self._clashes):
+            paths = [os.path.join(self.root, rel) for rel in clashes[name]]
+            log(f'{" and ".join(paths)} would overwrite each other in the share, not sending them until only one is left', WARNING, paths=paths)
+        self._clashes = set(clashes)
+        clashing = {rel for rels in clashes.values() for rel in rels}
+        for rel in sorted(queue.pending):
+            if rel in self.changing or rel in clashing:
+                continue  # wait for it to settle or for the clash to be resolved
+            if len(batch) >= self.batch_files or (len(batch) > 0 and size >= self.batch_bytes):
+                break
+            sig = self.files.get(rel)
+            if sig is None:
+                queue.pending.discard(rel)
+                continue
+            batch.append(FileEntry(os.path.join(self.root, rel), os.path.basename(rel), sig[0]))
+            queue.batch[rel] = sig
+            size += sig[0]
+        return batch
+
+    def transfer(self, peer: str, batch: List[FileEntry]) -> BatchResult:
+        sent = []  # type: List[str]
+        failed = []  # type: List[str]
+        returncode = 0
+        groups = self.group_files(batch) if self.group_files is not None else [([], batch)]
+        for options, members in groups:
+            for chunk in chunk_args(members):
+                result = subprocess.run(rsync_command([entry.path for entry in chunk], peer, self.rsync, options), stdout=subprocess.DEVNULL)
+                rels = [os.path.relpath(entry.path, self.root) for entry in chunk]
+                if result.returncode == 0:
+                    sent.extend(rels)
+                else:
+                    failed.extend(rels)
+                    returncode = returncode or result.returncode
+        return BatchResult(peer, sent, failed, returncode, None)
+
+    def finish(self, queue: PeerQueue, result: BatchResult) -> BatchResult:
+        for rel in result.sent:
+            # changed again while it was being sent - keep it for the next batch
+            if self.files.get(rel) == queue.batch.get(rel):
+                queue.pending.discard(rel)
+        queue.batch = {}
+        if len(result.failed) > 0:
+            queue.attempts += 1
+            retry_in = min(WATCH_RETRY_MAX, WATCH_RETRY * 2 ** (queue.attempts - 1))
+            queue.next_try = self.clock() + retry_in
+            result = result._replace(retry_in=retry_in)
+        else:
+            queue.attempts = 0
+            queue.next_try = 0.0
+        self._dirty = True
+        return result
+
+    def pump(self, pool: ThreadPoolExecutor) -> None:
+        '''
+        Collect finished transfers and start the next batch for every idle peer
+        '''
+        for peer, queue in self.queues.items():
+            if queue.running is not None:
+                if not queue.running.done():
+                    continue
+                try:
+                    result = queue.running.result()
+                except OSError as err:
+                    result = BatchResult(peer, [], sorted(queue.batch), None, None)
+                    log(f'Couldn\'t run {self.rsync}: {err}', ERROR, peer=peer)
+                queue.running = None
+                self.on_batch(self.finish(queue, result))
+            if len(queue.pending) == 0 or self.clock() < queue.next_try:
+                continue
+            batch = self.next_batch(queue)
+            if len(batch) > 0:
+                queue.running = pool.submit(self.transfer, peer, batch)
+
+    def idle(self) -> bool:
+        return len(self.changing) == 0 and all(queue.running is None and len(queue.pending) == 0 for queue in self.queues.values())
+
+    def watch(self, should_stop: Callable[[], bool] = lambda: False, save_interval=WATCH_SAVE_INTERVAL) -> None:
+        '''
+        Follow the outbox and push changes to every peer until should_stop returns True
+        '''
+        with inotify.Inotify() as watcher, ThreadPoolExecutor(max_workers=max(1, len(self.queues))) as pool:
+            for rel in list(self.dirs):
+                self._add_watch(watcher, rel)
+            # changes between the refresh and the watches being in place
+            self.reconcile()
+            last_save = time.monotonic()
+            while not should_stop():
+                self.pump(pool)
+                timeout = min(self.debounce, 1) if len(self.changing) > 0 else 1
+                if any(queue.running is not None for queue in self.queues.values()):
+                    timeout = min(timeout, 0.1)
+                now = time.monotonic()
+                for event in watcher.read_events(timeout=timeout):
+                    self.handle_event(watcher, event, now)
+                self.settle(time.monotonic())
+                if self._dirty and time.monotonic() - last_save >= save_interval:
+                    self.save()
+                    last_save = time.monotonic()
+            for queue in self.queues.values():
+                if queue.running is not None:
+                    # a batch that already started is waited for, one that hasn't stays pending
+                    if queue.running.cancel():
+                        queue.batch = {}
+                    else:
+                        self.on_batch(self.finish(queue, queue.running.result()))
+                    queue.running = None
+            self.save()
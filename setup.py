@@ -17,6 +17,14 @@ setuptools.setup(
     install_requires=[
         'sshpubkeys'
     ],
+    extras_require={
+        # built-in delta engine used by lansync sync
+        'delta': ['numpy'],
+        # chunking of lansync dedup
+        'dedup': ['numpy'],
+        # timing zstd and lz4 for lansync send --compress, zlib needs nothing
+        'compression': ['zstandard', 'lz4'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",